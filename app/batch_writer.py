@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+from google.api_core import exceptions
+
+from models import BatchChunkResult, BatchWriteResult
+from usage import propagate, record, start_writing
+
+# Firestore rejects batches with more than 500 writes
+BATCH_LIMIT = 500
+BATCH_WORKERS = 8
+BATCH_RETRIES = 3
+BATCH_BACKOFF_SECONDS = 0.5
+
+SET = "set"
+UPDATE = "update"
+
+# Errors worth retrying; anything else (a missing document for an update,
+# a permission error) fails the same way every time
+TRANSIENT_ERRORS = (
+    exceptions.Aborted,
+    exceptions.DeadlineExceeded,
+    exceptions.InternalServerError,
+    exceptions.ResourceExhausted,
+    exceptions.ServiceUnavailable,
+)
+
+
+def coalesce(writes: List[Tuple]) -> List[Tuple]:
+    """
+    Folds repeated writes to the same document into one, later fields
+    overriding earlier ones, keeping the position of the first write.
+    """
+    merged: Dict[str, Tuple] = {}
+    for ref, data in writes:
+        if ref.path in merged:
+            merged[ref.path] = (ref, {**merged[ref.path][1], **data})
+        else:
+            merged[ref.path] = (ref, dict(data))
+    return list(merged.values())
+
+def chunked(writes: List[Tuple], size: int) -> List[List[Tuple]]:
+    return [writes[start:start + size] for start in range(0, len(writes), size)]
+
+def summarise(results: List[BatchChunkResult], total: int) -> BatchWriteResult:
+    result = BatchWriteResult(
+        chunks=results,
+        written=sum(result.size for result in results if result.success),
+        failed=sum(result.size for result in results if not result.success),
+    )
+    if result.failed:
+        logging.error(f"{result.failed} of {total} writes failed in {len(results)} batches")
+    return result
+
+def stage(batch, chunk: List[Tuple], op: str):
+    for ref, data in chunk:
+        if op == UPDATE:
+            batch.update(ref, data)
+        else:
+            batch.set(ref, data, merge=True)
+
+def backoff_delay(backoff: float, attempt: int) -> float:
+    return backoff * (2 ** (attempt - 1)) * (1 + random.random())
+
+
+class BatchWriter():
+    """
+    Commits document writes in batches of at most chunkSize writes, with at
+    most maxWorkers batches in flight, retrying transient failures with
+    exponential backoff.
+    """
+
+    def __init__(self, client, chunkSize: int = BATCH_LIMIT, maxWorkers: int = BATCH_WORKERS,
+                 retries: int = BATCH_RETRIES, backoff: float = BATCH_BACKOFF_SECONDS):
+        self.client = client
+        self.chunkSize = chunkSize
+        self.retries = retries
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix="batch-writer")
+
+    def commit(self, writes: List[Tuple], op: str = SET, retry: bool = True) -> BatchWriteResult:
+        """
+        writes is a list of (document_ref, data) pairs. SET writes are merged
+        into existing documents, UPDATE writes fail for missing documents.
+
+        With retry=False a failed batch is not committed again. A commit that
+        failed may still have landed, so writes that must not be applied
+        twice, such as firestore.Increment, are committed this way and the
+        caller repairs what they touch when the result has failures.
+        """
+        writes = coalesce(writes)
+        # The chunks commit concurrently, none of them may be rejected for
+        # the budget once another one has been written
+        start_writing()
+        retries = self.retries if retry else 0
+        commitChunk = propagate(self.commitChunk)
+        futures = [self.executor.submit(commitChunk, index, chunk, op, retries) for index, chunk in enumerate(chunked(writes, self.chunkSize))]
+        return summarise([future.result() for future in futures], len(writes))
+
+    def commitChunk(self, index: int, chunk: List[Tuple], op: str, retries: int) -> BatchChunkResult:
+        attempt = 0
+        while True:
+            attempt += 1
+            batch = self.client.batch()
+            stage(batch, chunk, op)
+            record()
+            try:
+                batch.commit()
+            except TRANSIENT_ERRORS as e:
+                if attempt > retries:
+                    logging.error(f"Giving up on batch {index} after {attempt} attempts: {e}")
+                    return BatchChunkResult(index=index, size=len(chunk), success=False, error=str(e), attempts=attempt)
+                delay = backoff_delay(self.backoff, attempt)
+                logging.warning(f"Retrying batch {index} in {delay:.2f}s: {e}")
+                time.sleep(delay)
+            except Exception as e:
+                logging.error(f"Error committing batch {index}: {e}")
+                return BatchChunkResult(index=index, size=len(chunk), success=False, error=str(e), attempts=attempt)
+            else:
+                record(writes=len(chunk), round_trips=0)
+                return BatchChunkResult(index=index, size=len(chunk), success=True, attempts=attempt)
+
+
+class AsyncBatchWriter():
+    """
+    BatchWriter for the async Firestore client: the batches are committed
+    concurrently on the event loop instead of on a thread pool.
+    """
+
+    def __init__(self, client, chunkSize: int = BATCH_LIMIT, maxWorkers: int = BATCH_WORKERS,
+                 retries: int = BATCH_RETRIES, backoff: float = BATCH_BACKOFF_SECONDS):
+        self.client = client
+        self.chunkSize = chunkSize
+        self.maxWorkers = maxWorkers
+        self.retries = retries
+        self.backoff = backoff
+
+    async def commit(self, writes: List[Tuple], op: str = SET, retry: bool = True) -> BatchWriteResult:
+        writes = coalesce(writes)
+        start_writing()
+        retries = self.retries if retry else 0
+        # Created per call, a semaphore belongs to the running event loop
+        limit = asyncio.Semaphore(self.maxWorkers)
+        results = await asyncio.gather(*(self.commitChunk(index, chunk, op, retries, limit) for index, chunk in enumerate(chunked(writes, self.chunkSize))))
+        return summarise(list(results), len(writes))
+
+    async def commitChunk(self, index: int, chunk: List[Tuple], op: str, retries: int, limit: asyncio.Semaphore) -> BatchChunkResult:
+        attempt = 0
+        while True:
+            attempt += 1
+            batch = self.client.batch()
+            stage(batch, chunk, op)
+            record()
+            try:
+                async with limit:
+                    await batch.commit()
+            except TRANSIENT_ERRORS as e:
+                if attempt > retries:
+                    logging.error(f"Giving up on batch {index} after {attempt} attempts: {e}")
+                    return BatchChunkResult(index=index, size=len(chunk), success=False, error=str(e), attempts=attempt)
+                delay = backoff_delay(self.backoff, attempt)
+                logging.warning(f"Retrying batch {index} in {delay:.2f}s: {e}")
+                await asyncio.sleep(delay)
+            except Exception as e:
+                logging.error(f"Error committing batch {index}: {e}")
+                return BatchChunkResult(index=index, size=len(chunk), success=False, error=str(e), attempts=attempt)
+            else:
+                record(writes=len(chunk), round_trips=0)
+                return BatchChunkResult(index=index, size=len(chunk), success=True, attempts=attempt)
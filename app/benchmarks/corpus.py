@@ -0,0 +1,154 @@
+import datetime
+import random
+from typing import List, Tuple
+
+from models import Message, Pattern, PatternAction, Sender, SenderStatus
+
+# (sender id, bank name) of the banks the corpus has messages from
+BANKS = [("HDFCBK", "HDFC"), ("ICICIT", "ICICI"), ("SBIUPI", "SBI"), ("AXISBK", "AXIS"), ("KOTAKB", "KOTAK")]
+PROMO_SENDERS = ["MYNTRA", "SWIGGY", "ZOMATO", "AIRTEL", "JIOINF", "BKMSHW"]
+# Operator prefixes of Indian sender ids, as in "VM-HDFCBK"
+PREFIXES = ["VM", "AD", "JD", "BZ", "VK", "AX"]
+MERCHANTS = [
+    "AMAZON PAY", "FLIPKART", "SWIGGY", "ZOMATO", "UBER INDIA", "OLA CABS", "BIGBASKET", "DMART", "APOLLO PHARMACY",
+    "IRCTC", "MAKEMYTRIP", "BOOKMYSHOW", "NETFLIX", "SPOTIFY", "RELIANCE FRESH", "SHELL PETROL", "CHAI POINT",
+]
+PAYEES = ["RAHUL SHARMA", "PRIYA NAIR", "AMIT KUMAR", "SNEHA REDDY", "ROHAN MEHTA", "ANITA DESAI"]
+
+TEMPLATES = {
+    "card": (
+        "Rs.{amount} spent on {bank} Bank Card XX{card} at {merchant} on {date}. Avl Lmt: Rs.{balance}. "
+        "Not you? Call 18002586161 to block.",
+        r"Rs\.(?P<amount>[\d,]+\.\d{{2}}) spent on {bank} Bank Card XX\d{{4}} at (?P<merchant>.+?) on (?P<date>[\d-]+)\. "
+        r"Avl Lmt: Rs\.(?P<balance>[\d,]+\.\d{{2}})",
+        {"type": "card", "transactiontype": "debit"},
+    ),
+    "upi": (
+        "Sent Rs.{amount} from {bank} Bank A/C *{card} To {merchant} On {date} Ref {ref}. Not You? Call 18002586161",
+        r"Sent Rs\.(?P<amount>[\d,]+\.\d{{2}}) from {bank} Bank A/C \*\d{{4}} To (?P<merchant>.+?) On (?P<date>[\d-]+) Ref",
+        {"type": "upi", "transactiontype": "debit"},
+    ),
+    "credit": (
+        "Rs.{amount} credited to {bank} A/c XX{card} on {date} by {payee}. Avl Bal Rs.{balance}",
+        r"Rs\.(?P<amount>[\d,]+\.\d{{2}}) credited to {bank} A/c XX\d{{4}} on (?P<date>[\d-]+) by (?P<merchant>.+?)\. "
+        r"Avl Bal Rs\.(?P<balance>[\d,]+\.\d{{2}})",
+        {"type": "neft", "transactiontype": "credit"},
+    ),
+    "otp": (
+        "{otp} is the OTP for txn of Rs.{amount} at {merchant} on {bank} Bank card XX{card}. Valid for 10 mins. Do not share.",
+        r"is the OTP for txn of Rs\.(?P<amount>[\d,]+\.\d{{2}}) at .+? on {bank} Bank card",
+        {},
+    ),
+}
+PROMO_TEXTS = [
+    "Flat 50% off on your next order! Use code SAVE50. T&C apply. {url}",
+    "Your data pack expires today. Recharge now with Rs.{amount} and get 2GB extra. {url}",
+    "Hurry! Tickets for the weekend are selling fast. Book now at {url}",
+]
+# Texts no pattern matches, the messages stay unprocessed
+UNMATCHED_TEXTS = [
+    "Dear Customer, your {bank} Bank statement for the month is ready. Download it from the app.",
+    "Your cheque no. {card} has been cleared. Thank you for banking with {bank} Bank.",
+]
+
+
+def formatAmount(value: float) -> str:
+    return f"{value:,.2f}"
+
+def bankSender(rng: random.Random, senderId: str) -> str:
+    return f"{rng.choice(PREFIXES)}-{senderId}"
+
+
+def generatePatterns(count: int, rng: random.Random) -> List[Pattern]:
+    """
+    Patterns for every bank and template of the corpus, then filler patterns
+    for banks that send nothing, some of them applying to every sender, up
+    to count patterns.
+    """
+    patterns = []
+    for senderId, bank in BANKS:
+        for kind, (_, regex, metadata) in TEMPLATES.items():
+            action = PatternAction.reject if kind == "otp" else PatternAction.approve
+            metadata = {**metadata, "account": bank} if metadata else {}
+            patterns.append(Pattern(id=f"{bank.lower()}-{kind}", name=f"{bank} {kind}", pattern=regex.format(bank=bank),
+                                    sender=senderId, metadata=metadata, action=action))
+    patterns = patterns[:count]
+
+    index = 0
+    while len(patterns) < count:
+        kind = rng.choice(["card", "upi", "credit"])
+        bank = f"BANK{index:04d}"
+        # One in ten has no sender and is tried against every message
+        sender = "" if index % 10 == 0 else f"BNK{index:04d}"
+        _, regex, metadata = TEMPLATES[kind]
+        patterns.append(Pattern(id=f"filler-{index}", name=f"{bank} {kind}", pattern=regex.format(bank=bank), sender=sender,
+                                metadata={**metadata, "account": bank}))
+        index += 1
+    return patterns
+
+def generateSenders(count: int) -> List[Sender]:
+    """
+    The bank senders as approved and the promotional ones as rejected, then
+    approved filler senders up to count.
+    """
+    senders = [Sender(name=senderId, status=SenderStatus.approved) for senderId, _ in BANKS]
+    senders += [Sender(name=name, status=SenderStatus.rejected) for name in PROMO_SENDERS]
+    index = 0
+    while len(senders) < count:
+        senders.append(Sender(name=f"BNK{index:04d}", status=SenderStatus.approved))
+        index += 1
+    return senders[:max(count, len(BANKS) + len(PROMO_SENDERS))]
+
+def generateMessages(count: int, rng: random.Random, now: int) -> List[Message]:
+    """
+    A month of messages, newest first: mostly bank transactions, with OTPs,
+    promotions, statements, unknown senders, messages without a sender and
+    repeated bodies mixed in at roughly the rates a real inbox has them.
+    """
+    messages = []
+    bodies = []
+    for index in range(count):
+        timestamp = now - rng.randrange(30 * 24 * 60 * 60)
+        date = datetime.datetime.fromtimestamp(timestamp).strftime("%d-%m-%y")
+        senderId, bank = rng.choice(BANKS)
+        fields = {
+            "amount": formatAmount(rng.choice([rng.uniform(10, 999), rng.uniform(1000, 99999)])),
+            "balance": formatAmount(rng.uniform(1000, 500000)),
+            "bank": bank,
+            "card": f"{rng.randrange(10000):04d}",
+            "merchant": rng.choice(MERCHANTS),
+            "payee": rng.choice(PAYEES),
+            "date": date,
+            "ref": f"{rng.randrange(10 ** 12):012d}",
+            "otp": f"{rng.randrange(10 ** 6):06d}",
+            "url": f"https://t.co/{rng.randrange(16 ** 6):06x}",
+        }
+        roll = rng.random()
+        if roll < 0.03 and bodies:
+            # The same SMS delivered twice
+            sender, sms = rng.choice(bodies)
+        elif roll < 0.60:
+            sender, sms = bankSender(rng, senderId), TEMPLATES[rng.choice(["card", "upi", "upi", "credit"])][0].format(**fields)
+        elif roll < 0.70:
+            sender, sms = bankSender(rng, senderId), TEMPLATES["otp"][0].format(**fields)
+        elif roll < 0.80:
+            sender, sms = bankSender(rng, senderId), rng.choice(UNMATCHED_TEXTS).format(**fields)
+        elif roll < 0.93:
+            sender, sms = bankSender(rng, rng.choice(PROMO_SENDERS)), rng.choice(PROMO_TEXTS).format(**fields)
+        elif roll < 0.98:
+            # A small pool of senders missing from the catalog
+            sender, sms = bankSender(rng, f"NEWS{rng.randrange(20):02d}"), rng.choice(PROMO_TEXTS).format(**fields)
+        else:
+            sender, sms = rng.choice(["", "HDFCBK", "5676791"]), rng.choice(PROMO_TEXTS).format(**fields)
+        bodies.append((sender, sms))
+        messages.append(Message(id=f"m{index:06d}", sender=sender, sms=sms, timestamp=timestamp))
+    return sorted(messages, key=lambda message: message.timestamp, reverse=True)
+
+def generateCorpus(messages: int, patterns: int, senders: int, seed: int = 7, now: int = 0) -> Tuple[List[Message], List[Pattern], List[Sender]]:
+    """
+    Returns (messages, patterns, senders); the same arguments always give
+    the same corpus.
+    """
+    rng = random.Random(seed)
+    now = now or int(datetime.datetime(2025, 6, 30).timestamp())
+    return generateMessages(messages, rng, now), generatePatterns(patterns, rng), generateSenders(senders)
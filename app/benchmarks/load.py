@@ -0,0 +1,308 @@
+"""
+HTTP load test of the API against the in-memory store.
+
+Run from the app directory:
+
+    python -m benchmarks.load                           # server in this process
+    python -m benchmarks.load --external --workers 2    # separate uvicorn process
+    python -m benchmarks.load --concurrency 1,8,32 --duration 20 \\
+        --mix sms=40,transactions=40,categorize=15,processmessages=5
+
+The server is seeded with --users users of generated SMS (see corpus.py),
+parsed into transactions, and authenticates requests by the X-Load-User
+header instead of a Firebase token. Mail enrichment is left off, it needs
+IMAP. Closed-loop clients on keep-alive connections then send the request
+mix for --duration seconds at each concurrency level, and latency
+percentiles, throughput and error rate are reported per route.
+
+The clients are threads of this process, so with the server in the same
+process they compete with it for the GIL; use --external when sizing a
+deployment.
+"""
+import argparse
+import contextlib
+import http.client
+import io
+import json
+import logging
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Tuple
+
+# Before anything creates the store
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+
+# Seeding of the server; main() passes its options on through these, so an
+# --external server process sees them too
+LOAD_USERS = int(os.environ.get("LOAD_USERS", 5))
+LOAD_MESSAGES = int(os.environ.get("LOAD_MESSAGES", 2000))
+LOAD_PATTERNS = int(os.environ.get("LOAD_PATTERNS", 100))
+LOAD_SENDERS = int(os.environ.get("LOAD_SENDERS", 200))
+LOAD_SEED = int(os.environ.get("LOAD_SEED", 7))
+
+USER_HEADER = "X-Load-User"
+DEFAULT_MIX = "sms=30,transactions=45,categorize=15,processmessages=10"
+CATEGORIES = ["food", "travel", "shopping", "health", "home", "entertainment"]
+MONTH_SECONDS = 30 * 24 * 60 * 60
+
+
+def userEmail(index: int) -> str:
+    return f"load{index}@example.com"
+
+def create_app():
+    """
+    Returns main.app over a seeded in-memory store. Also the uvicorn factory
+    of --external runs.
+    """
+    from fastapi import Request
+
+    import main
+    from benchmarks.corpus import generateCorpus
+    from parser import parseMessages
+    from storage import get_storage
+
+    # The request paths log at INFO and WARNING on every call
+    logging.getLogger().setLevel(logging.ERROR)
+    users = int(os.environ.get("LOAD_USERS", LOAD_USERS))
+    messageCount = int(os.environ.get("LOAD_MESSAGES", LOAD_MESSAGES))
+    seed = int(os.environ.get("LOAD_SEED", LOAD_SEED))
+    storage = get_storage()
+    now = int(time.time())
+    for index in range(users):
+        messages, patterns, senders = generateCorpus(messageCount, LOAD_PATTERNS, LOAD_SENDERS, seed + index, now)
+        if index == 0:
+            for pattern in patterns:
+                storage.save_pattern(pattern)
+            storage.save_senders(senders)
+        email = userEmail(index)
+        for message in messages:
+            storage.save_message(email, message.id, message.dict(exclude={"id"}))
+        with contextlib.redirect_stdout(io.StringIO()):
+            parseMessages(email, messages, wait=True)
+    # /status looks for an admin with recent transactions
+    if hasattr(storage, "users"):
+        storage.users[userEmail(0)] = {"role": "admin"}
+
+    def loadTestEmail(request: Request) -> str:
+        return request.headers.get(USER_HEADER) or userEmail(0)
+
+    main.app.dependency_overrides[main.getEmail] = loadTestEmail
+    if main.start_enrichment_queue in main.app.router.on_startup:
+        main.app.router.on_startup.remove(main.start_enrichment_queue)
+    return main.app
+
+
+def freePort() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+def waitForPort(port: int, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with contextlib.suppress(OSError), socket.create_connection(("127.0.0.1", port), timeout=1):
+            return
+        time.sleep(0.2)
+    raise TimeoutError(f"Server did not come up on port {port}")
+
+@contextlib.contextmanager
+def inProcessServer(port: int):
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(create_app(), host="127.0.0.1", port=port, log_level="warning", access_log=False))
+    thread = threading.Thread(target=server.run, name="load-server", daemon=True)
+    thread.start()
+    try:
+        waitForPort(port, 60)
+        yield
+    finally:
+        server.should_exit = True
+        thread.join(10)
+
+@contextlib.contextmanager
+def externalServer(port: int, workers: int):
+    appDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    command = [sys.executable, "-m", "uvicorn", "--factory", "benchmarks.load:create_app", "--host", "127.0.0.1",
+               "--port", str(port), "--workers", str(workers), "--log-level", "warning", "--no-access-log"]
+    process = subprocess.Popen(command, cwd=appDir, env=os.environ.copy())
+    try:
+        waitForPort(port, 300)
+        yield
+    finally:
+        process.terminate()
+        process.wait(30)
+
+
+class LoadClient():
+    """
+    One closed-loop client: sends the next request of the mix as soon as
+    the previous one is answered, on its own keep-alive connection.
+    """
+
+    def __init__(self, port: int, mix: List[Tuple[str, int]], transactionIds: Dict[str, List[str]], seed: int):
+        self.port = port
+        self.users = sorted(transactionIds)
+        self.routes = [route for route, _ in mix]
+        self.weights = [weight for _, weight in mix]
+        self.transactionIds = transactionIds
+        self.rng = random.Random(seed)
+        self.connection = None
+        self.samples: List[Tuple[str, float, bool]] = []
+
+    def request(self, method: str, path: str, email: str, body=None) -> Tuple[int, bytes]:
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+        headers = {USER_HEADER: email}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        try:
+            self.connection.request(method, path, body=payload, headers=headers)
+            response = self.connection.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            raise
+
+    def next(self) -> Tuple[str, str, str, str, Dict]:
+        route = self.rng.choices(self.routes, self.weights)[0]
+        email = self.rng.choice(self.users)
+        if route == "sms":
+            sms = f"Sent Rs.{self.rng.uniform(10, 5000):,.2f} from HDFC Bank A/C *{self.rng.randrange(10000):04d} To LOAD TEST " \
+                  f"On {time.strftime('%d-%m-%y')} Ref {self.rng.randrange(10 ** 12):012d}. Not You? Call 18002586161"
+            return route, "POST", "/sms", email, {"email": email, "sms": sms, "sender": "VM-HDFCBK"}
+        if route == "transactions":
+            to_date = int(time.time()) - self.rng.randrange(MONTH_SECONDS)
+            path = f"/transactions?from_date={to_date - self.rng.choice([7, 30]) * 86400}&to_date={to_date}"
+            if self.rng.random() < 0.5:
+                path += "&limit=100"
+            return route, "GET", path, email, None
+        if route == "categorize":
+            transactionId = self.rng.choice(self.transactionIds[email] or ["missing"])
+            return route, "POST", "/transaction/categorize", email, {"transaction_id": transactionId, "category": self.rng.choice(CATEGORIES)}
+        return route, "POST", "/processmessages", email, None
+
+    def run(self, stop: threading.Event):
+        while not stop.is_set():
+            route, method, path, email, body = self.next()
+            start = time.perf_counter()
+            try:
+                status, _ = self.request(method, path, email, body)
+                ok = status < 400
+            except (OSError, http.client.HTTPException):
+                ok = False
+            self.samples.append((route, time.perf_counter() - start, ok))
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    # Nearest rank over sorted values
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+def summarise(samples: List[Tuple[str, float, bool]], seconds: float) -> Dict[str, Dict]:
+    byRoute: Dict[str, List[Tuple[float, bool]]] = {}
+    for route, latency, ok in samples:
+        byRoute.setdefault(route, []).append((latency, ok))
+        byRoute.setdefault("all", []).append((latency, ok))
+    stats = {}
+    for route, values in sorted(byRoute.items(), key=lambda item: item[0] == "all"):
+        latencies = sorted(latency for latency, _ in values)
+        errors = sum(1 for _, ok in values if not ok)
+        stats[route] = {
+            "requests": len(values),
+            "throughput": len(values) / seconds,
+            "errorRate": errors / len(values),
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+        }
+    return stats
+
+def transactionIdsByUser(port: int, users: int) -> Dict[str, List[str]]:
+    client = LoadClient(port, [], {}, 0)
+    transactionIds = {}
+    try:
+        for index in range(users):
+            email = userEmail(index)
+            _, body = client.request("GET", f"/transactions?from_date={int(time.time()) - 2 * MONTH_SECONDS}&to_date={int(time.time())}", email)
+            transactionIds[email] = [transaction["id"] for transaction in json.loads(body)["transactions"]]
+    finally:
+        client.close()
+    return transactionIds
+
+def runLevel(port: int, concurrency: int, duration: float, mix, transactionIds, seed: int) -> Dict[str, Dict]:
+    clients = [LoadClient(port, mix, transactionIds, seed * 1000 + index) for index in range(concurrency)]
+    stop = threading.Event()
+    threads = [threading.Thread(target=client.run, args=(stop,), name=f"load-client-{index}") for index, client in enumerate(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        client.close()
+    return summarise([sample for client in clients for sample in client.samples], elapsed)
+
+def report(concurrency: int, stats: Dict[str, Dict]):
+    print(f"\nconcurrency {concurrency}")
+    print(f"  {'route':<17}{'requests':>9}{'req/s':>9}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for route, row in stats.items():
+        print(f"  {route:<17}{row['requests']:>9}{row['throughput']:>9.1f}{row['errorRate'] * 100:>7.1f}%"
+              f"{row['p50'] * 1000:>9.1f}{row['p95'] * 1000:>9.1f}{row['p99'] * 1000:>9.1f}")
+
+def parseMix(mix: str) -> List[Tuple[str, int]]:
+    routes = []
+    for part in mix.split(","):
+        route, _, weight = part.partition("=")
+        if route not in ("sms", "transactions", "categorize", "processmessages"):
+            raise argparse.ArgumentTypeError(f"Unknown route in mix: {route}")
+        routes.append((route, int(weight or 1)))
+    return routes
+
+def main(argv=None) -> int:
+    arguments = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arguments.add_argument("--concurrency", default="1,4,16,64", help="comma separated client counts, one run each")
+    arguments.add_argument("--duration", type=float, default=10, help="seconds per concurrency level")
+    arguments.add_argument("--mix", type=parseMix, default=parseMix(DEFAULT_MIX), help=f"route=weight list (default: {DEFAULT_MIX})")
+    arguments.add_argument("--external", action="store_true", help="run the server as a separate uvicorn process")
+    arguments.add_argument("--workers", type=int, default=1, help="uvicorn workers of an --external server")
+    arguments.add_argument("--users", type=int, default=LOAD_USERS)
+    arguments.add_argument("--messages", type=int, default=LOAD_MESSAGES, help="seeded messages per user")
+    arguments.add_argument("--seed", type=int, default=LOAD_SEED)
+    arguments.add_argument("--output", help="also write the results to this JSON file")
+    options = arguments.parse_args(argv)
+
+    os.environ.update(LOAD_USERS=str(options.users), LOAD_MESSAGES=str(options.messages), LOAD_SEED=str(options.seed))
+
+    port = freePort()
+    server = externalServer(port, options.workers) if options.external else inProcessServer(port)
+    results = {}
+    with server:
+        transactionIds = transactionIdsByUser(port, options.users)
+        for concurrency in (int(level) for level in options.concurrency.split(",")):
+            results[concurrency] = runLevel(port, concurrency, options.duration, options.mix, transactionIds, options.seed)
+            report(concurrency, results[concurrency])
+
+    if options.output:
+        with open(options.output, "w") as outputFile:
+            json.dump({"options": {**vars(options), "mix": dict(options.mix)}, "levels": results}, outputFile, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
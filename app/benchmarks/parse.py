@@ -0,0 +1,214 @@
+"""
+Micro-benchmarks of the SMS parsing hot path on a generated corpus, against
+the in-memory store.
+
+Run from the app directory:
+
+    python -m benchmarks.parse                      # small and medium
+    python -m benchmarks.parse --scale large
+    python -m benchmarks.parse --messages 5000 --patterns 300
+    python -m benchmarks.parse --save-baseline      # after an intended change
+
+Every stage runs once untimed to warm the caches, then --repeats timed runs
+of which the median and the best are reported. The store keeps what earlier
+runs wrote, so the numbers are those of re-parsing known messages, as a full
+refresh does. Best times slower than the stored baseline's by more than
+--tolerance are flagged and make the run exit with status 1; the best of a
+few runs is far less noisy than the median on a shared machine. Timings
+only compare on one machine, so the baseline is kept next to this file and
+not checked in.
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List
+
+from storage import set_storage
+from storage_memory import MemoryStorage
+
+import db
+from benchmarks.corpus import generateCorpus
+from models import Message, MessageStatus, Transaction
+from parser import extract_sms_details, isValidSender, parseMessage, parseMessages
+from transactions import add_transactions
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+EMAIL = "bench@example.com"
+# name -> (messages, patterns, senders)
+SCALES = {
+    "small": (1000, 10, 50),
+    "medium": (10000, 100, 200),
+    "large": (100000, 1000, 1000),
+}
+# Differences below this are noise whatever the tolerance says
+MIN_REGRESSION_SECONDS = 0.002
+
+
+def resetStore(patterns, senders):
+    storage = MemoryStorage()
+    for pattern in patterns:
+        storage.save_pattern(pattern)
+    storage.save_senders(senders)
+    set_storage(storage)
+    db.get_patterns.cache_clear()
+    db.get_senders.cache_clear()
+    db.get_merchants.cache_clear()
+    db.get_transaction.cache_clear()
+    db.sms_hashes.users.clear()
+    db.transaction_store.invalidate(EMAIL)
+    return storage
+
+def timeStage(run: Callable, prepare: Callable, repeats: int) -> Dict[str, float]:
+    """
+    Returns the median and best seconds of run(prepare()) over repeats runs,
+    after one untimed run. As in timeit, the garbage collector is off while
+    timing. Output the code under test prints is swallowed.
+    """
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for attempt in range(repeats + 1):
+            argument = prepare()
+            gc.collect()
+            gc.disable()
+            try:
+                start = time.perf_counter()
+                run(argument)
+                elapsed = time.perf_counter() - start
+            finally:
+                gc.enable()
+            if attempt:
+                times.append(elapsed)
+    return {"median": statistics.median(times), "best": min(times)}
+
+def copies(messages: List[Message]) -> List[Message]:
+    return [message.copy() for message in messages]
+
+def runScale(name: str, messageCount: int, patternCount: int, senderCount: int, repeats: int, seed: int) -> Dict:
+    messages, patterns, senders = generateCorpus(messageCount, patternCount, senderCount, seed)
+    storage = resetStore(patterns, senders)
+    for message in messages:
+        storage.save_message(EMAIL, message.id, message.dict(exclude={"id"}))
+
+    # Inputs of the later stages, from one untimed pass
+    with contextlib.redirect_stdout(io.StringIO()):
+        withSender = [message for message in messages if message.sender]
+        candidates = [message for message in withSender if isValidSender(message.sender)]
+        matches = []
+        for message in candidates:
+            success, status, pattern, details = parseMessage(message)
+            if success and status == MessageStatus.matched and details is not None:
+                matches.append((message, pattern, details))
+    transactionFields = [
+        {**details, **pattern.metadata, "timestamp": message.timestamp, "id": message.id}
+        for message, pattern, details in matches
+    ]
+    transactions = [Transaction.from_json(dict(fields)) for fields in transactionFields]
+    matchedIds = {message.id for message, _, _ in matches}
+    statuses = [message.copy(update={"status": MessageStatus.matched if message.id in matchedIds else MessageStatus.rejected}) for message in messages]
+
+    stages = {
+        "sender": timeStage(lambda batch: [isValidSender(message.sender) for message in batch], lambda: withSender, repeats),
+        "dedupe": timeStage(lambda batch: db.claim_sms_hashes(EMAIL, batch), lambda: candidates, repeats),
+        "match": timeStage(lambda batch: [parseMessage(message) for message in batch], lambda: candidates, repeats),
+        "extract": timeStage(lambda batch: [extract_sms_details(pattern.pattern, message.sms) for message, pattern, _ in batch], lambda: matches, repeats),
+        "from_json": timeStage(lambda batch: [Transaction.from_json(fields) for fields in batch], lambda: [dict(fields) for fields in transactionFields], repeats),
+        "status_write": timeStage(lambda batch: db.update_message_status(EMAIL, batch), lambda: statuses, repeats),
+        "transaction_write": timeStage(lambda batch: add_transactions(EMAIL, batch), lambda: [transaction.copy() for transaction in transactions], repeats),
+        "end_to_end": timeStage(lambda batch: parseMessages(EMAIL, batch, wait=True), lambda: copies(messages), repeats),
+    }
+    return {
+        "messages": messageCount,
+        "patterns": patternCount,
+        "senders": senderCount,
+        "matched": len(matches),
+        "throughput": messageCount / stages["end_to_end"]["median"],
+        "stages": stages,
+    }
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get("scales", {}).get(name)
+        if not previous:
+            continue
+        if (previous["messages"], previous["patterns"], previous["senders"]) != (result["messages"], result["patterns"], result["senders"]):
+            continue
+        for stage, timings in result["stages"].items():
+            before = previous["stages"].get(stage, {}).get("best")
+            seconds = timings["best"]
+            if before and seconds > before * (1 + tolerance) and seconds - before > MIN_REGRESSION_SECONDS:
+                regressions.append(f"{name}/{stage}: {before * 1000:.1f} ms -> {seconds * 1000:.1f} ms (+{(seconds / before - 1) * 100:.0f}%)")
+    return regressions
+
+def report(name: str, result: Dict, baseline: Dict):
+    previous = baseline.get("scales", {}).get(name, {}).get("stages", {})
+    print(f"\n{name}: {result['messages']} messages, {result['patterns']} patterns, {result['senders']} senders, "
+          f"{result['matched']} matched, {result['throughput']:,.0f} messages/s")
+    print(f"  {'stage':<18}{'median ms':>12}{'best ms':>10}{'us/message':>12}{'baseline ms':>13}")
+    for stage, timings in result["stages"].items():
+        before = f"{previous[stage]['best'] * 1000:.2f}" if stage in previous else "-"
+        print(f"  {stage:<18}{timings['median'] * 1000:>12.2f}{timings['best'] * 1000:>10.2f}"
+              f"{timings['median'] / result['messages'] * 1e6:>12.2f}{before:>13}")
+
+def main(argv=None) -> int:
+    arguments = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arguments.add_argument("--scale", action="append", choices=sorted(SCALES), help="preset scale, repeatable (default: small and medium)")
+    arguments.add_argument("--messages", type=int, help="custom scale: number of messages")
+    arguments.add_argument("--patterns", type=int, default=100, help="custom scale: number of patterns")
+    arguments.add_argument("--senders", type=int, default=200, help="custom scale: number of senders")
+    arguments.add_argument("--repeats", type=int, default=7)
+    arguments.add_argument("--seed", type=int, default=7)
+    arguments.add_argument("--baseline", default=BASELINE_PATH)
+    arguments.add_argument("--tolerance", type=float, default=0.5, help="flag best times this much slower than the baseline")
+    arguments.add_argument("--save-baseline", action="store_true", help="store this run's results as the baseline")
+    options = arguments.parse_args(argv)
+
+    # The hot path logs per message at INFO
+    logging.getLogger().setLevel(logging.ERROR)
+
+    scales = {}
+    if options.messages:
+        scales[f"custom-{options.messages}-{options.patterns}-{options.senders}"] = (options.messages, options.patterns, options.senders)
+    for name in options.scale or ([] if options.messages else ["small", "medium"]):
+        scales[name] = SCALES[name]
+
+    baseline = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+
+    results = {}
+    for name, (messageCount, patternCount, senderCount) in scales.items():
+        results[name] = runScale(name, messageCount, patternCount, senderCount, options.repeats, options.seed)
+        report(name, results[name], baseline)
+
+    if options.save_baseline:
+        saved = {**baseline, "python": platform.python_version(), "machine": platform.machine()}
+        saved["scales"] = {**baseline.get("scales", {}), **results}
+        with open(options.baseline, "w") as baselineFile:
+            json.dump(saved, baselineFile, indent=2)
+        print(f"\nBaseline saved to {options.baseline}")
+        return 0
+
+    if not baseline:
+        print(f"\nNo baseline at {options.baseline}, store one with --save-baseline")
+        return 0
+    regressions = compare(results, baseline, options.tolerance)
+    if regressions:
+        print("\nRegressions against the baseline:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
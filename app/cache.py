@@ -0,0 +1,169 @@
+import functools
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from metrics import CallbackMetric
+
+DEFAULT_TTL_SECONDS = int(os.environ.get("CACHE_TTL_SECONDS", 300))
+DEFAULT_MAXSIZE = int(os.environ.get("CACHE_MAXSIZE", 1024))
+
+MISSING = object()
+
+caches: Dict[str, "TTLCache"] = {}
+
+
+class TTLCache():
+    """
+    Bounded LRU cache whose entries also expire after ttl seconds. Entries
+    can be tagged with a tenant (the user's email) so one user's entries can
+    be dropped without touching anyone else's.
+    """
+
+    def __init__(self, name: str, maxsize: int = DEFAULT_MAXSIZE, ttl: float = DEFAULT_TTL_SECONDS):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+        self.tenants: Dict[str, set] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        caches[name] = self
+
+    def get(self, key):
+        """
+        Returns the cached value, or MISSING.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            expires, tenant, value = entry
+            if expires <= time.monotonic():
+                self.drop(key)
+                self.expirations += 1
+                self.misses += 1
+                return MISSING
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, tenant: Optional[str] = None):
+        with self.lock:
+            if key in self.entries:
+                self.drop(key)
+            self.entries[key] = (time.monotonic() + self.ttl, tenant, value)
+            if tenant is not None:
+                self.tenants.setdefault(tenant, set()).add(key)
+            while len(self.entries) > self.maxsize:
+                self.drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def drop(self, key):
+        # Caller holds the lock
+        _, tenant, _ = self.entries.pop(key)
+        if tenant is not None:
+            keys = self.tenants.get(tenant)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tenants[tenant]
+
+    def invalidate(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.drop(key)
+
+    def invalidate_tenant(self, tenant: str):
+        with self.lock:
+            for key in list(self.tenants.get(tenant, ())):
+                self.drop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tenants.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+def make_key(args, kwargs):
+    if kwargs:
+        return args + tuple(sorted(kwargs.items()))
+    return args
+
+def cached(cache: TTLCache, per_user: bool = False):
+    """
+    Memoizes a function in the given cache. With per_user=True the first
+    argument is the user's email and entries are tagged with it, so
+    func.invalidate_tenant(email) drops only that user's entries.
+    func.invalidate(*args) drops a single entry and func.cache_clear()
+    drops everything.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = make_key(args, kwargs)
+            value = cache.get(key)
+            if value is MISSING:
+                value = func(*args, **kwargs)
+                tenant = (args[0] if args else kwargs.get("email")) if per_user else None
+                cache.set(key, value, tenant)
+            return value
+
+        wrapper.cache = cache
+        wrapper.invalidate = lambda *args, **kwargs: cache.invalidate(make_key(args, kwargs))
+        wrapper.invalidate_tenant = cache.invalidate_tenant
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator
+
+def cached_async(cache: TTLCache, per_user: bool = False):
+    """
+    cached() for coroutine functions. Given the same cache as the blocking
+    variant of a function both share entries and invalidation.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = make_key(args, kwargs)
+            value = cache.get(key)
+            if value is MISSING:
+                value = await func(*args, **kwargs)
+                tenant = (args[0] if args else kwargs.get("email")) if per_user else None
+                cache.set(key, value, tenant)
+            return value
+
+        wrapper.cache = cache
+        wrapper.invalidate = lambda *args, **kwargs: cache.invalidate(make_key(args, kwargs))
+        wrapper.invalidate_tenant = cache.invalidate_tenant
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator
+
+def cache_stats() -> Dict[str, Dict[str, int]]:
+    return {name: cache.stats() for name, cache in caches.items()}
+
+def stats_metric(name: str, help: str, type: str, field: str) -> CallbackMetric:
+    return CallbackMetric(name, help, type, ["cache"], lambda: {(cache,): stats[field] for cache, stats in cache_stats().items()})
+
+stats_metric("cache_hits_total", "Lookups served from the cache", "counter", "hits")
+stats_metric("cache_misses_total", "Lookups that missed the cache", "counter", "misses")
+stats_metric("cache_evictions_total", "Entries evicted to stay under maxsize", "counter", "evictions")
+stats_metric("cache_expirations_total", "Entries dropped after their TTL", "counter", "expirations")
+stats_metric("cache_entries", "Entries currently cached", "gauge", "size")
@@ -1,50 +1,104 @@
-from typing import List
-from models import Category, CategoryEntry, Message, MessageStatus, Pattern, Sender, Transaction
-from firebase_admin import firestore
-from google.cloud.firestore_v1.base_query import FieldFilter
+from typing import Dict, List
+from models import BatchWriteResult, Category, CategoryEntry, Message, MessageStatus, MonthlySummary, Pattern, Sender, Transaction
 import datetime
-from functools import cache
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import time
 import logging
 import threading
 
+from cache import TTLCache, cached
+from dedupe import HashIndex, sms_digest
+from metrics import Counter, Histogram, timed
+from storage import get_storage
+from summary import build_summary, merge_deltas, month_bounds, month_key, transaction_delta
+from transaction_store import TransactionStore
+from usage import propagate
 from utils import get_start_and_end_of_month, measure_time
 
-db = firestore.client()
+# Tries of a summary rebuild before it is returned without being stored
+SUMMARY_REBUILD_ATTEMPTS = 3
 
-def read_messages(email, days_ago_start=30, admin_mode=False):
+sms_hashes = HashIndex()
+read_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="admin-read")
+transaction_store = TransactionStore()
+
+category_cache = TTLCache("categories")
+pattern_cache = TTLCache("patterns", maxsize=1)
+sender_cache = TTLCache("senders", maxsize=1)
+email_cache = TTLCache("emails", maxsize=1)
+merchant_cache = TTLCache("merchants", maxsize=1)
+user_cache = TTLCache("users")
+admin_cache = TTLCache("admins")
+transaction_cache = TTLCache("transaction", maxsize=10000)
+
+operation_seconds = Histogram("db_operation_seconds", "Duration of db.py operations, cache hits excluded", ["operation"])
+operation_errors = Counter("db_operation_errors_total", "db.py operations that raised", ["operation"])
+
+def operation(func):
+    # Under @cached, so only the calls that miss the cache are timed
+    return timed(operation_seconds, errors=operation_errors)(func)
+
+def _read_user_messages(email, start_timestamp, limit=None):
+    return get_storage().list_messages(email, start_timestamp, limit)
+
+@operation
+def read_messages(email, days_ago_start=30, admin_mode=False, limit=None):
     start_date = datetime.datetime.now() - datetime.timedelta(days=days_ago_start)
     start_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
     start_timestamp = int(start_date.timestamp())
 
-    messages = []
-
-    if admin_mode:
-        # If admin_mode is True, iterate through all emails in the "sms" collection
-        sms_collection = db.collection("sms")
-        all_emails = sms_collection.stream()
-        for email_doc in all_emails:
-            email_id = email_doc.id
-            email_collection = sms_collection.document(email_id).collection("messages")
-            filter_condition = FieldFilter("timestamp", ">=", start_timestamp)
-            query = email_collection.where(filter=filter_condition).order_by("timestamp", direction=firestore.Query.DESCENDING).stream()
-            for doc in query:
-                doc_dict = doc.to_dict()
-                doc_dict["id"] = doc.id
-                messages.append(Message(**doc_dict))
-    else:
-        # If admin_mode is False, only get messages for the specified email
-        sms_collection = db.collection("sms").document(email).collection("messages")
-        filter_condition = FieldFilter("timestamp", ">=", start_timestamp)
-        query = sms_collection.where(filter=filter_condition).order_by("timestamp", direction=firestore.Query.DESCENDING).stream()
+    if not admin_mode:
+        return _read_user_messages(email, start_timestamp, limit)
+
+    # In admin mode, query every user's messages concurrently and merge the
+    # already newest-first results; with a limit no user needs to return
+    # more than limit messages, and the merge stops once it has enough
+    read_user_messages = propagate(_read_user_messages)
+    futures = [read_executor.submit(read_user_messages, user_email, start_timestamp, limit) for user_email in get_emails()]
+    merged = heapq.merge(*(future.result() for future in futures), key=lambda message: message.timestamp, reverse=True)
+    return list(islice(merged, limit))
+
+@operation
+def read_new_messages(email, watermark, days_ago_start=30):
+    """
+    Reads the messages that still need parsing: anything at or after the
+    processing watermark that has not been matched or rejected yet, plus any
+    message inside the window that is explicitly marked unprocessed (for
+    example through /sms/unprocess).
+
+    Returns the messages, newest first, and the newest timestamp seen at or
+    after the watermark, which the caller can store as the next watermark.
+    """
+    start_date = datetime.datetime.now() - datetime.timedelta(days=days_ago_start)
+    start_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    start_timestamp = int(start_date.timestamp())
+
+    storage = get_storage()
+    messages = {}
+    newest = watermark
+
+    for message in storage.list_messages(email, max(watermark, start_timestamp)):
+        newest = max(newest, message.timestamp)
+        if message.status == MessageStatus.unprocessed:
+            messages[message.id] = message
+
+    for message in storage.list_messages_with_status(email, MessageStatus.unprocessed.value, start_timestamp):
+        messages[message.id] = message
 
-        for doc in query:
-            doc_dict = doc.to_dict()
-            doc_dict["id"] = doc.id
-            messages.append(Message(**doc_dict))
+    messages = sorted(messages.values(), key=lambda message: message.timestamp, reverse=True)
+    return messages, newest
 
-    return messages
+@operation
+def get_processing_watermark(email) -> int:
+    return get_storage().get_watermark(email)
 
+@operation
+def set_processing_watermark(email, timestamp: int):
+    get_storage().set_watermark(email, timestamp)
+
+@operation
 def read_sms_from_last_30_days(email):
     if not email:
         raise Exception("Email is required")
@@ -55,17 +109,9 @@ def read_sms_from_last_30_days(email):
 
     start_timestamp = int(start_of_month.timestamp())
 
-    # Query the Firestore collection
-    sms_collection = db.collection("sms").document(email).collection("messages")
-    filter_condition = FieldFilter("timestamp", ">=", start_timestamp)
-    query = sms_collection.where(filter=filter_condition).order_by("timestamp").stream()
-
-    # Collect the results
-    messages = []
-    for doc in query:
-        messages.append(doc.to_dict())
-
-    return messages
+    # Oldest first
+    messages = get_storage().list_messages(email, start_timestamp)
+    return [message.dict(exclude={"id"}) for message in reversed(messages)]
 
 
 DEFAULT_CATEGORIES = [
@@ -81,16 +127,10 @@ DEFAULT_CATEGORIES = [
     CategoryEntry(category=Category.investment, icon="TrendingUp", colorHex="#33ccff", default=True),
     CategoryEntry(category=Category.entertainment, icon="Movie", colorHex="#cc33ff", default=True)
 ]
-@cache
+@cached(category_cache, per_user=True)
+@operation
 def get_categories(email: str):
-    category_collection = db.collection("category").document(email).collection("categories")
-    query = category_collection.order_by("category").stream()
-    categories = []
-
-    for doc in query:
-        doc_dict = doc.to_dict()
-        doc_dict["id"] = doc.id
-        categories.append(CategoryEntry(**doc_dict))
+    categories = get_storage().list_categories(email)
 
     # Instead of extending, if any of the default categories already exist, we will not add them again
     existing_categories = {cat.category: cat for cat in categories}
@@ -100,124 +140,117 @@ def get_categories(email: str):
 
     return categories
 
+@operation
 def upsert_category(categoryEntry: CategoryEntry, email: str):
     if not categoryEntry:
         return False
     if not categoryEntry.category or not categoryEntry.icon or not categoryEntry.colorHex:
         return False
-    category_collection = db.collection("category").document(email).collection("categories")
-    if categoryEntry.id and category_collection.document(categoryEntry.id).get().exists:
-        category_collection.document(categoryEntry.id).set(categoryEntry.dict())
-    else:
-        category_collection.add(categoryEntry.dict())
-    get_categories.cache_clear()
+    get_storage().save_category(email, categoryEntry)
+    get_categories.invalidate_tenant(email)
     return True
 
+@operation
 def delete_category(category: str, email: str):
-    category_collection = db.collection("category").document(email).collection("categories")
-    category_ref = category_collection.document(category)
-
-    if category_ref.get().exists:
-        category_ref.delete()
-        get_categories.cache_clear()
+    if get_storage().delete_category(email, category):
+        get_categories.invalidate_tenant(email)
         return True
     return False
 
+@operation
 def add_sender(sender: Sender):
-    sender_collection = db.collection("sender")
-    if sender_collection.document(sender.name).get().exists:
-        return
-    sender_collection.document(sender.name).set(sender.dict())
-    get_senders.cache_clear()
+    if get_storage().add_sender(sender):
+        get_senders.cache_clear()
 
+@operation
 def update_senders(senders: List[Sender]):
-    sender_collection = db.collection("sender")
-
-    for sender in senders:
-        sender_collection.document(sender.name).set(sender.dict())
+    get_storage().save_senders(senders)
     get_senders.cache_clear()
 
+@operation
 def upsert_pattern(pattern: Pattern, email: str = "") -> bool:
     pattern.createdBy = email
-    pattern_collection = db.collection("pattern")
-    if pattern.id and pattern_collection.document(pattern.id).get().exists:
-        pattern_collection.document(pattern.id).set(pattern.dict())
-    else:
-        pattern_collection.add(pattern.dict())
+    get_storage().save_pattern(pattern)
     get_patterns.cache_clear()
     return True
 
-@cache
+@cached(pattern_cache)
+@operation
 def get_patterns():
-    pattern_collection = db.collection("pattern")
-    query = pattern_collection.order_by("action").stream()
-    patterns = []
-    for doc in query:
-        doc_dict = doc.to_dict()
-        doc_dict["id"] = doc.id
-        patterns.append(Pattern(**doc_dict))
-    return patterns
-
-@cache
+    return get_storage().list_patterns()
+
+@cached(sender_cache)
+@operation
 def get_senders():
-    sender_collection = db.collection("sender")
-    query = sender_collection.stream()
-    senders = []
-    for doc in query:
-        doc_dict = doc.to_dict()
-        doc_dict["id"] = doc.id
-        senders.append(Sender(**doc_dict))
-    return senders
-
-@cache
-def get_emails():
-    sms_collection = db.collection("sms")
-    emails = [doc.id for doc in sms_collection.stream()]
-    return emails
+    return get_storage().list_senders()
 
-def update_message_status(email: str, messages: List[Message]):
+@cached(email_cache)
+@operation
+def get_emails():
+    return get_storage().list_emails()
+
+@operation
+def update_message_status(email: str, messages: List[Message]) -> int:
+    """
+    Writes status and matched pattern for the messages, repeated ids keeping
+    the last status. Returns how many updates landed.
+    """
     if not messages:
-        return
+        return 0
 
-    batch = db.batch()
-
-    for message in messages:
-        sms_doc_ref = db.collection("sms").document(email).collection("messages").document(message.id)
-        batch.update(sms_doc_ref, {"status": message.status.value, "matchedPattern": message.matchedPattern})
-
-    try:
-        batch.commit()
-    except Exception as e:
-        print(f"Error updating message statuses: {e}")
+    updates = [(message.id, message.status.value, message.matchedPattern) for message in messages]
+    result = get_storage().update_message_statuses(email, updates)
+    if result.failed:
+        logging.error(f"Error updating message statuses for email: {email}: {result.failed} of {len(updates)} failed")
+    return result.written
 
+@operation
 def unprocess_message(email: str, message_id: str):
-    sms_doc_ref = db.collection("sms").document(email).collection("messages").document(message_id)
-    sms_doc_ref.set({"status": MessageStatus.unprocessed.value, "matchedPattern": ""}, merge=True)
+    get_storage().set_message_status(email, message_id, MessageStatus.unprocessed.value, "")
     return True
 
-def add_transactions_db(email: str, transactions: List[Transaction]):
-    if not transactions:
-        return False
-
-    batch = db.batch()
+@operation
+def get_transactions_by_id(email, transaction_ids: List[str]) -> Dict[str, Transaction]:
+    if not transaction_ids:
+        return {}
+    return get_storage().get_transactions_by_id(email, transaction_ids)
 
-    for transaction in transactions:
-        transaction_ref = db.collection("transaction").document(email).collection("transaction").document(transaction.id)
-
-        if not transaction_ref.get().exists:
-            batch.set(transaction_ref, transaction.dict(), merge=True)
-
-    try:
-        batch.commit()
-        get_transactions.cache_clear()
+@operation
+def add_transactions_db(email: str, transactions: List[Transaction], check_existing: bool = True) -> BatchWriteResult:
+    if not transactions:
+        return BatchWriteResult()
+
+    if check_existing:
+        existing = get_transactions_by_id(email, [transaction.id for transaction in transactions])
+        transactions = [transaction for transaction in transactions if transaction.id not in existing]
+
+    storage = get_storage()
+    result = storage.save_transactions(email, transactions)
+    _store_saved_transactions(email, transactions, result)
+    delta = merge_deltas([transaction_delta(None, transaction) for transaction in transactions])
+    if result.failed or storage.increment_summaries(email, delta).failed:
+        reset_monthly_summaries(email, delta.keys())
+    if result.written:
         populate_get_transactions_cache_thread(email)
-        return True
-    except Exception as e:
-        print(f"Error updating transactions: {e}")
-        return False
+    return result
+
+def _store_saved_transactions(email, transactions, result: BatchWriteResult):
+    """
+    Brings the transaction store and get_transaction's cache in step with a
+    save of the transactions. Shared with db_async.py.
+    """
+    if result.failed:
+        print(f"Error updating transactions: {result.failed} of {len(transactions)} not written")
+        # Unknown which of the chunks landed, reload this user's data on demand
+        transaction_store.invalidate(email)
+    else:
+        for transaction in transactions:
+            transaction_store.upsert(email, transaction)
+    for transaction in transactions:
+        get_transaction.invalidate(email, transaction.id)
 
 def populate_get_transactions_cache_thread(email):
-    thread = threading.Thread(target=populate_get_transactions_cache, args=(email,))
+    thread = threading.Thread(target=populate_get_transactions_cache, args=(email,), name="populate-transactions")
     thread.start()
 
 def populate_get_transactions_cache(email):
@@ -226,95 +259,224 @@ def populate_get_transactions_cache(email):
     logging.warn(f"Start date: {start_date}, End date: {end_date}")
     _ = get_transactions(email, start_date, end_date)
 
-@cache
-def get_transactions(email, from_date=None, to_date=None):
-    transaction_collection = db.collection("transaction").document(email).collection("transaction")
-    query = transaction_collection.order_by("timestamp", direction=firestore.Query.DESCENDING)
-
-    if from_date is not None and from_date != 0:
-        if len(str(from_date)) == 13:
-            from_date /= 1000 
-        from_date_dt = datetime.datetime.utcfromtimestamp(from_date)
-        query = query.where(filter=FieldFilter("timestamp", ">=", int(from_date_dt.timestamp())))
+def _normalise_timestamp(timestamp):
+    if not timestamp:
+        return None
+    # Timestamps in milliseconds have 13 digits
+    if len(str(int(timestamp))) == 13:
+        timestamp /= 1000
+    return int(timestamp)
 
-    if to_date is not None and to_date != 0:
-        if len(str(to_date)) == 13:
-            to_date /= 1000
-        to_date_dt = datetime.datetime.utcfromtimestamp(to_date)
-        query = query.where(filter=FieldFilter("timestamp", "<=", int(to_date_dt.timestamp())))
+def _query_transactions(email, start=None, end=None):
+    return get_storage().query_transactions(email, start, end)
 
-    query_stream = query.stream()
-
-    transactions = []
-    for doc in query_stream:
-        doc_dict = doc.to_dict()
-        transactions.append(Transaction(**doc_dict))
-
-    return transactions
+@operation
+def get_transactions(email, from_date=None, to_date=None):
+    """
+    Returns the user's transactions with from_date <= timestamp <= to_date,
+    newest first. Served from the in-memory transaction store, only months
+    that have not been loaded yet are read from storage.
+    """
+    from_date = _normalise_timestamp(from_date)
+    to_date = _normalise_timestamp(to_date)
+    _load_transactions(email, from_date, to_date)
+    return transaction_store.range(email, from_date, to_date)
 
-@cache
 def get_transaction_uncached(email, transaction_id):
     transaction = get_transaction(email, transaction_id)
     if transaction:
         return transaction
-    get_transaction.cache_clear()
+    get_transaction.invalidate(email, transaction_id)
     return get_transaction(email, transaction_id)
 
-@cache
+def _load_transactions(email, from_date, to_date):
+    for start, end in transaction_store.missing(email, from_date, to_date):
+        queriedAt = time.monotonic()
+        transaction_store.fill(email, start, end, _query_transactions(email, start, end), queriedAt)
+
+@operation
+def get_transactions_page(email, from_date=None, to_date=None, limit=100, after=None) -> List[Transaction]:
+    """
+    Returns up to limit transactions of the window, newest first, starting
+    after the (timestamp, id) key of the last transaction of the previous
+    page. Windows the transaction store already holds are paged in memory;
+    others are paged in storage, reading only the page rather than loading
+    the whole window.
+    """
+    from_date = _normalise_timestamp(from_date)
+    to_date = _normalise_timestamp(to_date)
+    if not transaction_store.missing(email, from_date, to_date):
+        return transaction_store.page(email, from_date, to_date, limit, after)
+    return get_storage().query_transactions_page(email, from_date, to_date, limit, after)
+
+@operation
+def stream_transactions(email, from_date=None, to_date=None):
+    """
+    Yields the window's transactions, newest first, straight from the
+    storage stream without holding the result in memory.
+    """
+    from_date = _normalise_timestamp(from_date)
+    to_date = _normalise_timestamp(to_date)
+    yield from get_storage().stream_transactions(email, from_date, to_date)
+
+@cached(transaction_cache, per_user=True)
+@operation
 def get_transaction(email, transaction_id):
-    transaction_ref = db.collection("transaction").document(email).collection("transaction").document(transaction_id)
-    transaction = transaction_ref.get()
-    if transaction.exists:
-        return Transaction(**transaction.to_dict())
-    return None
+    return get_storage().get_transaction(email, transaction_id)
 
 @measure_time
-def update_transaction(email, transaction_id, transaction):
-    transaction_ref = db.collection("transaction").document(email).collection("transaction").document(transaction_id)
-    transaction_ref.set(transaction.dict(), merge=True)
-    get_transaction.cache_clear()
-    get_transactions.cache_clear()
-    populate_get_transactions_cache_thread(email)
-
-@cache
+@operation
+def update_transaction(email, transaction_id, transaction, fields=None, only_if=None) -> bool:
+    """
+    Saves the transaction, or only its fields when given, unless only_if is
+    given and does not hold for the stored transaction, checked in the same
+    atomic update. Returns whether it was saved.
+    """
+    # The summary delta is taken against what the update actually overwrites
+    try:
+        merged = get_storage().update_transaction(email, transaction_id, transaction, transaction_delta, fields, only_if)
+    except Exception:
+        # A commit that failed may still have landed along with its summary
+        # increments, the month is rebuilt rather than guessed
+        reset_monthly_summaries(email, [month_key(transaction.timestamp)])
+        raise
+    if merged is None:
+        return False
+    get_transaction.invalidate(email, transaction_id)
+    transaction_store.upsert(email, merged)
+    return True
+
+@operation
+def reset_monthly_summaries(email, months):
+    get_storage().delete_summaries(email, list(months))
+
+@operation
+def get_monthly_summary(email, month, rebuild=False) -> MonthlySummary:
+    """
+    Returns the spend summary for a "YYYY-MM" month. Summaries are kept up to
+    date with increments as transactions change; a month that was never
+    built (or was reset after a failed write) is built from the month's
+    transactions first.
+
+    Every increment bumps the summary's generation. A rebuild stores its
+    result only if the generation it started from is unchanged, and builds
+    again otherwise, so increments made while it read the transactions are
+    not overwritten.
+    """
+    storage = get_storage()
+    start, end = month_bounds(month)
+    for attempt in range(SUMMARY_REBUILD_ATTEMPTS):
+        data = storage.get_summary(email, month) or {}
+        if not rebuild and data.get("built"):
+            return _stored_summary(month, data)
+
+        generation = data.get("generation", 0)
+        # Read from storage rather than the transaction store, which may lag
+        # behind writes made by other processes
+        summary = build_summary(month, _query_transactions(email, start, end + 1))
+        if storage.set_summary(email, month, {**summary.dict(), "built": True, "generation": generation}, generation):
+            return summary
+    logging.warning(f"Summary for {month} of email: {email} kept changing while being rebuilt, returning it unsaved")
+    return summary
+
+def _stored_summary(month, data) -> MonthlySummary:
+    return MonthlySummary(month=month, **{key: data[key] for key in ("totals", "categories", "ignored") if key in data})
+
+@cached(merchant_cache)
+@operation
 def get_merchants():
-    merchant_collection = db.collection("merchant")
-    query = merchant_collection.stream()
-    merchants = {}
-    for doc in query:
-        doc_dict = doc.to_dict()
-        merchants[doc.id] = doc_dict
-    return merchants
-
-@cache
+    return get_storage().list_merchants()
+
+@cached(user_cache, per_user=True)
+@operation
 def get_user_details(email):
-    user_ref = db.collection("users").document(email)
-    user = user_ref.get()
-    if user.exists:
-        return user.to_dict()
-    return None
+    return get_storage().get_user(email)
 
-@cache
+@cached(admin_cache, per_user=True)
+@operation
 def is_admin(email):
     user = get_user_details(email)
     if user and user.get("role") == "admin":
         return True
     return False
 
+@operation
 def delete_pattern(email: str, pattern_id: str) -> bool:
     if not is_admin(email):
         return False
 
-    pattern_collection = db.collection("pattern").document(email).collection("patterns")
-    pattern_ref = pattern_collection.document(pattern_id)
-    
-    if pattern_ref.get().exists:
-        pattern_ref.delete()
-        get_patterns.cache_clear(email)
+    if get_storage().delete_pattern(pattern_id):
+        get_patterns.cache_clear()
         return True
     return False
 
-def save_sms(email: str, sms: str, sender: str, id: str = ""):
+@operation
+def claim_sms_hash(email: str, sms: str, message_id: str, timestamp: int) -> bool:
+    """
+    Records the SMS body as seen under message_id. Returns False when another
+    message with the same body was already claimed inside the dedupe window.
+    """
+    storage = get_storage()
+    digest = sms_digest(sms)
+    entry = sms_hashes.get(email, digest)
+    if entry is None:
+        if storage.create_sms_hash(email, digest, {"messageId": message_id, "timestamp": timestamp}):
+            sms_hashes.put(email, digest, message_id, timestamp)
+            return True
+        data = storage.get_sms_hashes(email, [digest]).get(digest, {})
+        entry = (data.get("messageId", ""), data.get("timestamp", 0))
+        sms_hashes.put(email, digest, *entry)
+
+    if sms_hashes.isDuplicate(entry, message_id, timestamp):
+        return False
+    if entry[0] != message_id:
+        storage.set_sms_hashes(email, {digest: {"messageId": message_id, "timestamp": timestamp}})
+        sms_hashes.put(email, digest, message_id, timestamp)
+    return True
+
+@operation
+def release_sms_hash(email: str, sms: str, message_id: str):
+    digest = sms_digest(sms)
+    entry = sms_hashes.get(email, digest)
+    if entry and entry[0] == message_id:
+        sms_hashes.remove(email, digest)
+        get_storage().delete_sms_hash(email, digest)
+
+@operation
+def claim_sms_hashes(email: str, messages: List[Message]):
+    """
+    Bulk version of claim_sms_hash for a parse run. Digests missing from the
+    in-memory index are loaded with one multi-get, new claims are written in
+    a single batch, and earlier messages in the list win over later ones.
+
+    Returns the ids of the messages that are duplicates.
+    """
+    digests = [sms_digest(message.sms) for message in messages]
+    missing = {digest for digest in digests if sms_hashes.get(email, digest) is None}
+    storage = get_storage()
+    if missing:
+        for digest, data in storage.get_sms_hashes(email, list(missing)).items():
+            sms_hashes.put(email, digest, data.get("messageId", ""), data.get("timestamp", 0))
+
+    duplicates = set()
+    claims = {}
+    for message, digest in zip(messages, digests):
+        entry = sms_hashes.get(email, digest)
+        if sms_hashes.isDuplicate(entry, message.id, message.timestamp):
+            duplicates.add(message.id)
+            continue
+        if entry is None or entry[0] != message.id:
+            sms_hashes.put(email, digest, message.id, message.timestamp)
+            claims[digest] = {"messageId": message.id, "timestamp": message.timestamp}
+
+    result = storage.set_sms_hashes(email, claims)
+    if result.failed:
+        logging.error(f"Error saving {result.failed} SMS hashes for email: {email}")
+
+    return duplicates
+
+@operation
+def save_sms(email: str, sms: str, sender: str, id: str = "") -> bool:
     timestamp = int(time.time())
     entry = {
         "sms": sms,
@@ -322,26 +484,72 @@ def save_sms(email: str, sms: str, sender: str, id: str = ""):
         "timestamp": timestamp
     }
 
+    storage = get_storage()
+    message_id = id or storage.new_message_id(email)
+    if not claim_sms_hash(email, sms, message_id, timestamp):
+        logging.info(f"Dropping duplicate SMS for email: {email}")
+        return False
+
     try:
-        sms_collection = db.collection("sms").document(email).collection("messages")
-        if id:
-            sms_doc = sms_collection.document(id)
-            if sms_doc.get().exists:
-                sms_doc.set(entry, merge=True)
-            else:
-                sms_doc.set(entry)
-        else:
-            sms_doc = sms_collection.document()
-            sms_doc.set(entry)
+        storage.save_message(email, message_id, entry)
         logging.info(f"SMS saved successfully for email: {email}")
+        return True
     except Exception as e:
         logging.error(f"Error saving SMS for email: {email}: {e}")
+        release_sms_hash(email, sms, message_id)
+        return False
 
 @measure_time
+@operation
 def add_merchant(merchant: str, category: Category):
     try:
-        merchant_collection = db.collection("merchant")
-        merchant_collection.document(merchant).set({"category": category.value}, merge=True)
+        get_storage().save_merchant(merchant, category.value)
         get_merchants.cache_clear()
     except Exception as e:
         logging.error(f"Error adding merchant: {merchant}: {e}")
+
+@operation
+def enqueue_enrichments(email: str, transaction_ids: List[str]) -> int:
+    """
+    Queues the transactions for enrichment. Transactions already in the
+    queue, including ones that ran out of attempts, are left as they are.
+    Returns how many were queued.
+    """
+    if not transaction_ids:
+        return 0
+    transaction_ids = list(dict.fromkeys(transaction_ids))
+    try:
+        return get_storage().queue_enrichments(email, transaction_ids, time.time())
+    except Exception as e:
+        logging.error(f"Error queueing enrichment for email: {email}: {e}")
+        return 0
+
+@operation
+def get_pending_enrichments(limit: int, now: float) -> List[Dict]:
+    """
+    Returns up to limit queue items that can be claimed at now: expired
+    claims first, then pending items in the order they became due.
+    """
+    return get_storage().pending_enrichments(limit, now)
+
+@operation
+def claim_enrichment(item_id: str, owner: str, now: float, seconds: float) -> bool:
+    """
+    Marks a due queue item as running for owner until now + seconds. Fails
+    when the item is done, not due yet or held by a live claim.
+    """
+    return get_storage().claim_enrichment(item_id, owner, now, seconds)
+
+@operation
+def complete_enrichment(item_id: str):
+    get_storage().complete_enrichment(item_id)
+
+@operation
+def retry_enrichment(item_id: str, attempts: int, next_attempt: float, error: str, give_up: bool = False):
+    get_storage().retry_enrichment(item_id, {
+        "status": "failed" if give_up else "pending",
+        "attempts": attempts,
+        "nextAttempt": next_attempt,
+        "error": error,
+        "owner": "",
+    })
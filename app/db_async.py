@@ -0,0 +1,179 @@
+import asyncio
+import datetime
+import heapq
+import logging
+import time
+from itertools import islice
+from typing import Dict, List
+
+from cache import cached_async
+from db import (DEFAULT_CATEGORIES, SUMMARY_REBUILD_ATTEMPTS, _normalise_timestamp, _store_saved_transactions, _stored_summary, admin_cache,
+                category_cache, email_cache, merchant_cache, operation, pattern_cache, sender_cache, transaction_cache, transaction_store,
+                user_cache)
+from models import BatchWriteResult, MonthlySummary, Transaction
+from storage import get_storage
+from summary import build_summary, merge_deltas, month_bounds, transaction_delta
+from utils import get_start_and_end_of_month
+
+# Async counterparts of the reads and writes in db.py that the request
+# handlers make, awaiting the *_async methods of the storage. They share
+# db.py's caches and transaction store, so a write made through either
+# module is seen by both.
+
+# Bounds the per-user queries of an admin-mode read in flight at once
+ADMIN_READ_CONCURRENCY = 8
+
+# Background loads started after writes, kept so they are not collected early
+background = set()
+
+
+@operation
+async def read_messages(email, days_ago_start=30, admin_mode=False, limit=None):
+    start_date = datetime.datetime.now() - datetime.timedelta(days=days_ago_start)
+    start_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    start_timestamp = int(start_date.timestamp())
+
+    storage = get_storage()
+    if not admin_mode:
+        return await storage.list_messages_async(email, start_timestamp, limit)
+
+    concurrency = asyncio.Semaphore(ADMIN_READ_CONCURRENCY)
+
+    async def read_user(user_email):
+        async with concurrency:
+            return await storage.list_messages_async(user_email, start_timestamp, limit)
+
+    results = await asyncio.gather(*(read_user(user_email) for user_email in await get_emails()))
+    merged = heapq.merge(*results, key=lambda message: message.timestamp, reverse=True)
+    return list(islice(merged, limit))
+
+@cached_async(category_cache, per_user=True)
+@operation
+async def get_categories(email: str):
+    categories = await get_storage().list_categories_async(email)
+
+    existing_categories = {cat.category: cat for cat in categories}
+    for default_category in DEFAULT_CATEGORIES:
+        if default_category.category not in existing_categories:
+            categories.append(default_category)
+
+    return categories
+
+@cached_async(pattern_cache)
+@operation
+async def get_patterns():
+    return await get_storage().list_patterns_async()
+
+@cached_async(sender_cache)
+@operation
+async def get_senders():
+    return await get_storage().list_senders_async()
+
+@cached_async(email_cache)
+@operation
+async def get_emails():
+    return await get_storage().list_emails_async()
+
+@cached_async(merchant_cache)
+@operation
+async def get_merchants():
+    return await get_storage().list_merchants_async()
+
+@cached_async(user_cache, per_user=True)
+@operation
+async def get_user_details(email):
+    return await get_storage().get_user_async(email)
+
+@cached_async(admin_cache, per_user=True)
+@operation
+async def is_admin(email):
+    user = await get_user_details(email)
+    if user and user.get("role") == "admin":
+        return True
+    return False
+
+@operation
+async def reset_monthly_summaries(email, months):
+    await get_storage().delete_summaries_async(email, list(months))
+
+@operation
+async def get_monthly_summary(email, month, rebuild=False) -> MonthlySummary:
+    """
+    db.get_monthly_summary, rebuilding on the async client.
+    """
+    storage = get_storage()
+    start, end = month_bounds(month)
+    for attempt in range(SUMMARY_REBUILD_ATTEMPTS):
+        data = await storage.get_summary_async(email, month) or {}
+        if not rebuild and data.get("built"):
+            return _stored_summary(month, data)
+
+        generation = data.get("generation", 0)
+        summary = build_summary(month, await storage.query_transactions_async(email, start, end + 1))
+        if await storage.set_summary_async(email, month, {**summary.dict(), "built": True, "generation": generation}, generation):
+            return summary
+    logging.warning(f"Summary for {month} of email: {email} kept changing while being rebuilt, returning it unsaved")
+    return summary
+
+@operation
+async def get_transactions_by_id(email, transaction_ids: List[str]) -> Dict[str, Transaction]:
+    if not transaction_ids:
+        return {}
+    return await get_storage().get_transactions_by_id_async(email, transaction_ids)
+
+@operation
+async def add_transactions_db(email: str, transactions: List[Transaction], check_existing: bool = True) -> BatchWriteResult:
+    if not transactions:
+        return BatchWriteResult()
+
+    if check_existing:
+        existing = await get_transactions_by_id(email, [transaction.id for transaction in transactions])
+        transactions = [transaction for transaction in transactions if transaction.id not in existing]
+
+    storage = get_storage()
+    result = await storage.save_transactions_async(email, transactions)
+    _store_saved_transactions(email, transactions, result)
+    delta = merge_deltas([transaction_delta(None, transaction) for transaction in transactions])
+    if result.failed or (await storage.increment_summaries_async(email, delta)).failed:
+        await reset_monthly_summaries(email, delta.keys())
+    if result.written:
+        start_date, end_date = get_start_and_end_of_month()
+        task = asyncio.ensure_future(get_transactions(email, start_date, end_date))
+        background.add(task)
+        task.add_done_callback(background.discard)
+    return result
+
+async def _load_transactions(email, from_date, to_date):
+    storage = get_storage()
+    ranges = transaction_store.missing(email, from_date, to_date)
+    queriedAt = time.monotonic()
+    loaded = await asyncio.gather(*(storage.query_transactions_async(email, start, end) for start, end in ranges))
+    for (start, end), transactions in zip(ranges, loaded):
+        transaction_store.fill(email, start, end, transactions, queriedAt)
+
+@operation
+async def get_transactions(email, from_date=None, to_date=None):
+    from_date = _normalise_timestamp(from_date)
+    to_date = _normalise_timestamp(to_date)
+    await _load_transactions(email, from_date, to_date)
+    return transaction_store.range(email, from_date, to_date)
+
+@operation
+async def get_transactions_page(email, from_date=None, to_date=None, limit=100, after=None) -> List[Transaction]:
+    from_date = _normalise_timestamp(from_date)
+    to_date = _normalise_timestamp(to_date)
+    if not transaction_store.missing(email, from_date, to_date):
+        return transaction_store.page(email, from_date, to_date, limit, after)
+    return await get_storage().query_transactions_page_async(email, from_date, to_date, limit, after)
+
+@operation
+async def stream_transactions(email, from_date=None, to_date=None):
+    from_date = _normalise_timestamp(from_date)
+    to_date = _normalise_timestamp(to_date)
+    async for transaction in get_storage().stream_transactions_async(email, from_date, to_date):
+        yield transaction
+
+@cached_async(transaction_cache, per_user=True)
+@operation
+async def get_transaction(email, transaction_id):
+    return await get_storage().get_transaction_async(email, transaction_id)
@@ -0,0 +1,55 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+# Two identical SMS bodies this close together are treated as one message
+DEDUPE_WINDOW_SECONDS = int(os.environ.get("DEDUPE_WINDOW_SECONDS", 30 * 24 * 60 * 60))
+MAX_HASHES_PER_USER = 20000
+
+
+def sms_digest(sms: str) -> str:
+    return hashlib.md5(sms.encode()).hexdigest()
+
+
+class HashIndex():
+    """
+    In-memory front of the persistent SMS hash index. Holds, per user, the
+    message id and timestamp that first claimed each SMS digest, bounded to
+    the most recently used entries. The backing store lives in db.py.
+    """
+
+    def __init__(self, window: int = DEDUPE_WINDOW_SECONDS, maxEntries: int = MAX_HASHES_PER_USER):
+        self.window = window
+        self.maxEntries = maxEntries
+        self.users: Dict[str, OrderedDict] = {}
+        self.lock = threading.Lock()
+
+    def get(self, email: str, digest: str) -> Optional[Tuple[str, int]]:
+        with self.lock:
+            entries = self.users.get(email)
+            if entries is None or digest not in entries:
+                return None
+            entries.move_to_end(digest)
+            return entries[digest]
+
+    def put(self, email: str, digest: str, messageId: str, timestamp: int):
+        with self.lock:
+            entries = self.users.setdefault(email, OrderedDict())
+            entries[digest] = (messageId, timestamp)
+            entries.move_to_end(digest)
+            if len(entries) > self.maxEntries:
+                entries.popitem(last=False)
+
+    def remove(self, email: str, digest: str):
+        with self.lock:
+            entries = self.users.get(email)
+            if entries is not None:
+                entries.pop(digest, None)
+
+    def isDuplicate(self, entry: Optional[Tuple[str, int]], messageId: str, timestamp: int) -> bool:
+        if entry is None:
+            return False
+        claimedId, claimedTimestamp = entry
+        return claimedId != messageId and abs(timestamp - claimedTimestamp) <= self.window
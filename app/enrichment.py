@@ -0,0 +1,126 @@
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Set
+
+from db import claim_enrichment, complete_enrichment, get_pending_enrichments, get_transactions_by_id, retry_enrichment, update_transaction
+from models import Transaction
+from sharding import node_id
+
+ENRICHMENT_WORKERS = int(os.environ.get("ENRICHMENT_WORKERS", 2))
+ENRICHMENT_RETRIES = int(os.environ.get("ENRICHMENT_RETRIES", 5))
+ENRICHMENT_BACKOFF_SECONDS = float(os.environ.get("ENRICHMENT_BACKOFF_SECONDS", 30))
+ENRICHMENT_POLL_SECONDS = float(os.environ.get("ENRICHMENT_POLL_SECONDS", 15))
+# A claim not finished by then (the node died) is picked up again
+ENRICHMENT_LEASE_SECONDS = float(os.environ.get("ENRICHMENT_LEASE_SECONDS", 300))
+ENRICHMENT_BATCH = 100
+
+
+class EnrichmentQueue():
+    """
+    Works off the "enrichment" collection, one document per queued
+    transaction. Due items are claimed, grouped by user and handed to
+    enrich in batches, at most workers users at a time; transactions that
+    enrich changed are saved with update_transaction. A failing batch is
+    retried with exponential backoff, and gives up after retries attempts.
+
+    enrich(transactions) changes the transactions in place and raises when
+    the batch should be retried. Only the given fields of a changed
+    transaction are saved, and only if pending(stored) still holds for the
+    stored transaction, so a change made while enrich ran (categorized by
+    hand) is neither overwritten nor enriched over.
+    """
+
+    def __init__(self, enrich: Callable[[List[Transaction]], None], fields: Set[str], pending: Callable[[Transaction], bool],
+                 workers: int = ENRICHMENT_WORKERS, retries: int = ENRICHMENT_RETRIES, backoff: float = ENRICHMENT_BACKOFF_SECONDS,
+                 pollSeconds: float = ENRICHMENT_POLL_SECONDS, leaseSeconds: float = ENRICHMENT_LEASE_SECONDS):
+        self.enrich = enrich
+        self.fields = fields
+        self.pending = pending
+        self.retries = retries
+        self.backoff = backoff
+        self.pollSeconds = pollSeconds
+        self.leaseSeconds = leaseSeconds
+        self.owner = node_id()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="enrichment")
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.loop, name="enrichment-queue", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+    def notify(self):
+        """
+        Wakes the queue up after new items were added, instead of waiting
+        for the next poll.
+        """
+        self.wakeup.set()
+
+    def loop(self):
+        while not self.stopped.is_set():
+            try:
+                self.runOnce()
+            except Exception:
+                logging.exception("Error running the enrichment queue")
+            self.wakeup.wait(self.pollSeconds)
+            self.wakeup.clear()
+
+    def runOnce(self) -> int:
+        """
+        Claims and processes the due items. Returns how many were claimed.
+        """
+        now = time.time()
+        byEmail: Dict[str, List[Dict]] = {}
+        for item in get_pending_enrichments(ENRICHMENT_BATCH, now):
+            if claim_enrichment(item["id"], self.owner, now, self.leaseSeconds):
+                byEmail.setdefault(item["email"], []).append(item)
+        futures = [self.executor.submit(self.process, email, items) for email, items in byEmail.items()]
+        for future in futures:
+            future.result()
+        return sum(len(items) for items in byEmail.values())
+
+    def process(self, email: str, items: List[Dict]):
+        try:
+            transactions = get_transactions_by_id(email, [item["transactionId"] for item in items])
+            before = {transaction_id: transaction.dict() for transaction_id, transaction in transactions.items()}
+            self.enrich(list(transactions.values()))
+        except Exception as e:
+            logging.exception(f"Error enriching {len(items)} transactions for email: {email}")
+            for item in items:
+                self.retry(item, str(e))
+            return
+
+        for item in items:
+            transaction = transactions.get(item["transactionId"])
+            try:
+                if transaction is not None and transaction.dict() != before[transaction.id]:
+                    update_transaction(email, transaction.id, transaction, fields=self.fields, only_if=self.stillPending)
+                complete_enrichment(item["id"])
+            except Exception as e:
+                logging.exception(f"Error saving enriched transaction {item['transactionId']} for email: {email}")
+                self.retry(item, str(e))
+
+    def stillPending(self, stored: Optional[Transaction]) -> bool:
+        return stored is not None and self.pending(stored)
+
+    def retry(self, item: Dict, error: str):
+        attempts = item.get("attempts", 0) + 1
+        giveUp = attempts >= self.retries
+        delay = self.backoff * (2 ** (attempts - 1)) * (1 + random.random())
+        if giveUp:
+            logging.error(f"Giving up on enriching {item['id']} after {attempts} attempts: {error}")
+        try:
+            retry_enrichment(item["id"], attempts, time.time() + delay, error, giveUp)
+        except Exception:
+            # The claim expires and the item is retried anyway
+            logging.exception(f"Error rescheduling enrichment {item['id']}")
@@ -0,0 +1,97 @@
+import re
+from html import unescape
+
+# Text inside these never shows up in BeautifulSoup's get_text()
+SKIP_TAGS = {"script", "style", "template"}
+# Raw text elements, their content is not markup
+RAW_TAGS = {"script", "style"}
+PRESERVE_WHITESPACE_TAGS = {"pre", "textarea"}
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr"}
+ASCII_SPACES = " \n\t\f\r"
+
+TOKEN_PATTERN = re.compile(
+    r"<!--.*?(?:-->|\Z)"
+    r"|<![^>]*>"
+    r"|<\?[^>]*>"
+    r"|<(/?)([a-zA-Z][^\s/>]*)(?:[^>\"']|\"[^\"]*\"|'[^']*')*>",
+    re.DOTALL,
+)
+RAW_END_PATTERNS = {tag: re.compile(rf"</{tag}\s*>", re.IGNORECASE) for tag in RAW_TAGS}
+
+
+def extract_text(html: str) -> str:
+    """
+    Flattens an HTML document to text the way
+    BeautifulSoup(html, features="lxml").get_text() does, in one scan over
+    the markup and without building a tree. Comments, declarations and
+    script/style/template content are left out, and a whitespace-only run
+    between two tags becomes a single "\\n" (or " " without a newline)
+    outside pre and textarea.
+    """
+    parts = []
+    pending = []
+    stack = []
+    skipDepth = 0
+    preserveDepth = 0
+    started = False
+    position = 0
+    length = len(html)
+
+    def flush():
+        nonlocal started
+        text = "".join(pending)
+        pending.clear()
+        if not text or skipDepth:
+            return
+        if not preserveDepth and not text.strip(ASCII_SPACES):
+            # lxml drops whitespace ahead of the document's first content
+            if not started:
+                return
+            text = "\n" if "\n" in text else " "
+        started = True
+        parts.append(unescape(text))
+
+    while position < length:
+        match = TOKEN_PATTERN.search(html, position)
+        if match is None:
+            pending.append(html[position:])
+            break
+        pending.append(html[position:match.start()])
+        position = match.end()
+        closing, tag = match.group(1), match.group(2)
+        tag = tag.lower() if tag else None
+        if closing and tag not in stack:
+            # A stray end tag is dropped, the text around it stays one string
+            continue
+        flush()
+        if tag is None:
+            # Comment, doctype, CDATA or processing instruction
+            continue
+
+        if closing:
+            # Close whatever was left open inside it too
+            while stack:
+                closed = stack.pop()
+                if closed in SKIP_TAGS:
+                    skipDepth -= 1
+                if closed in PRESERVE_WHITESPACE_TAGS:
+                    preserveDepth -= 1
+                if closed == tag:
+                    break
+            continue
+
+        started = True
+        if tag in RAW_TAGS:
+            end = RAW_END_PATTERNS[tag].search(html, position)
+            position = end.end() if end else length
+            continue
+        if tag in VOID_TAGS:
+            continue
+        stack.append(tag)
+        if tag in SKIP_TAGS:
+            skipDepth += 1
+        if tag in PRESERVE_WHITESPACE_TAGS:
+            preserveDepth += 1
+
+    flush()
+    return "".join(parts)
@@ -1,14 +1,52 @@
+import bisect
+import functools
 import imaplib
 import datetime
 import email
+import queue
+import threading
+from contextlib import contextmanager
 from email.header import decode_header
 import re
 import os
+import time
 import webbrowser
 from utils import getSecret, Config
 import dateutil.parser
 import logging
 from bs4 import BeautifulSoup
+from html_text import extract_text
+from mail_cache import MailCache
+from metrics import Counter, Histogram
+
+MAIL_POOL_SIZE = int(os.environ.get("MAIL_POOL_SIZE", 4))
+# Dropped or timed out connections surface as these; the session is replaced
+CONNECTION_ERRORS = (imaplib.IMAP4.abort, OSError)
+# "soup" flattens mails with BeautifulSoup, "fast" with html_text's single
+# pass extractor, "verify" runs both, logs any difference and keeps soup's
+TEXT_EXTRACTOR = os.environ.get("MAIL_TEXT_EXTRACTOR", "soup")
+FETCH_ID_PATTERN = re.compile(rb"^(\d+)\s")
+UID_PATTERN = re.compile(rb"UID (\d+)")
+
+imapSeconds = Histogram("imap_command_seconds", "Duration of IMAP commands, connecting included", ["command"])
+imapErrors = Counter("imap_command_errors_total", "IMAP commands that raised", ["command"])
+mailCacheLookups = Counter("mail_cache_lookups_total", "Mails served from the mail cache or fetched", ["result"])
+
+# Patterns handed over as strings are compiled once
+compilePattern = functools.lru_cache(maxsize=128)(re.compile)
+
+def htmlToText(htmlContent):
+    if not htmlContent:
+        return ""
+    if TEXT_EXTRACTOR == "fast":
+        return extract_text(htmlContent)
+    text = BeautifulSoup(htmlContent, features="lxml").get_text()
+    if TEXT_EXTRACTOR == "verify":
+        fastText = extract_text(htmlContent)
+        if fastText != text:
+            offset = next((index for index, (a, b) in enumerate(zip(text, fastText)) if a != b), min(len(text), len(fastText)))
+            logging.warning(f"Fast text extraction differs at offset {offset}: {text[offset:offset + 40]!r} != {fastText[offset:offset + 40]!r}")
+    return text
 
 class Email():
     def __init__(self):
@@ -18,6 +56,8 @@ class Email():
         self.subject = None
         self.date = None
         self.htmlContent = None
+        self.messageIdHeader = None
+        self.text = None
 
     def __str__(self):
         return '''From: {senderName} {senderEmail}
@@ -33,7 +73,7 @@ Date: {date}
 
     def parseSubject(self, pattern):
         if type(pattern) == str:
-            pattern = re.compile(pattern)
+            pattern = compilePattern(pattern)
         if not pattern:
             return {}
         match = pattern.search(self.subject)
@@ -41,57 +81,244 @@ Date: {date}
             return self.fixDict(match.groupdict())
         return {}
 
+    def getText(self):
+        if self.text is None:
+            self.text = htmlToText(self.htmlContent)
+        return self.text
+
     def parseHtmlContent(self, pattern):
         if type(pattern) == str:
-            pattern = re.compile(pattern)
-        soup = BeautifulSoup(self.htmlContent, features="lxml")
-        content = soup.get_text()
-        match = pattern.search(content)
+            pattern = compilePattern(pattern)
+        match = pattern.search(self.getText())
         if match:
             return self.fixDict(match.groupdict())
         return {}
 
+    def toCacheEntry(self, key):
+        return {
+            "uid": key,
+            "messageId": self.messageIdHeader,
+            "senderName": self.senderName,
+            "senderEmail": self.senderEmail,
+            "subject": self.subject,
+            "date": self.date.isoformat(),
+            "timestamp": self.date.timestamp(),
+            "text": self.getText(),
+        }
+
+    @classmethod
+    def fromCacheEntry(cls, messageId, entry):
+        emailObject = cls()
+        emailObject.messageId = messageId
+        emailObject.messageIdHeader = entry["messageId"]
+        emailObject.senderName = entry["senderName"]
+        emailObject.senderEmail = entry["senderEmail"]
+        emailObject.subject = entry["subject"]
+        emailObject.date = datetime.datetime.fromisoformat(entry["date"])
+        emailObject.text = entry["text"]
+        return emailObject
+
 class SingletonMeta(type):
     _instances = {}
+    _lock = threading.Lock()
     def __call__(cls, *args, **kwargs):
         if cls not in cls._instances:
-            instance = super().__call__(*args, **kwargs)
-            cls._instances[cls] = instance
+            with cls._lock:
+                if cls not in cls._instances:
+                    instance = super().__call__(*args, **kwargs)
+                    cls._instances[cls] = instance
         return cls._instances[cls]
 
+def fetchResponses(data):
+    """
+    Pairs the UID of every (envelope, literal) item of a UID FETCH response
+    with its literal, skipping the closing b")" items. The UID may come
+    after the literal, in the closing item. Without a UID the sequence
+    number is used.
+    """
+    data = list(data)
+    for index, response in enumerate(data):
+        if not isinstance(response, tuple):
+            continue
+        match = UID_PATTERN.search(response[0])
+        if match is None and index + 1 < len(data) and isinstance(data[index + 1], bytes):
+            match = UID_PATTERN.search(data[index + 1])
+        if match is None:
+            match = FETCH_ID_PATTERN.match(response[0])
+        if match:
+            yield match.group(1), response[0], response[1]
+
+def mergeWindows(windows):
+    """
+    Sorts (fromEpoch, toEpoch) windows and joins the overlapping ones.
+    """
+    merged = []
+    for fromEpoch, toEpoch in sorted(windows):
+        if merged and fromEpoch <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], toEpoch))
+        else:
+            merged.append((fromEpoch, toEpoch))
+    return merged
+
+def inWindows(timestamp, windows):
+    # windows as returned by mergeWindows
+    index = bisect.bisect_right(windows, (timestamp, float("inf"))) - 1
+    return index >= 0 and timestamp <= windows[index][1]
+
+def parseRawMessage(rawBytes):
+    message = email.message_from_bytes(rawBytes)
+    if message.is_multipart():
+        for part in message.walk():
+            try:
+                content = part.get_payload(decode=True).decode()
+                if part.get_content_type() == "text/html":
+                    messageBody = content
+                    return message, messageBody
+            except:
+                pass
+                # print("Could not load multipart content")
+    else:
+        if message.get_content_type() == "text/html" or message.get_content_type() == "text/plain":
+            messageBody = message.get_payload(decode=True).decode()
+            return message, messageBody
+    return message, None
+
 class Mail(metaclass=SingletonMeta):
-    def __init__(self):
+    """
+    IMAP access through a pool of at most MAIL_POOL_SIZE logged in sessions,
+    so concurrent callers do not share one connection. A session that fails
+    with a connection error is discarded and the call retried once on a
+    new one.
+
+    Messages are addressed by UID. Fetched mails are kept in a MailCache
+    under "UIDVALIDITY:UID", so a mail already seen is not fetched again.
+    """
+
+    def __init__(self, poolSize: int = MAIL_POOL_SIZE):
         self.config = Config("mail", isSecret=True)
         self.email = self.config.get("email")
         self.password = self.config.get("password")
-        self.imap =  imaplib.IMAP4_SSL("imap.gmail.com")
-        self.imap.login(self.email, self.password)
-        self.imap.select("INBOX")
+        self.idle = queue.LifoQueue()
+        # Sessions that may still be opened
+        self.available = threading.BoundedSemaphore(poolSize)
+        self.cache = MailCache()
+        # UIDVALIDITY of INBOX as of the latest session opened, for cache
+        # keys of calls that do not hold a session
+        self.uidValidity = None
+
+    def timeCommand(self, command, call, *args):
+        start = time.perf_counter()
+        try:
+            return call(*args)
+        except Exception:
+            imapErrors.inc(command)
+            raise
+        finally:
+            imapSeconds.observe(time.perf_counter() - start, command)
+
+    def uid(self, imap, command, *args):
+        return self.timeCommand(command.lower(), imap.uid, command, *args)
+
+    def connect(self):
+        imap = self.timeCommand("connect", imaplib.IMAP4_SSL, "imap.gmail.com")
+        self.timeCommand("login", imap.login, self.email, self.password)
+        self.timeCommand("select", imap.select, "INBOX")
+        _, uidValidity = imap.response("UIDVALIDITY")
+        imap.uidValidity = uidValidity[0].decode() if uidValidity and uidValidity[0] else "0"
+        self.uidValidity = imap.uidValidity
+        return imap
+
+    @contextmanager
+    def session(self):
+        self.available.acquire()
+        imap = None
+        try:
+            try:
+                imap = self.idle.get_nowait()
+            except queue.Empty:
+                imap = self.connect()
+            yield imap
+        except CONNECTION_ERRORS:
+            self.close(imap)
+            imap = None
+            raise
+        finally:
+            if imap is not None:
+                self.idle.put(imap)
+            self.available.release()
+
+    def close(self, imap):
+        if imap is None:
+            return
+        try:
+            imap.logout()
+        except Exception:
+            pass
+
+    def run(self, operation):
+        """
+        Calls operation(imap) on a pooled session, once more on a fresh
+        session if the connection turns out to be broken.
+        """
+        try:
+            with self.session() as imap:
+                return operation(imap)
+        except CONNECTION_ERRORS as e:
+            logging.warning(f"IMAP session failed, reconnecting: {e}")
+            with self.session() as imap:
+                return operation(imap)
+
+    def cacheKey(self, uidValidity, uid):
+        return f"{uidValidity}:{uid.decode() if isinstance(uid, bytes) else uid}"
 
     def getRawMessage(self, messageId):
-        status, data = self.imap.fetch(messageId,'(RFC822)')
+        status, data = self.run(lambda imap: self.uid(imap, "FETCH", messageId, '(RFC822)'))
         if status != "OK":
             raise Exception("Could not fetch message with messageId", messageId)
 
         for response in data:
             if isinstance(response, tuple):
-                message = email.message_from_bytes(response[1])
-                if message.is_multipart():
-                    for part in message.walk():
-                        try:
-                            content = part.get_payload(decode=True).decode()
-                            if part.get_content_type() == "text/html":
-                                messageBody = content
-                                return message, messageBody
-                        except:
-                            pass
-                            # print("Could not load multipart content")
-                else:
-                    if message.get_content_type() == "text/html" or message.get_content_type() == "text/plain":
-                        messageBody = message.get_payload(decode=True).decode() 
-                        return message, messageBody
-                return message, None
+                return parseRawMessage(response[1])
         raise Exception("Could not parse email")
+
+    def getMessageHeaders(self, imap, messageIds):
+        """
+        Returns the date (the Date header, falling back to INTERNALDATE) and
+        the Message-ID of every message, with one FETCH that leaves the
+        bodies on the server.
+        """
+        status, data = self.uid(imap, "FETCH", b",".join(messageIds), "(INTERNALDATE BODY.PEEK[HEADER.FIELDS (DATE MESSAGE-ID)])")
+        if status != "OK":
+            raise Exception("Could not fetch message headers")
+
+        headers = {}
+        for messageId, envelope, headerBytes in fetchResponses(data):
+            message = email.message_from_bytes(headerBytes)
+            timestamp = None
+            try:
+                timestamp = dateutil.parser.parse(message.get("Date")).timestamp()
+            except (TypeError, ValueError, OverflowError):
+                internalDate = imaplib.Internaldate2tuple(envelope)
+                if internalDate:
+                    timestamp = time.mktime(internalDate)
+            headers[messageId] = (timestamp, (message.get("Message-ID") or "").strip() or None)
+        return headers
+
+    def getEmails(self, imap, messageIds):
+        """
+        Downloads and parses the given messages with one FETCH.
+        """
+        if not messageIds:
+            return []
+        status, data = self.uid(imap, "FETCH", b",".join(messageIds), "(RFC822)")
+        if status != "OK":
+            raise Exception("Could not fetch messages", messageIds)
+
+        emails = []
+        for messageId, _, rawBytes in fetchResponses(data):
+            rawMessage, messageBody = parseRawMessage(rawBytes)
+            emails.append(self.convertToEmail(messageId, rawMessage, messageBody))
+        return emails
     
     def convertToEmail(self, messageId, rawMessage, messageBody):
         def getHeader(headerName, index):
@@ -117,19 +344,32 @@ class Mail(metaclass=SingletonMeta):
         emailObject.subject = getHeader("Subject", 0)
         emailObject.date = dateutil.parser.parse(getHeader("Date", 0))
         emailObject.htmlContent = messageBody
+        emailObject.messageIdHeader = (rawMessage.get("Message-ID") or "").strip() or None
         return emailObject
 
     def getEmail(self, messageId):
+        if self.uidValidity is None:
+            # Opening the first session reads it
+            with self.session():
+                pass
+        key = self.cacheKey(self.uidValidity, messageId)
+        entry = self.cache.get(key)
+        if entry and entry["text"] is not None:
+            mailCacheLookups.inc("hit")
+            return Email.fromCacheEntry(messageId, entry)
+        mailCacheLookups.inc("miss")
         rawMessage, messageBody = self.getRawMessage(messageId)
-        return self.convertToEmail(messageId, rawMessage, messageBody)
+        emailObject = self.convertToEmail(messageId, rawMessage, messageBody)
+        self.cache.put(emailObject.toCacheEntry(key))
+        return emailObject
 
     def markCompleted(self, messageId):
-        status, data = self.imap.store(messageId,'+FLAGS',self.config.get("emailProcessedFlag"))
+        status, data = self.run(lambda imap: self.uid(imap, "STORE", messageId,'+FLAGS',self.config.get("emailProcessedFlag")))
         if status != "OK":
             raise Exception("Could not set processed flag")
 
     def markIncomplete(self, messageId):
-        status, data = self.imap.store(messageId,'-FLAGS',self.config.get("emailProcessedFlag"))
+        status, data = self.run(lambda imap: self.uid(imap, "STORE", messageId,'-FLAGS',self.config.get("emailProcessedFlag")))
         if status != "OK":
             raise Exception("Could not unset processed flag")
 
@@ -137,15 +377,26 @@ class Mail(metaclass=SingletonMeta):
         return date.strftime("%d-%b-%Y")
 
     def getEmailsFrom(self, fromEmail, fromEpoch, toEpoch):
-        fromDate = datetime.datetime.utcfromtimestamp(fromEpoch)
-        toDate = datetime.datetime.utcfromtimestamp(toEpoch)
+        return self.getEmailsInWindows(fromEmail, [(fromEpoch, toEpoch)])
+
+    def getEmailsInWindows(self, fromEmail, windows):
+        """
+        Returns the emails from fromEmail dated inside any of the
+        (fromEpoch, toEpoch) windows, with a single search over the days
+        they span.
+        """
+        if not windows:
+            return []
+        return self.run(lambda imap: self.searchEmailsInWindows(imap, fromEmail, mergeWindows(windows)))
 
-        if fromDate.date() == toDate.date():
-            toDate += datetime.timedelta(days=1)
+    def searchEmailsInWindows(self, imap, fromEmail, windows):
+        fromDate = datetime.datetime.utcfromtimestamp(windows[0][0])
+        # BEFORE excludes its day, so search up to the day after the last one
+        toDate = datetime.datetime.utcfromtimestamp(windows[-1][1]) + datetime.timedelta(days=1)
 
         # IMAP only filters by date (not time), so fetch all emails from that date range
-        status, messageIds = self.imap.search(
-            None, "FROM", fromEmail, 
+        status, messageIds = self.uid(
+            imap, "SEARCH", "FROM", fromEmail, 
             "SINCE", self.formatDate(fromDate), 
             "BEFORE", self.formatDate(toDate), 
             "UNKEYWORD", self.config.get("emailProcessedFlag")
@@ -155,13 +406,37 @@ class Mail(metaclass=SingletonMeta):
             raise Exception("Could not search for messages from", fromEmail)
         
         messageIds = messageIds[0].split()
-        emails = []
+        if not messageIds:
+            return []
 
-        for messageId in messageIds:
-            emailObj = self.getEmail(messageId)
+        keys = {messageId: self.cacheKey(imap.uidValidity, messageId) for messageId in messageIds}
+        entries = self.cache.getMany(list(keys.values()))
 
-            # Manually filter by exact epoch timestamps
-            if fromEpoch <= emailObj.date.timestamp() <= toEpoch:
-                emails.append(emailObj)
+        # Manually filter by exact epoch timestamps, on the headers alone, so
+        # only the bodies of messages inside a window are downloaded. Headers
+        # of new messages are cached too, and a Message-ID already cached
+        # under another UID brings its text along.
+        unknown = [messageId for messageId in messageIds if keys[messageId] not in entries]
+        if unknown:
+            for messageId, (timestamp, messageIdHeader) in self.getMessageHeaders(imap, unknown).items():
+                known = self.cache.getByMessageId(messageIdHeader)
+                entry = {**known, "uid": keys[messageId]} if known else {"uid": keys[messageId], "messageId": messageIdHeader, "timestamp": timestamp}
+                self.cache.put(entry)
+                entries[keys[messageId]] = entry
 
-        return emails
+        emails = {}
+        toFetch = []
+        for messageId in messageIds:
+            entry = entries.get(keys[messageId])
+            if not entry or entry["timestamp"] is None or not inWindows(entry["timestamp"], windows):
+                continue
+            if entry.get("text") is None:
+                toFetch.append(messageId)
+            else:
+                emails[messageId] = Email.fromCacheEntry(messageId, entry)
+        mailCacheLookups.inc("hit", amount=len(emails))
+        mailCacheLookups.inc("miss", amount=len(toFetch))
+        for emailObject in self.getEmails(imap, toFetch):
+            self.cache.put(emailObject.toCacheEntry(self.cacheKey(imap.uidValidity, emailObject.messageId)))
+            emails[emailObject.messageId] = emailObject
+        return [emails[messageId] for messageId in messageIds if messageId in emails]
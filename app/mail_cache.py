@@ -0,0 +1,124 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+from utils import getScriptDir
+
+MAIL_CACHE_PATH = os.environ.get("MAIL_CACHE_PATH", os.path.join(getScriptDir(), "cache", "mail.sqlite3"))
+MAIL_CACHE_MAX_BYTES = int(os.environ.get("MAIL_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+# Counted for every row on top of its text, so header-only rows are evicted too
+ROW_OVERHEAD_BYTES = 128
+FIELDS = ("uid", "messageId", "senderName", "senderEmail", "subject", "date", "timestamp", "text")
+
+
+class MailCache():
+    """
+    On-disk cache of fetched mails in SQLite. Rows are keyed by
+    "UIDVALIDITY:UID", so they go stale by themselves when the mailbox is
+    renumbered, and are also found by Message-ID. A row holds the decoded
+    headers and the plain text of the body; a row without text only records
+    the date of a mail whose body was never needed.
+
+    Once the stored text outgrows maxBytes the least recently used rows are
+    evicted.
+    """
+
+    def __init__(self, path: str = MAIL_CACHE_PATH, maxBytes: int = MAIL_CACHE_MAX_BYTES):
+        self.maxBytes = maxBytes
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS mail (
+                    uid TEXT PRIMARY KEY,
+                    messageId TEXT,
+                    senderName TEXT,
+                    senderEmail TEXT,
+                    subject TEXT,
+                    date TEXT,
+                    timestamp REAL,
+                    text TEXT,
+                    size INTEGER NOT NULL DEFAULT 0,
+                    accessed REAL NOT NULL
+                )
+            """)
+            self.connection.execute("CREATE INDEX IF NOT EXISTS mail_message_id ON mail (messageId)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS mail_accessed ON mail (accessed)")
+            self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM mail").fetchone()[0]
+
+    def rows(self, query: str, params) -> List[Dict]:
+        # Caller holds the lock
+        cursor = self.connection.execute(query, params)
+        return [dict(zip(FIELDS, row)) for row in cursor.fetchall()]
+
+    def getMany(self, uids: List[str]) -> Dict[str, Dict]:
+        if not uids:
+            return {}
+        found = {}
+        with self.lock:
+            # Stay under SQLite's limit of bound parameters
+            for start in range(0, len(uids), 500):
+                chunk = uids[start:start + 500]
+                marks = ",".join("?" * len(chunk))
+                for row in self.rows(f"SELECT {', '.join(FIELDS)} FROM mail WHERE uid IN ({marks})", chunk):
+                    found[row["uid"]] = row
+            self.touch(list(found))
+        return found
+
+    def get(self, uid: str) -> Optional[Dict]:
+        return self.getMany([uid]).get(uid)
+
+    def getByMessageId(self, messageId: str) -> Optional[Dict]:
+        if not messageId:
+            return None
+        with self.lock:
+            rows = self.rows(f"SELECT {', '.join(FIELDS)} FROM mail WHERE messageId = ? AND text IS NOT NULL LIMIT 1", (messageId,))
+            if rows:
+                self.touch([rows[0]["uid"]])
+            return rows[0] if rows else None
+
+    def touch(self, uids: List[str]):
+        # Caller holds the lock
+        now = time.time()
+        self.connection.executemany("UPDATE mail SET accessed = ? WHERE uid = ?", [(now, uid) for uid in uids])
+
+    def put(self, entry: Dict):
+        """
+        Stores a mail given as a dict with the FIELDS keys; missing keys are
+        stored as NULL.
+        """
+        values = [entry.get(field) for field in FIELDS]
+        size = ROW_OVERHEAD_BYTES + len((entry.get("text") or "").encode()) + len((entry.get("subject") or "").encode())
+        with self.lock:
+            previous = self.connection.execute("SELECT size FROM mail WHERE uid = ?", (entry["uid"],)).fetchone()
+            self.connection.execute(
+                f"INSERT OR REPLACE INTO mail ({', '.join(FIELDS)}, size, accessed) VALUES ({','.join('?' * len(FIELDS))}, ?, ?)",
+                values + [size, time.time()],
+            )
+            self.size += size - (previous[0] if previous else 0)
+            if self.size > self.maxBytes:
+                self.evict()
+
+    def evict(self):
+        # Caller holds the lock. Evict down to 90% so the next few puts do
+        # not evict again.
+        target = self.maxBytes * 0.9
+        cursor = self.connection.execute("SELECT uid, size FROM mail ORDER BY accessed")
+        evicted = []
+        for uid, size in cursor.fetchall():
+            if self.size <= target:
+                break
+            evicted.append((uid,))
+            self.size -= size
+        self.connection.executemany("DELETE FROM mail WHERE uid = ?", evicted)
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM mail")
+            self.size = 0
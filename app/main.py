@@ -1,25 +1,38 @@
+import hmac
 import os
 from uuid import uuid4
 from auth import validate_token
 from typing import List
 from models import AddTransactionReasonRequest, CategorizeTransactionRequest, CategoryEntry, GetTransactionRequest, IgnoreTransactionRequest, Message, Pattern, UpdateSendersRequest, Transaction
-from fastapi import FastAPI, Security, HTTPException, BackgroundTasks, Depends, Path, Body, Request
+from fastapi import FastAPI, Security, HTTPException, BackgroundTasks, Depends, Path, Body, Query, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from parser import parseMessages, extract_sms_details, executor
-from db import get_categories, delete_category, get_emails, get_patterns, get_senders, get_transactions, is_admin, read_messages, read_sms_from_last_30_days, unprocess_message, upsert_category, upsert_pattern, update_senders, delete_pattern, save_sms, add_transactions_db
-from fastapi.responses import FileResponse
+from parser import parseMessages, processMessages, extract_sms_details, executor
+from db import delete_category, delete_pattern, save_sms, unprocess_message, update_senders, upsert_category, upsert_pattern
+from db_async import (add_transactions_db, get_categories, get_emails, get_monthly_summary, get_patterns, get_senders, get_transactions,
+                      get_transactions_page, is_admin, read_messages, stream_transactions)
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from transactions import add_transaction_reason, categorize_transaction, ignore_transaction, unignore_transaction
+from metrics import CONTENT_TYPE, METRICS_TOKEN, render
+from profiler import PROFILE_MAX_SECONDS, run_in_threadpool
+from refresh import refresh_all
+from starlette.routing import Match
+from transactions import add_transaction_reason, categorize_transaction, enrichmentQueue, ignore_transaction, unignore_transaction
+import profiler
+import usage
+from utils import decode_cursor, encode_cursor
 import uvicorn
 import logging
+import json
 from datetime import datetime
 
 jwt_bearer = HTTPBearer(auto_error=False)
 logging.basicConfig(level=logging.INFO)
 
 app = FastAPI()
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# The built frontend is only there in the image
+if os.path.isdir("static"):
+    app.mount("/static", StaticFiles(directory="static"), name="static")
 
 origins = [
     "http://localhost",
@@ -35,6 +48,72 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def route_of(request: Request) -> str:
+    for route in request.app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return request.url.path
+
+@app.middleware("http")
+async def firestore_usage(request: Request, call_next):
+    # Counts the Firestore reads and writes made for the request, returned as
+    # X-Firestore-* headers and logged; see usage.py for the budgets
+    route = route_of(request)
+    requestUsage = usage.Usage(route, usage.budget_for(route))
+    token = usage.current.set(requestUsage)
+    try:
+        response = await call_next(request)
+    except usage.BudgetExceeded as e:
+        response = JSONResponse({"detail": str(e)}, status_code=503)
+    finally:
+        usage.current.reset(token)
+
+    def finish():
+        requestUsage.finished = True
+        logging.info(json.dumps({"event": "firestore_usage", "method": request.method, "route": route, "status": response.status_code, **requestUsage.counts()}))
+
+    # A streamed body still reads while it is sent, its headers are partial
+    response.headers.update(requestUsage.headers())
+    if requestUsage.streaming:
+        response.body_iterator = finished_after(response.body_iterator, finish)
+    else:
+        finish()
+    return response
+
+async def finished_after(body, finish):
+    try:
+        async for chunk in body:
+            yield chunk
+    finally:
+        finish()
+
+@app.middleware("http")
+async def trace_request(request: Request, call_next):
+    # Only requests claimed by a cProfile trace of /admin/profile
+    trace = profiler.claim(route_of(request))
+    if trace is None:
+        return await call_next(request)
+    trace.method, trace.path = request.method, request.url.path
+    token = profiler.tracing.set(trace)
+    profile = trace.start()
+    try:
+        response = await call_next(request)
+        trace.status = response.status_code
+        return response
+    finally:
+        profile.disable()
+        profiler.tracing.reset(token)
+        trace.done.set()
+
+@app.on_event("startup")
+def start_enrichment_queue():
+    enrichmentQueue.start()
+
+@app.on_event("shutdown")
+def stop_enrichment_queue():
+    enrichmentQueue.stop()
+
 def getEmail(credentials: HTTPAuthorizationCredentials = Security(jwt_bearer)) -> str:
     if credentials and credentials.scheme == "Bearer":
         email = validate_token(credentials.credentials)
@@ -54,41 +133,40 @@ def ui() -> str:
     return FileResponse(os.path.join("static", "expense-tracker", "index.html"))
 
 @app.post("/processmessages")
-def process_messages(email = Security(getEmail), background_tasks: BackgroundTasks = None):
-    messages = read_messages(email)
-    parseMessages(email, messages, background_tasks)
+async def process_messages(email = Security(getEmail), background_tasks: BackgroundTasks = None, full: bool = False):
+    await run_in_threadpool(processMessages, email, full=full, backgroundTasks=background_tasks)
     return {"status": "success", "message": "Messages processed successfully"}
 
 @app.get("/messages")
-def messages(email = Security(getEmail), admin_mode: bool = False):
-    if not is_admin(email):
+async def messages(email = Security(getEmail), admin_mode: bool = False, limit: int = Query(default=0, ge=0)):
+    if not await is_admin(email):
         admin_mode = False
-    messages = read_messages(email, admin_mode=admin_mode)
+    messages = await read_messages(email, admin_mode=admin_mode, limit=limit or None)
     messages = {"messages": [message.dict() for message in messages]}
     return messages
 
 @app.post("/senders")
-def _update_senders(updateSendersRequest: UpdateSendersRequest, email = Security(getEmail)):
-    update_senders(updateSendersRequest.senders)
+async def _update_senders(updateSendersRequest: UpdateSendersRequest, email = Security(getEmail)):
+    await run_in_threadpool(update_senders, updateSendersRequest.senders)
     return "ok"
 
 @app.get("/patterns")
-def patterns(email = Security(getEmail)):
-    patterns = get_patterns()
+async def patterns(email = Security(getEmail)):
+    patterns = await get_patterns()
     return {"patterns": patterns}
 
 @app.post("/patterns")
-def _upsert_pattern(pattern: Pattern, email = Security(getEmail)):
-    success = upsert_pattern(pattern, email)
+async def _upsert_pattern(pattern: Pattern, email = Security(getEmail)):
+    success = await run_in_threadpool(upsert_pattern, pattern, email)
     if not success:
         raise HTTPException(status_code=400, detail="Invalid pattern")
     return "ok"
 
 @app.delete("/patterns/{pattern_id}")
-def _delete_pattern(pattern_id: str = Path(..., description="The ID of the pattern to delete"), email = Security(getEmail)):
-    if not is_admin(email):
+async def _delete_pattern(pattern_id: str = Path(..., description="The ID of the pattern to delete"), email = Security(getEmail)):
+    if not await is_admin(email):
         raise HTTPException(status_code=403, detail="Not authorized to delete patterns")
-    success = delete_pattern(pattern_id)
+    success = await run_in_threadpool(delete_pattern, email, pattern_id)
     if not success:
         raise HTTPException(status_code=404, detail="Pattern not found")
     return {"status": "success", "message": "Pattern deleted successfully"}
@@ -99,93 +177,168 @@ def test_pattern(content: str = Body(..., embed=True), regex: str = Body(..., em
     return {"success": success, "details": details}
 
 @app.get("/senders")
-def _get_senders(email = Security(getEmail)):
-    senders = get_senders()
+async def _get_senders(email = Security(getEmail)):
+    senders = await get_senders()
     senders = [sender.dict() for sender in senders] 
     return {"senders": senders}
 
 @app.get("/transactions")
-def _get_transactions(email = Security(getEmail), transactionRequest: GetTransactionRequest = Depends()):
-    transactions = get_transactions(email, transactionRequest.get_from_date(), transactionRequest.get_to_date())
-    return {"transactions": transactions}
+async def _get_transactions(email = Security(getEmail), transactionRequest: GetTransactionRequest = Depends()):
+    from_date, to_date = transactionRequest.get_from_date(), transactionRequest.get_to_date()
+    if transactionRequest.stream:
+        return StreamingResponse(usage.stream(ndjson(stream_transactions(email, from_date, to_date))), media_type="application/x-ndjson")
+
+    if not transactionRequest.limit:
+        transactions = await get_transactions(email, from_date, to_date)
+        return {"transactions": transactions}
+
+    after = None
+    if transactionRequest.cursor:
+        try:
+            after = decode_cursor(transactionRequest.cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    transactions = await get_transactions_page(email, from_date, to_date, transactionRequest.limit + 1, after)
+    next_cursor = None
+    if len(transactions) > transactionRequest.limit:
+        transactions = transactions[:transactionRequest.limit]
+        last = transactions[-1]
+        next_cursor = encode_cursor(last.timestamp, last.id)
+    return {"transactions": transactions, "next_cursor": next_cursor}
+
+async def ndjson(transactions):
+    try:
+        async for transaction in transactions:
+            yield json.dumps(transaction.dict()) + "\n"
+    except usage.BudgetExceeded as e:
+        # The status has been sent, the stream ends with the error instead
+        yield json.dumps({"detail": str(e)}) + "\n"
+
+@app.get("/summary")
+async def _get_summary(email = Security(getEmail), month: str = "", rebuild: bool = False):
+    if not month:
+        month = datetime.now().strftime("%Y-%m")
+    try:
+        datetime.strptime(month, "%Y-%m")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Month must be in YYYY-MM format")
+    summary = await get_monthly_summary(email, month, rebuild)
+    return {"summary": summary}
 
 @app.post("/transaction/ignore")
-def _ignore_transaction(request: IgnoreTransactionRequest, email = Security(getEmail)):
-    ignore_transaction(request.transaction_id, email, manual=True)
+async def _ignore_transaction(request: IgnoreTransactionRequest, email = Security(getEmail)):
+    await run_in_threadpool(ignore_transaction, request.transaction_id, email, manual=True)
     return "ok"
 
 @app.post("/transaction/unignore")
-def _unignore_transaction(request: IgnoreTransactionRequest, email = Security(getEmail)):
-    unignore_transaction(request.transaction_id, email, manual=True)
+async def _unignore_transaction(request: IgnoreTransactionRequest, email = Security(getEmail)):
+    await run_in_threadpool(unignore_transaction, request.transaction_id, email, manual=True)
     return "ok"
 
 @app.post("/transaction/reason")
-def _add_transaction_reason(request: AddTransactionReasonRequest, email = Security(getEmail)):
-    add_transaction_reason(request, email, manual=True)
+async def _add_transaction_reason(request: AddTransactionReasonRequest, email = Security(getEmail)):
+    await run_in_threadpool(add_transaction_reason, request, email, manual=True)
     return "ok"
 
 @app.post("/transaction/categorize")
-def _categorize_transaction(request: CategorizeTransactionRequest, email = Security(getEmail)):
-    categorize_transaction(request.transaction_id, request.category, email, manual=True)
+async def _categorize_transaction(request: CategorizeTransactionRequest, email = Security(getEmail)):
+    await run_in_threadpool(categorize_transaction, request.transaction_id, request.category, email, manual=True)
     return "ok"
 
 @app.post("/transactions/add")
-def add_transaction(transaction: Transaction = Body(...), email = Security(getEmail)):
-    add_transactions_db(email, [transaction])
+async def add_transaction(transaction: Transaction = Body(...), email = Security(getEmail)):
+    result = await add_transactions_db(email, [transaction])
+    if result.failed:
+        raise HTTPException(status_code=500, detail="Failed to add transaction")
     return {"status": "success", "message": "Transactions added successfully"}
 
 @app.post("/transaction/refresh")
-def _refresh_transactions():
-    emails = get_emails()
-    for email in emails:
-        logging.info(f"Running scheduled task for email: {email} at {datetime.now()}")
-        messages = read_messages(email, 1)
-        parseMessages(email, messages)
-        logging.info(f"Finished processing messages for email: {email}")
+async def _refresh_transactions(full: bool = False):
+    emails = await get_emails()
+    logging.info(f"Running scheduled refresh for {len(emails)} emails at {datetime.now()}")
+    reports = await run_in_threadpool(refresh_all, emails, full=full)
+    if reports is None:
+        raise HTTPException(status_code=409, detail="Refresh already running")
+    logging.info(f"Finished scheduled refresh for {len(emails)} emails")
+    return {"status": "success", "reports": reports}
 
 @app.post("/sms/unprocess")
-def unprocess_sms(email = Security(getEmail), sms_id= Body(..., embed=True)):
+async def unprocess_sms(email = Security(getEmail), sms_id= Body(..., embed=True)):
     logging.info(f"Unprocessing SMS with ID: {sms_id} for email: {email}")
-    unprocess_message(email, sms_id)
+    await run_in_threadpool(unprocess_message, email, sms_id)
     return {"status": "success", "message": "Message unprocessed successfully"}
 
 @app.post("/sms")
-def save_sms_endpoint(request: Request, email: str = Body(...), sms: str = Body(...), sender: str = Body(...), background_tasks: BackgroundTasks = None):
+async def save_sms_endpoint(request: Request, email: str = Body(...), sms: str = Body(...), sender: str = Body(...), background_tasks: BackgroundTasks = None):
     id = str(uuid4())
-    save_sms(email, sms, sender, id)
+    if not await run_in_threadpool(save_sms, email, sms, sender, id):
+        return {"status": "success", "message": "SMS already received"}
     message = Message(sms=sms, sender=sender, timestamp=int(datetime.now().timestamp()), id=id)
-    parseMessages(email, [message], background_tasks)
+    await run_in_threadpool(parseMessages, email, [message], background_tasks)
     return {"status": "success", "message": "SMS saved successfully"}
 
 @app.get("/category")
-def _get_categories(email = Security(getEmail)):
-    categories = get_categories(email)
+async def _get_categories(email = Security(getEmail)):
+    categories = await get_categories(email)
     return {"categories": categories}
 
 @app.post("/category")
-def _upsert_category(categoryEntry: CategoryEntry = Body(...), email = Security(getEmail)):
-    if not upsert_category(categoryEntry, email):
+async def _upsert_category(categoryEntry: CategoryEntry = Body(...), email = Security(getEmail)):
+    if not await run_in_threadpool(upsert_category, categoryEntry, email):
         raise HTTPException(status_code=400, detail="Invalid category entry")
     return {"status": "success", "message": "Category added successfully"}
 
 @app.delete("/category/{category}")
-def _delete_category(category: str = Path(..., description="The category to delete"), email = Security(getEmail)):
-    if not delete_category(category, email):
+async def _delete_category(category: str = Path(..., description="The category to delete"), email = Security(getEmail)):
+    if not await run_in_threadpool(delete_category, category, email):
         raise HTTPException(status_code=404, detail="Category not found")
     return {"status": "success", "message": "Category deleted successfully"}
 
+@app.get("/admin/profile")
+async def profile(email = Security(getEmail), mode: str = Query(default="sample", pattern="^(sample|cprofile)$"),
+                  seconds: float = Query(default=10, gt=0, le=PROFILE_MAX_SECONDS), route: str = "",
+                  sort: str = "cumulative", limit: int = Query(default=50, gt=0)):
+    """
+    sample: collapsed stacks of all threads sampled for seconds, for a
+    flamegraph. cprofile: cProfile statistics of the next request to route
+    (any route when empty) starting within seconds.
+    """
+    if not await is_admin(email):
+        raise HTTPException(status_code=403, detail="Not authorized to profile")
+    if mode == "sample":
+        stacks = await run_in_threadpool(profiler.sample, seconds)
+        if stacks is None:
+            raise HTTPException(status_code=409, detail="Profile already running")
+        return PlainTextResponse(stacks)
+
+    trace = await run_in_threadpool(profiler.trace_next, route, seconds)
+    if trace is None:
+        raise HTTPException(status_code=409, detail="Profile already running")
+    if not trace.done.is_set():
+        raise HTTPException(status_code=504, detail=f"No request to {route or 'any route'} finished within the wait")
+    try:
+        return PlainTextResponse(trace.report(sort, limit))
+    except KeyError:
+        raise HTTPException(status_code=400, detail=f"Invalid sort key: {sort}")
+
+@app.get("/metrics")
+async def metrics(credentials: HTTPAuthorizationCredentials = Security(jwt_bearer)):
+    # A static scrape token, user ID tokens expire within the hour
+    if not METRICS_TOKEN or not credentials or not hmac.compare_digest(credentials.credentials.encode(), METRICS_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Not authorized to read metrics")
+    return Response(await run_in_threadpool(render), media_type=CONTENT_TYPE)
 
 @app.get("/status")
-def status():
-    emails = get_emails()
+async def status():
+    emails = await get_emails()
     hasTransactions = False
     for email in emails:
-        if is_admin(email):
+        if await is_admin(email):
             # get current date in epoch
             to_date = int(datetime.now().timestamp())
             # get from date as 30 days before today
             from_date = to_date - 30 * 24 * 60 * 60
-            transactions = get_transactions(email, from_date, to_date)
+            transactions = await get_transactions(email, from_date, to_date)
             if transactions:
                 hasTransactions = True
                 break
@@ -0,0 +1,235 @@
+import functools
+import inspect
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Latency buckets in seconds, from cache hits up to slow IMAP fetches
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = "text/plain; version=0.0.4"
+# Bearer token the scraper sends to /metrics, which is closed while unset
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+metrics: Dict[str, "Metric"] = {}
+metricsLock = threading.Lock()
+
+Labels = Tuple[str, ...]
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def formatLabels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f"{name}=\"{escape(value)}\"" for name, value in zip(names, values)) + "}"
+
+def formatValue(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metric():
+    """
+    A named family of samples told apart by label values, rendered in the
+    Prometheus text format.
+
+    Recording takes no lock: every thread writes to its own shard, found
+    through a thread-local, and shards are only merged when the metrics are
+    collected. Shards of threads that have ended are folded into one
+    whenever a new shard is registered and on collection, so short-lived
+    threads do not pile up between scrapes.
+    """
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.local = threading.local()
+        self.shards: List[Tuple[threading.Thread, Dict]] = []
+        self.retired: Dict = {}
+        self.lock = threading.Lock()
+        with metricsLock:
+            metrics[name] = self
+
+    def shard(self) -> Dict:
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.fold()
+                self.shards.append((threading.current_thread(), shard))
+        return shard
+
+    def fold(self):
+        # Caller holds the lock
+        alive = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self.merge(self.retired, shard)
+        self.shards = alive
+
+    def merge(self, target: Dict, shard: Dict):
+        raise NotImplementedError
+
+    def collect(self) -> Dict:
+        with self.lock:
+            self.fold()
+            merged: Dict = {}
+            self.merge(merged, self.retired)
+            for _, shard in self.shards:
+                # A copy, the owning thread keeps writing
+                self.merge(merged, dict(shard))
+        return merged
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels: str, amount: float = 1):
+        shard = self.shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def merge(self, target: Dict, shard: Dict):
+        for labels, value in shard.items():
+            target[labels] = target.get(labels, 0) + value
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{formatLabels(self.labelnames, labels)} {formatValue(value)}" for labels, value in sorted(self.collect().items())]
+
+
+class Histogram(Metric):
+    """
+    Per label values, one count per bucket (not cumulative) followed by the
+    +Inf bucket and the sum of the observations.
+    """
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels: str):
+        shard = self.shard()
+        counts = shard.get(labels)
+        if counts is None:
+            counts = shard[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def merge(self, target: Dict, shard: Dict):
+        for labels, counts in shard.items():
+            merged = target.get(labels)
+            if merged is None:
+                target[labels] = list(counts)
+            else:
+                for index, count in enumerate(counts):
+                    merged[index] += count
+
+    def render(self) -> List[str]:
+        lines = []
+        names = self.labelnames + ("le",)
+        for labels, counts in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{formatLabels(names, labels + (formatValue(bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{formatLabels(self.labelnames, labels)} {formatValue(counts[-1])}")
+            lines.append(f"{self.name}_count{formatLabels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class CallbackMetric(Metric):
+    """
+    Samples read when the metrics are collected, from a callback returning
+    {label values: value}, for counts something else already keeps.
+    """
+
+    def __init__(self, name: str, help: str, type: str, labelnames: Sequence[str], callback: Callable[[], Dict[Labels, float]]):
+        super().__init__(name, help, labelnames)
+        self.type = type
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{formatLabels(self.labelnames, labels)} {formatValue(value)}" for labels, value in sorted(self.callback().items())]
+
+
+def timed(histogram: Histogram, label: Optional[str] = None, errors: Optional[Counter] = None):
+    """
+    Records the duration of every call in histogram, labelled with label or
+    the function's name, and counts the calls that raise in errors. For
+    generators the time until they are exhausted is recorded.
+    """
+    def decorator(func):
+        name = label or func.__name__
+
+        def record(start, failed):
+            histogram.observe(time.perf_counter() - start, name)
+            if failed and errors is not None:
+                errors.inc(name)
+
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def generatorWrapper(*args, **kwargs):
+                start, failed = time.perf_counter(), True
+                try:
+                    yield from func(*args, **kwargs)
+                    failed = False
+                finally:
+                    record(start, failed)
+            return generatorWrapper
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def coroutineWrapper(*args, **kwargs):
+                start, failed = time.perf_counter(), True
+                try:
+                    result = await func(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    record(start, failed)
+            return coroutineWrapper
+
+        if inspect.isasyncgenfunction(func):
+            @functools.wraps(func)
+            async def asyncGeneratorWrapper(*args, **kwargs):
+                start, failed = time.perf_counter(), True
+                try:
+                    async for item in func(*args, **kwargs):
+                        yield item
+                    failed = False
+                finally:
+                    record(start, failed)
+            return asyncGeneratorWrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start, failed = time.perf_counter(), True
+            try:
+                result = func(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                record(start, failed)
+        return wrapper
+    return decorator
+
+def render() -> str:
+    with metricsLock:
+        families = sorted(metrics.values(), key=lambda metric: metric.name)
+    lines = []
+    for metric in families:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
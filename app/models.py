@@ -108,9 +108,50 @@ class CategorizeTransactionRequest(BaseModel):
     transaction_id: str
     category: Union[Category, str]
 
+class BatchChunkResult(BaseModel):
+    index: int
+    size: int
+    success: bool
+    error: str = ""
+    attempts: int = 1
+
+class BatchWriteResult(BaseModel):
+    chunks: List[BatchChunkResult] = []
+    written: int = 0
+    failed: int = 0
+
+class ParseReport(BaseModel):
+    scanned: int = 0
+    matched: int = 0
+    rejected: int = 0
+    transactions: int = 0
+    transactionsWritten: int = 0
+
+class RefreshReport(ParseReport):
+    email: str
+    status: str = "ok"
+    error: str = ""
+    duration: float = 0
+
+class SummaryTotals(BaseModel):
+    debit: float = 0
+    credit: float = 0
+    count: int = 0
+
+class MonthlySummary(BaseModel):
+    month: str
+    totals: SummaryTotals = Field(default_factory=SummaryTotals)
+    categories: Dict[str, SummaryTotals] = {}
+    ignored: SummaryTotals = Field(default_factory=SummaryTotals)
+
 class GetTransactionRequest(BaseModel):
     from_date: int = 0
     to_date: int = 0
+    # Page size; 0 returns the whole window in one response
+    limit: int = Field(default=0, ge=0, le=1000)
+    cursor: str = ""
+    # Stream the window as newline-delimited JSON
+    stream: bool = False
 
     def normalise(self, ts):
         # If timestamp is in milliseconds, convert to seconds
@@ -1,19 +1,26 @@
 from concurrent.futures import ThreadPoolExecutor
 import datetime
 import json
-import hashlib
 import logging
 import re
+import time
 from typing import List
 
-from models import Message, MessageStatus, PatternAction, Sender, SenderComparisonType, SenderStatus, Transaction
-from db import add_sender, get_patterns, get_senders, update_message_status
+from models import Message, MessageStatus, ParseReport, PatternAction, Transaction
+from metrics import Counter, Histogram, timed
+from db import claim_sms_hashes, get_processing_watermark, read_messages, read_new_messages, set_processing_watermark, update_message_status
+from pattern_engine import get_pattern_engine
+from sender_classifier import classifier
 from transactions import add_transactions
 
 
 reject_keywords = []
 regexes = []
-executor = ThreadPoolExecutor()
+executor = ThreadPoolExecutor(thread_name_prefix="parser")
+
+stage_seconds = Histogram("parse_stage_seconds", "Duration of the parseMessages stages, per call", ["stage"])
+parsed_messages = Counter("parse_messages_total", "Messages parsed, by outcome", ["outcome"])
+write_transactions = timed(stage_seconds, "transaction_write")(add_transactions)
 
 def extract_sms_details(regex: str, sms: str):
     """
@@ -36,35 +43,45 @@ def extract_sms_details(regex: str, sms: str):
         logging.error(f"Regex error: {e} for regex: {regex}")
         return False, {}
 
-def reject(email: str, messages: List[Message]):
+def reject(email: str, messages: List[Message]) -> int:
     if not messages:
-        return
+        return 0
 
     for message in messages:
         message.status = MessageStatus.rejected
 
     logging.info(f"Rejecting {len(messages)} messages")
-    update_message_status(email, messages)
+    return update_message_status(email, messages)
 
-def set_matched(email: str, messages: List[Message]):
+def set_matched(email: str, messages: List[Message]) -> int:
     if not messages:
-        return
+        return 0
 
     for message in messages:
         message.status = MessageStatus.matched
 
     logging.info(f"Matching {len(messages)} messages")
-    update_message_status(email, messages)
+    return update_message_status(email, messages)
+
+def observe_stage(stage: str, start: float) -> float:
+    # Once per stage and call, the loops themselves stay free of it
+    now = time.perf_counter()
+    stage_seconds.observe(now - start, stage)
+    return now
 
-def parseMessages(email: str, messages: List[Message], backgroundTasks=None):
+def parseMessages(email: str, messages: List[Message], backgroundTasks=None, wait: bool = False) -> ParseReport:
+    """
+    Parses the messages, writes their statuses and hands the resulting
+    transactions to add_transactions: as a background task when given
+    backgroundTasks, inline when wait is set, on the executor otherwise.
+    """
     rejected = []
     matched = []
     transactions = []
-    hashes = set()
+    candidates = []
+    start = time.perf_counter()
     for message in messages:
         sender = message.sender
-        sms = message.sms
-        hash = hashlib.md5(sms.encode()).hexdigest()
         if not sender:
             if message.status != MessageStatus.rejected:
                 logging.info(f"Rejecting message with no sender: {message}")
@@ -74,11 +91,16 @@ def parseMessages(email: str, messages: List[Message], backgroundTasks=None):
             if message.status != MessageStatus.rejected:
                 rejected.append(message)
             continue
-        if hash in hashes:
+        candidates.append(message)
+    start = observe_stage("sender", start)
+
+    duplicates = claim_sms_hashes(email, candidates)
+    start = observe_stage("dedupe", start)
+    for message in candidates:
+        if message.id in duplicates:
             logging.info(f"Rejecting duplicate message: {message.sms}")
             rejected.append(message)
             continue
-        hashes.add(hash)
         timestamp = message.timestamp
         success, status, pattern, transaction = parseMessage(message)
         if success:
@@ -102,42 +124,65 @@ def parseMessages(email: str, messages: List[Message], backgroundTasks=None):
                 rejected.append(message)
         else:
             message.status = MessageStatus.unprocessed
+    start = observe_stage("match", start)
     reject(email, rejected)
     set_matched(email, matched)
-    if backgroundTasks:
-        backgroundTasks.add_task(add_transactions, email, transactions)
+    observe_stage("status_write", start)
+    parsed_messages.inc("matched", amount=len(matched))
+    parsed_messages.inc("rejected", amount=len(rejected))
+    parsed_messages.inc("unprocessed", amount=len(messages) - len(matched) - len(rejected))
+    report = ParseReport(scanned=len(messages), matched=len(matched), rejected=len(rejected), transactions=len(transactions))
+    if wait:
+        result = write_transactions(email, transactions)
+        report.transactionsWritten = result.written if result else 0
+    elif backgroundTasks:
+        backgroundTasks.add_task(write_transactions, email, transactions)
     else:
-        executor.submit(add_transactions, email, transactions)
+        executor.submit(write_transactions, email, transactions)
+    return report
+
+def processMessages(email: str, full: bool = False, days_ago_start: int = 30, backgroundTasks=None, wait: bool = False) -> ParseReport:
+    """
+    Parses a user's messages. By default only messages newer than the user's
+    processing watermark, or still marked unprocessed, are read and parsed.
+    With full=True the whole window is read and reparsed, as before.
+    """
+    if full:
+        messages = read_messages(email, days_ago_start)
+        report = parseMessages(email, messages, backgroundTasks, wait)
+        # Every status is derived again, so messages nothing matches any more
+        # are marked unprocessed as well as those never marked
+        update_message_status(email, [message for message in messages if message.status == MessageStatus.unprocessed])
+        newest = max((message.timestamp for message in messages), default=0)
+        if newest > get_processing_watermark(email):
+            set_processing_watermark(email, newest)
+        return report
+
+    report = ParseReport()
+    watermark = get_processing_watermark(email)
+    messages, newest = read_new_messages(email, watermark, days_ago_start)
+    if messages:
+        report = parseMessages(email, messages, backgroundTasks, wait)
+        # Messages nothing matched yet carry no stored status; mark them so the
+        # next run picks them up again once the watermark has moved past them
+        pending = [message for message in messages if message.status == MessageStatus.unprocessed and message.timestamp > watermark]
+        update_message_status(email, pending)
+    if newest > watermark:
+        set_processing_watermark(email, newest)
+    logging.info(f"Processed {len(messages)} new messages for email: {email}, watermark: {newest}")
+    return report
 
 def parseMessage(message: Message):
-    patterns = get_patterns()
-    for pattern in patterns:
-        if pattern.sender.lower() in message.sender.lower():
-            success, details = extract_sms_details(pattern.pattern, message.sms)
-            if success:
-                if pattern.action == PatternAction.approve:
-                    if details["amount"]:
-                        # Remove anything other than digits, and decimal points from amount
-                        details["amount"] = re.sub(r"[^\d,.]", "", details["amount"])
-                    return True, MessageStatus.matched, pattern, details
-                else:
-                    return True, MessageStatus.rejected, pattern, None
+    pattern, details = get_pattern_engine().match(message.sender, message.sms)
+    if pattern:
+        if pattern.action == PatternAction.approve:
+            if details["amount"]:
+                # Remove anything other than digits, and decimal points from amount
+                details["amount"] = re.sub(r"[^\d,.]", "", details["amount"])
+            return True, MessageStatus.matched, pattern, details
+        else:
+            return True, MessageStatus.rejected, pattern, None
     return False, MessageStatus.unprocessed, None, None
 
 def isValidSender(sender: str):
-    senders = get_senders()
-    if "-" not in sender:
-        return False
-    for senderItem in senders:
-        if senderItem.comparison_type == SenderComparisonType.contains:
-            if senderItem.name.lower() in sender.lower():
-                if senderItem.status == SenderStatus.approved:
-                    return True
-                elif senderItem.status == SenderStatus.unprocessed:
-                    return True
-                else:
-                    return False
-    name = sender.split("-")[1]
-    senderObject = Sender(name=name)
-    add_sender(senderObject)
-    return False
+    return classifier.isValid(sender)
@@ -0,0 +1,92 @@
+import logging
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from db import get_patterns
+from models import Pattern
+
+# Distinct message senders seen by one engine; bank sender ids are a small set
+# in practice, this only guards against a flood of junk sender names.
+MAX_SENDER_ENTRIES = 4096
+
+
+class CompiledPattern():
+    def __init__(self, pattern: Pattern, regex: re.Pattern):
+        self.pattern = pattern
+        self.regex = regex
+        self.senderKey = normaliseSender(pattern.sender)
+
+
+def normaliseSender(sender: str) -> str:
+    return (sender or "").lower()
+
+
+class PatternEngine():
+    """
+    Compiled view over a pattern catalog.
+
+    Every regex is compiled once, and the patterns that apply to a message
+    sender are resolved once per distinct sender. A pattern applies when its
+    sender is contained in the message sender, same as the linear scan did,
+    and candidates keep the catalog order so the first matching pattern wins.
+    """
+
+    def __init__(self, patterns: List[Pattern]):
+        self.patterns = patterns
+        self.compiled: List[CompiledPattern] = []
+        for pattern in patterns:
+            try:
+                self.compiled.append(CompiledPattern(pattern, re.compile(pattern.pattern)))
+            except re.error as e:
+                logging.error(f"Regex error: {e} for pattern: {pattern.id} {pattern.pattern}")
+
+        self.senderKeys: Dict[str, List[CompiledPattern]] = {}
+        for compiled in self.compiled:
+            self.senderKeys.setdefault(compiled.senderKey, []).append(compiled)
+
+        self.bySender: Dict[str, List[CompiledPattern]] = {}
+        self.lock = threading.Lock()
+
+    def candidates(self, sender: str) -> List[CompiledPattern]:
+        sender = normaliseSender(sender)
+        candidates = self.bySender.get(sender)
+        if candidates is not None:
+            return candidates
+
+        keys = {key for key in self.senderKeys if key in sender}
+        candidates = [compiled for compiled in self.compiled if compiled.senderKey in keys]
+        with self.lock:
+            if len(self.bySender) >= MAX_SENDER_ENTRIES:
+                self.bySender.clear()
+            self.bySender[sender] = candidates
+        return candidates
+
+    def match(self, sender: str, sms: str) -> Tuple[Optional[Pattern], Dict]:
+        for compiled in self.candidates(sender):
+            match = compiled.regex.search(sms)
+            if match:
+                return compiled.pattern, match.groupdict()
+        return None, {}
+
+
+engine: Optional[PatternEngine] = None
+engineLock = threading.Lock()
+
+def get_pattern_engine() -> PatternEngine:
+    """
+    Returns the engine for the current pattern catalog, rebuilding it when
+    get_patterns() returns a different list than the one the engine was built
+    from. The db layer hands out a new list whenever the pattern cache is
+    cleared, so upserts and deletes swap in a fresh engine, while readers
+    keep using whichever engine they already picked up.
+    """
+    global engine
+    patterns = get_patterns()
+    current = engine
+    if current is not None and current.patterns is patterns:
+        return current
+    with engineLock:
+        if engine is None or engine.patterns is not patterns:
+            engine = PatternEngine(patterns)
+        return engine
@@ -0,0 +1,161 @@
+import collections
+import contextvars
+import cProfile
+import functools
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+from fastapi.concurrency import run_in_threadpool as _run_in_threadpool
+
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", 60))
+SAMPLE_INTERVAL_SECONDS = float(os.environ.get("PROFILE_SAMPLE_INTERVAL_SECONDS", 0.005))
+# Numbers in thread names, as in "parser_3" or "Thread-12 (target)", so a
+# pool or a kind of thread is one root
+THREAD_NUMBER = re.compile(r"_\d+$|^Thread-\d+ ")
+
+# One profile at a time, sampling or tracing
+busy = threading.Lock()
+
+
+def frame_name(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def sample_stacks(seconds: float, interval: float = SAMPLE_INTERVAL_SECONDS) -> Dict[str, int]:
+    """
+    Samples the stacks of every other thread each interval for seconds and
+    returns how often each was seen, keyed by the collapsed stack: the
+    thread's name, then the frames from the outermost in, separated by ";".
+    """
+    sampler = threading.get_ident()
+    counts = collections.Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: THREAD_NUMBER.sub("", thread.name) for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == sampler:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}"))
+            counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return counts
+
+def sample(seconds: float) -> Optional[str]:
+    """
+    Returns the collapsed stacks of seconds of sampling, one "stack count"
+    line each as flamegraph.pl and speedscope read them, or None when a
+    profile is already running.
+    """
+    if not busy.acquire(blocking=False):
+        return None
+    try:
+        counts = sample_stacks(seconds)
+    finally:
+        busy.release()
+    return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+
+class Trace():
+    """
+    cProfile of one request. The event loop thread is profiled from the
+    request's start to its response, other requests the loop serves
+    meanwhile included; work the request hands to run_in_threadpool is
+    profiled on its worker thread.
+    """
+
+    def __init__(self, route: str = ""):
+        self.route = route
+        self.profiles: List[cProfile.Profile] = []
+        self.lock = threading.Lock()
+        self.claimed = threading.Event()
+        self.done = threading.Event()
+        self.method = None
+        self.path = None
+        self.status = None
+
+    def start(self) -> cProfile.Profile:
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+        return profile
+
+    def profiled(self, func):
+        @functools.wraps(func)
+        def run(*args, **kwargs):
+            profile = self.start()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+        return run
+
+    def report(self, sort: str = "cumulative", limit: int = 50) -> str:
+        output = io.StringIO()
+        with self.lock:
+            stats = pstats.Stats(*self.profiles, stream=output)
+        output.write(f"{self.method} {self.path} -> {self.status}\n")
+        stats.sort_stats(sort).print_stats(limit)
+        return output.getvalue()
+
+
+armed: Optional[Trace] = None
+armedLock = threading.Lock()
+tracing: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("tracing", default=None)
+
+def claim(route: str) -> Optional[Trace]:
+    """
+    Returns the armed trace if it is for route (or any route), disarming it.
+    """
+    global armed
+    if armed is None:
+        return None
+    with armedLock:
+        trace = armed
+        if trace is None or (trace.route and trace.route != route):
+            return None
+        armed = None
+    trace.claimed.set()
+    return trace
+
+def trace_next(route: str, seconds: float) -> Optional[Trace]:
+    """
+    Traces the next request to route (any route when empty) that starts
+    within seconds and returns its Trace once it is done, or unclaimed or
+    unfinished after the wait. Returns None when a profile is already
+    running.
+    """
+    global armed
+    if not busy.acquire(blocking=False):
+        return None
+    trace = Trace(route)
+    try:
+        with armedLock:
+            armed = trace
+        if trace.claimed.wait(seconds):
+            trace.done.wait(PROFILE_MAX_SECONDS)
+    finally:
+        with armedLock:
+            if armed is trace:
+                armed = None
+        busy.release()
+    return trace
+
+def traced(func):
+    trace = tracing.get()
+    return trace.profiled(func) if trace else func
+
+async def run_in_threadpool(func, *args, **kwargs):
+    """
+    fastapi's run_in_threadpool, profiling func when the request is traced.
+    """
+    return await _run_in_threadpool(traced(func), *args, **kwargs)
@@ -0,0 +1,99 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional
+
+from models import RefreshReport
+from parser import processMessages
+from sharding import SHARD_COUNT, ShardWorker
+from storage import get_storage
+from usage import propagate
+
+REFRESH_WORKERS = int(os.environ.get("REFRESH_WORKERS", 4))
+REFRESH_USER_BUDGET_SECONDS = float(os.environ.get("REFRESH_USER_BUDGET_SECONDS", 120))
+
+
+class RefreshScheduler():
+    """
+    Processes many users' messages concurrently on a bounded pool.
+
+    Each user gets a time budget; a user still running past it is reported
+    as timed out and skipped by later runs until its work finishes, since a
+    running thread cannot be stopped. Only one run happens at a time.
+    """
+
+    def __init__(self, workers: int = REFRESH_WORKERS, budget: float = REFRESH_USER_BUDGET_SECONDS):
+        self.budget = budget
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="refresh")
+        self.running = threading.Lock()
+        self.lock = threading.Lock()
+        self.inFlight = set()
+        self.started: Dict[str, float] = {}
+
+    def refreshUser(self, email: str, full: bool, days_ago_start: int) -> RefreshReport:
+        start = time.monotonic()
+        with self.lock:
+            self.started[email] = start
+        try:
+            logging.info(f"Refreshing messages for email: {email}")
+            report = processMessages(email, full=full, days_ago_start=days_ago_start, wait=True)
+            return RefreshReport(email=email, duration=time.monotonic() - start, **report.dict())
+        except Exception as e:
+            logging.exception(f"Error refreshing messages for email: {email}")
+            return RefreshReport(email=email, status="error", error=str(e), duration=time.monotonic() - start)
+        finally:
+            with self.lock:
+                self.inFlight.discard(email)
+                self.started.pop(email, None)
+
+    def run(self, emails: List[str], full: bool = False, days_ago_start: int = 1) -> Optional[List[RefreshReport]]:
+        """
+        Refreshes the given users and returns one report per user, or None
+        when another run is still in progress.
+        """
+        if not self.running.acquire(blocking=False):
+            return None
+        try:
+            reports: Dict[str, RefreshReport] = {}
+            pending = {}
+            refreshUser = propagate(self.refreshUser)
+            for email in emails:
+                with self.lock:
+                    if email in self.inFlight:
+                        reports[email] = RefreshReport(email=email, status="skipped", error="Previous refresh still running")
+                        continue
+                    self.inFlight.add(email)
+                pending[self.executor.submit(refreshUser, email, full, days_ago_start)] = email
+
+            while pending:
+                done, _ = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    reports[pending.pop(future)] = future.result()
+                now = time.monotonic()
+                for future, email in list(pending.items()):
+                    with self.lock:
+                        started = self.started.get(email)
+                    if started is not None and now - started > self.budget:
+                        logging.warning(f"Refresh for email: {email} exceeded {self.budget}s budget")
+                        reports[email] = RefreshReport(email=email, status="timeout", duration=now - started)
+                        del pending[future]
+
+            return [reports[email] for email in emails]
+        finally:
+            self.running.release()
+
+
+scheduler = RefreshScheduler()
+shardWorker = ShardWorker(get_storage().lease_store()) if SHARD_COUNT else None
+
+def refresh_all(emails: List[str], full: bool = False) -> Optional[List[RefreshReport]]:
+    """
+    Refreshes the users this node is responsible for. With REFRESH_SHARDS
+    set, that is only the users of the shards it leases for this cycle, and
+    other replicas pick up the rest.
+    """
+    if shardWorker is None:
+        return scheduler.run(emails, full=full)
+    return shardWorker.run(emails, lambda shardEmails: scheduler.run(shardEmails, full=full))
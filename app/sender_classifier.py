@@ -0,0 +1,115 @@
+import threading
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional
+
+from db import add_sender, get_senders
+from models import Sender, SenderComparisonType, SenderStatus
+
+# Unknown sender names already handed to add_sender by this process
+MAX_REGISTERED_UNKNOWN = 10000
+
+NO_MATCH = -1
+
+
+class SenderAutomaton():
+    """
+    Aho-Corasick automaton over the lower-cased sender names.
+
+    Each state remembers the lowest catalog index among the names that end
+    there (directly or via its failure links), so a single pass over the
+    message sender finds the same sender the old linear "contains" scan would
+    have stopped at: the first one in catalog order.
+    """
+
+    def __init__(self, senders: List[Sender]):
+        self.senders = senders
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.best: List[int] = [NO_MATCH]
+
+        for index, sender in enumerate(senders):
+            if sender.comparison_type != SenderComparisonType.contains:
+                continue
+            state = 0
+            for char in sender.name.lower():
+                nextState = self.goto[state].get(char)
+                if nextState is None:
+                    nextState = len(self.goto)
+                    self.goto[state][char] = nextState
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.best.append(NO_MATCH)
+                state = nextState
+            if self.best[state] == NO_MATCH:
+                self.best[state] = index
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nextState in self.goto[state].items():
+                queue.append(nextState)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                failState = self.goto[fallback].get(char, 0)
+                self.fail[nextState] = failState if failState != nextState else 0
+            inherited = self.best[self.fail[state]]
+            if inherited != NO_MATCH and (self.best[state] == NO_MATCH or inherited < self.best[state]):
+                self.best[state] = inherited
+
+    def find(self, text: str) -> Optional[Sender]:
+        best = self.best[0]
+        state = 0
+        for char in text.lower():
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            found = self.best[state]
+            if found != NO_MATCH and (best == NO_MATCH or found < best):
+                best = found
+                if best == 0:
+                    break
+        if best == NO_MATCH:
+            return None
+        return self.senders[best]
+
+
+class SenderClassifier():
+    def __init__(self):
+        self.automaton: Optional[SenderAutomaton] = None
+        self.registered = OrderedDict()
+        self.lock = threading.Lock()
+
+    def getAutomaton(self) -> SenderAutomaton:
+        # get_senders() returns a new list whenever the sender cache is
+        # cleared, which is the signal to rebuild the automaton
+        senders = get_senders()
+        automaton = self.automaton
+        if automaton is not None and automaton.senders is senders:
+            return automaton
+        with self.lock:
+            if self.automaton is None or self.automaton.senders is not senders:
+                self.automaton = SenderAutomaton(senders)
+            return self.automaton
+
+    def isValid(self, sender: str) -> bool:
+        if "-" not in sender:
+            return False
+        senderItem = self.getAutomaton().find(sender)
+        if senderItem:
+            return senderItem.status in (SenderStatus.approved, SenderStatus.unprocessed)
+        self.register(sender.split("-")[1])
+        return False
+
+    def register(self, name: str):
+        with self.lock:
+            if name in self.registered:
+                self.registered.move_to_end(name)
+                return
+            self.registered[name] = True
+            if len(self.registered) > MAX_REGISTERED_UNKNOWN:
+                self.registered.popitem(last=False)
+        add_sender(Sender(name=name))
+
+
+classifier = SenderClassifier()
@@ -0,0 +1,234 @@
+import hashlib
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+from google.cloud import firestore
+
+# 0 turns sharding off, every replica then refreshes every user
+SHARD_COUNT = int(os.environ.get("REFRESH_SHARDS", 0))
+LEASE_SECONDS = float(os.environ.get("REFRESH_LEASE_SECONDS", 120))
+# A shard is refreshed once per cycle, however many replicas are triggered
+CYCLE_SECONDS = float(os.environ.get("REFRESH_CYCLE_SECONDS", 300))
+
+
+def shard_of(email: str, shards: int) -> int:
+    # Stable across processes, unlike hash()
+    return int(hashlib.md5(email.encode()).hexdigest()[:8], 16) % shards
+
+def node_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+def can_claim(lease: Optional[Dict], owner: str, cycle: int, now: float) -> bool:
+    if not lease:
+        return True
+    if lease.get("cycle", -1) >= cycle:
+        return False
+    # A live lease is not re-entered even by its owner, so two runs on one
+    # node never work on the same shard
+    return not lease.get("owner") or lease.get("leaseUntil", 0) < now
+
+
+class FirestoreLeaseStore():
+    """
+    Leases kept in the "lease" collection, one document per shard, changed
+    only inside Firestore transactions.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def ref(self, shard: int):
+        return self.client.collection("lease").document(str(shard))
+
+    def claim(self, shard: int, owner: str, cycle: int, now: float, seconds: float) -> bool:
+        @firestore.transactional
+        def claim_in(transaction):
+            snapshot = self.ref(shard).get(transaction=transaction)
+            lease = snapshot.to_dict() if snapshot.exists else None
+            if not can_claim(lease, owner, cycle, now):
+                return False
+            transaction.set(self.ref(shard), {"owner": owner, "leaseUntil": now + seconds}, merge=True)
+            return True
+        return claim_in(self.client.transaction())
+
+    def renew(self, shard: int, owner: str, now: float, seconds: float) -> bool:
+        @firestore.transactional
+        def renew_in(transaction):
+            snapshot = self.ref(shard).get(transaction=transaction)
+            if not snapshot.exists or snapshot.to_dict().get("owner") != owner:
+                return False
+            transaction.update(self.ref(shard), {"leaseUntil": now + seconds})
+            return True
+        return renew_in(self.client.transaction())
+
+    def release(self, shard: int, owner: str, cycle: Optional[int] = None):
+        @firestore.transactional
+        def release_in(transaction):
+            snapshot = self.ref(shard).get(transaction=transaction)
+            if not snapshot.exists or snapshot.to_dict().get("owner") != owner:
+                return
+            update = {"owner": "", "leaseUntil": 0}
+            if cycle is not None:
+                update["cycle"] = cycle
+            transaction.update(self.ref(shard), update)
+        release_in(self.client.transaction())
+
+
+class LocalLeaseStore():
+    """
+    Stand-in lease store over a dict and a lock. Given a
+    multiprocessing.Manager dict and lock it is shared by worker processes,
+    which is how the sharding is exercised locally without Firestore.
+    """
+
+    def __init__(self, leases=None, lock=None):
+        self.leases = leases if leases is not None else {}
+        self.lock = lock if lock is not None else threading.Lock()
+
+    def claim(self, shard: int, owner: str, cycle: int, now: float, seconds: float) -> bool:
+        with self.lock:
+            lease = self.leases.get(shard)
+            if not can_claim(lease, owner, cycle, now):
+                return False
+            self.leases[shard] = {**(lease or {}), "owner": owner, "leaseUntil": now + seconds}
+            return True
+
+    def renew(self, shard: int, owner: str, now: float, seconds: float) -> bool:
+        with self.lock:
+            lease = self.leases.get(shard)
+            if not lease or lease.get("owner") != owner:
+                return False
+            self.leases[shard] = {**lease, "leaseUntil": now + seconds}
+            return True
+
+    def release(self, shard: int, owner: str, cycle: Optional[int] = None):
+        with self.lock:
+            lease = self.leases.get(shard)
+            if not lease or lease.get("owner") != owner:
+                return
+            lease = {**lease, "owner": "", "leaseUntil": 0}
+            if cycle is not None:
+                lease["cycle"] = cycle
+            self.leases[shard] = lease
+
+
+class ShardWorker():
+    """
+    Partitions users into shards and refreshes only the shards this node
+    manages to lease for the current cycle. A lease is renewed while its
+    shard is being processed and marked done for the cycle afterwards; a
+    lease left behind by a dead node expires and another node takes over.
+    """
+
+    def __init__(self, store, shards: int = SHARD_COUNT, leaseSeconds: float = LEASE_SECONDS,
+                 cycleSeconds: float = CYCLE_SECONDS, owner: Optional[str] = None):
+        self.store = store
+        self.shards = shards
+        self.leaseSeconds = leaseSeconds
+        self.cycleSeconds = cycleSeconds
+        self.owner = owner or node_id()
+
+    def run(self, emails: List[str], process: Callable[[List[str]], Optional[List]]) -> List:
+        """
+        Calls process with the users of every shard leased by this node and
+        returns the concatenated results. process returning None means the
+        shard was not handled, its lease is released for someone else.
+        """
+        cycle = int(time.time() // self.cycleSeconds)
+        byShard: Dict[int, List[str]] = {}
+        for email in emails:
+            byShard.setdefault(shard_of(email, self.shards), []).append(email)
+
+        shards = list(byShard)
+        # Different nodes start from different shards to spread the claims
+        random.shuffle(shards)
+        results = []
+        for shard in shards:
+            if not self.store.claim(shard, self.owner, cycle, time.time(), self.leaseSeconds):
+                continue
+            logging.info(f"{self.owner} leased shard {shard} with {len(byShard[shard])} emails for cycle {cycle}")
+            done = threading.Event()
+            heartbeat = threading.Thread(target=self.renew, args=(shard, done), name=f"lease-{shard}", daemon=True)
+            heartbeat.start()
+            try:
+                shardResults = process(byShard[shard])
+            except Exception:
+                logging.exception(f"Error processing shard {shard}")
+                shardResults = None
+            finally:
+                done.set()
+                heartbeat.join()
+            if shardResults is None:
+                self.store.release(shard, self.owner)
+                continue
+            self.store.release(shard, self.owner, cycle)
+            results.extend(shardResults)
+        return results
+
+    def renew(self, shard: int, done: threading.Event):
+        while not done.wait(self.leaseSeconds / 3):
+            if not self.store.renew(shard, self.owner, time.time(), self.leaseSeconds):
+                logging.warning(f"{self.owner} lost the lease on shard {shard}")
+                return
+
+
+def simulate_worker(leases, lock, emails, processed, shards, leaseSeconds, crash=False):
+    store = LocalLeaseStore(leases, lock)
+    worker = ShardWorker(store, shards=shards, leaseSeconds=leaseSeconds, cycleSeconds=3600)
+
+    def process(shardEmails):
+        if crash:
+            # Die while holding the lease, without releasing it
+            os._exit(1)
+        time.sleep(0.01)
+        processed.extend([(email, worker.owner) for email in shardEmails])
+        return shardEmails
+
+    worker.run(emails, process)
+
+if __name__ == "__main__":
+    # Local check: several processes share one in-memory lease store, one of
+    # them dies holding a lease; every user must end up processed once
+    import argparse
+    import multiprocessing
+
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument("--workers", type=int, default=4)
+    argParser.add_argument("--users", type=int, default=100)
+    argParser.add_argument("--shards", type=int, default=16)
+    args = argParser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    leaseSeconds = 1
+    emails = [f"user{index}@example.com" for index in range(args.users)]
+    with multiprocessing.Manager() as manager:
+        leases, lock, processed = manager.dict(), manager.Lock(), manager.list()
+        crashing = multiprocessing.Process(target=simulate_worker, args=(leases, lock, emails, processed, args.shards, leaseSeconds, True))
+        crashing.start()
+        crashing.join()
+
+        workers = [multiprocessing.Process(target=simulate_worker, args=(leases, lock, emails, processed, args.shards, leaseSeconds))
+                   for _ in range(args.workers)]
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join()
+        # The crashed node's lease has expired by now
+        time.sleep(leaseSeconds)
+        simulate_worker(leases, lock, emails, processed, args.shards, leaseSeconds)
+
+        counts: Dict[str, int] = {}
+        for email, _ in processed:
+            counts[email] = counts.get(email, 0) + 1
+        owners = {owner for _, owner in processed}
+        duplicates = [email for email, count in counts.items() if count > 1]
+        missing = [email for email in emails if email not in counts]
+        print(f"{len(counts)} users processed by {len(owners)} nodes, {len(duplicates)} duplicated, {len(missing)} missing")
+        if duplicates or missing:
+            raise SystemExit(1)
@@ -0,0 +1,359 @@
+import abc
+import os
+import threading
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
+
+from models import BatchChunkResult, BatchWriteResult, CategoryEntry, Message, Pattern, Sender, Transaction
+from summary import Delta
+
+# "firestore", "sqlite" or "memory"
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "firestore")
+
+
+class Storage(abc.ABC):
+    """
+    Everything db.py reads and writes, per entity, so the service can run on
+    another store than Firestore. Caching, the in-memory transaction store
+    and the summary bookkeeping stay in db.py, on top of this.
+
+    Timestamps are epoch seconds. Lists of messages and transactions come
+    newest first.
+    """
+
+    # Messages
+    @abc.abstractmethod
+    def new_message_id(self, email: str) -> str:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def list_messages(self, email: str, since: int, limit: Optional[int] = None) -> List[Message]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def list_messages_with_status(self, email: str, status: str, since: int) -> List[Message]:
+        """
+        The messages with the status and timestamp >= since.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def save_message(self, email: str, message_id: str, entry: Dict):
+        """
+        Creates the message, or merges entry into it when it exists.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def update_message_statuses(self, email: str, updates: List[Tuple[str, str, str]]) -> BatchWriteResult:
+        """
+        Applies (message_id, status, matchedPattern) updates; updates of
+        messages that do not exist fail.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_message_status(self, email: str, message_id: str, status: str, matchedPattern: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def list_emails(self) -> List[str]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_watermark(self, email: str) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_watermark(self, email: str, timestamp: int):
+        raise NotImplementedError
+
+    # Catalogs
+    @abc.abstractmethod
+    def list_categories(self, email: str) -> List[CategoryEntry]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def save_category(self, email: str, categoryEntry: CategoryEntry):
+        """
+        Replaces the category with the entry's id, or adds it as a new one.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_category(self, email: str, category_id: str) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def list_senders(self) -> List[Sender]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_sender(self, sender: Sender) -> bool:
+        """
+        Adds the sender unless one with its name exists. Returns whether it
+        was added.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def save_senders(self, senders: List[Sender]):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def list_patterns(self) -> List[Pattern]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def save_pattern(self, pattern: Pattern):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_pattern(self, pattern_id: str) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def list_merchants(self) -> Dict[str, Dict]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def save_merchant(self, merchant: str, category: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_user(self, email: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    # Transactions
+    @abc.abstractmethod
+    def get_transaction(self, email: str, transaction_id: str) -> Optional[Transaction]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_transactions_by_id(self, email: str, transaction_ids: List[str]) -> Dict[str, Transaction]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def save_transactions(self, email: str, transactions: List[Transaction]) -> BatchWriteResult:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def query_transactions(self, email: str, start: Optional[int] = None, end: Optional[int] = None) -> List[Transaction]:
+        """
+        Transactions with start <= timestamp < end, either bound optional.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def stream_transactions(self, email: str, from_ts: Optional[int] = None, to_ts: Optional[int] = None) -> Iterator[Transaction]:
+        """
+        Yields the transactions with from_ts <= timestamp <= to_ts.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def query_transactions_page(self, email: str, from_ts: Optional[int], to_ts: Optional[int], limit: int,
+                                after: Optional[Tuple[int, str]] = None) -> List[Transaction]:
+        """
+        Up to limit transactions with from_ts <= timestamp <= to_ts, ordered
+        by (timestamp, id) newest first, that come after the (timestamp, id)
+        key "after".
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def update_transaction(self, email: str, transaction_id: str, transaction: Transaction,
+                           delta: Callable[[Optional[Transaction], Transaction], Delta], fields: Optional[Set[str]] = None,
+                           only_if: Optional[Callable[[Optional[Transaction]], bool]] = None) -> Optional[Transaction]:
+        """
+        Merges transaction, or only its fields when given, into the stored
+        one and applies delta(stored, merged) to the monthly summaries,
+        atomically. With only_if nothing is written unless only_if(stored)
+        holds. Returns the merged transaction, None when nothing was written.
+        """
+        raise NotImplementedError
+
+    # Monthly summaries, stored as the nested maps of summary.increments()
+    @abc.abstractmethod
+    def get_summary(self, email: str, month: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_summary(self, email: str, month: str, data: Dict, generation: int) -> bool:
+        """
+        Replaces the summary, unless its generation (0 for a missing
+        summary) is no longer generation. Returns whether it was replaced.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def increment_summaries(self, email: str, delta: Delta) -> BatchWriteResult:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_summaries(self, email: str, months: List[str]):
+        raise NotImplementedError
+
+    # SMS hashes, as {"messageId", "timestamp"} per digest
+    @abc.abstractmethod
+    def get_sms_hashes(self, email: str, digests: List[str]) -> Dict[str, Dict]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def create_sms_hash(self, email: str, digest: str, data: Dict) -> bool:
+        """
+        Stores the hash unless it exists. Returns whether it was stored.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_sms_hashes(self, email: str, hashes: Dict[str, Dict]) -> BatchWriteResult:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_sms_hash(self, email: str, digest: str):
+        raise NotImplementedError
+
+    # Enrichment queue
+    @abc.abstractmethod
+    def queue_enrichments(self, email: str, transaction_ids: List[str], now: float) -> int:
+        """
+        Queues the transactions not in the queue yet. Returns how many were
+        queued.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def pending_enrichments(self, limit: int, now: float) -> List[Dict]:
+        """
+        Up to limit claimable items: running ones whose lease ran out before
+        now, then pending ones due by now, the longest due first.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def claim_enrichment(self, item_id: str, owner: str, now: float, seconds: float) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def complete_enrichment(self, item_id: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def retry_enrichment(self, item_id: str, update: Dict):
+        raise NotImplementedError
+
+    # Refresh leases, see sharding.py
+    @abc.abstractmethod
+    def lease_store(self):
+        raise NotImplementedError
+
+    # Async counterparts of the calls the request handlers make through
+    # db_async.py. These run the blocking method on the thread pool; a
+    # backend with an async client overrides them.
+    async def list_messages_async(self, email: str, since: int, limit: Optional[int] = None) -> List[Message]:
+        return await run_in_threadpool(self.list_messages, email, since, limit)
+
+    async def list_emails_async(self) -> List[str]:
+        return await run_in_threadpool(self.list_emails)
+
+    async def list_categories_async(self, email: str) -> List[CategoryEntry]:
+        return await run_in_threadpool(self.list_categories, email)
+
+    async def list_senders_async(self) -> List[Sender]:
+        return await run_in_threadpool(self.list_senders)
+
+    async def list_patterns_async(self) -> List[Pattern]:
+        return await run_in_threadpool(self.list_patterns)
+
+    async def list_merchants_async(self) -> Dict[str, Dict]:
+        return await run_in_threadpool(self.list_merchants)
+
+    async def get_user_async(self, email: str) -> Optional[Dict]:
+        return await run_in_threadpool(self.get_user, email)
+
+    async def get_transaction_async(self, email: str, transaction_id: str) -> Optional[Transaction]:
+        return await run_in_threadpool(self.get_transaction, email, transaction_id)
+
+    async def get_transactions_by_id_async(self, email: str, transaction_ids: List[str]) -> Dict[str, Transaction]:
+        return await run_in_threadpool(self.get_transactions_by_id, email, transaction_ids)
+
+    async def save_transactions_async(self, email: str, transactions: List[Transaction]) -> BatchWriteResult:
+        return await run_in_threadpool(self.save_transactions, email, transactions)
+
+    async def query_transactions_async(self, email: str, start: Optional[int] = None, end: Optional[int] = None) -> List[Transaction]:
+        return await run_in_threadpool(self.query_transactions, email, start, end)
+
+    async def stream_transactions_async(self, email: str, from_ts: Optional[int] = None, to_ts: Optional[int] = None) -> AsyncIterator[Transaction]:
+        async for transaction in iterate_in_threadpool(self.stream_transactions(email, from_ts, to_ts)):
+            yield transaction
+
+    async def query_transactions_page_async(self, email: str, from_ts: Optional[int], to_ts: Optional[int], limit: int,
+                                            after: Optional[Tuple[int, str]] = None) -> List[Transaction]:
+        return await run_in_threadpool(self.query_transactions_page, email, from_ts, to_ts, limit, after)
+
+    async def get_summary_async(self, email: str, month: str) -> Optional[Dict]:
+        return await run_in_threadpool(self.get_summary, email, month)
+
+    async def set_summary_async(self, email: str, month: str, data: Dict, generation: int) -> bool:
+        return await run_in_threadpool(self.set_summary, email, month, data, generation)
+
+    async def increment_summaries_async(self, email: str, delta: Delta) -> BatchWriteResult:
+        return await run_in_threadpool(self.increment_summaries, email, delta)
+
+    async def delete_summaries_async(self, email: str, months: List[str]):
+        await run_in_threadpool(self.delete_summaries, email, months)
+
+
+def written(count: int) -> BatchWriteResult:
+    """
+    The result of count writes committed at once, for the backends that
+    commit every write of a call in one go.
+    """
+    if not count:
+        return BatchWriteResult()
+    return BatchWriteResult(chunks=[BatchChunkResult(index=0, size=count, success=True)], written=count)
+
+def can_claim_enrichment(item: Optional[Dict], now: float) -> bool:
+    if not item:
+        return False
+    if item.get("status") == "pending":
+        return item.get("nextAttempt", 0) <= now
+    if item.get("status") == "running":
+        return item.get("leaseUntil", 0) < now
+    return False
+
+
+_storage: Optional[Storage] = None
+_lock = threading.Lock()
+
+def get_storage() -> Storage:
+    """
+    Returns the STORAGE_BACKEND storage, created on first use.
+    """
+    global _storage
+    if _storage is None:
+        with _lock:
+            if _storage is None:
+                if STORAGE_BACKEND == "sqlite":
+                    from storage_sqlite import SQLiteStorage
+                    _storage = SQLiteStorage()
+                elif STORAGE_BACKEND == "memory":
+                    from storage_memory import MemoryStorage
+                    _storage = MemoryStorage()
+                elif STORAGE_BACKEND == "firestore":
+                    from storage_firestore import FirestoreStorage
+                    _storage = FirestoreStorage()
+                else:
+                    raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+    return _storage
+
+def set_storage(storage: Storage):
+    """
+    Replaces the storage every later get_storage() returns, for benchmarks
+    and load tests that prepare their own store.
+    """
+    global _storage
+    with _lock:
+        _storage = storage
@@ -0,0 +1,519 @@
+import asyncio
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from firebase_admin import firestore, firestore_async
+from google.api_core.exceptions import AlreadyExists
+from google.cloud.firestore import async_transactional
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from batch_writer import UPDATE, AsyncBatchWriter, BatchWriter
+from models import BatchWriteResult, CategoryEntry, Message, Pattern, Sender, Transaction
+from sharding import FirestoreLeaseStore
+from storage import Storage, can_claim_enrichment
+from summary import increments
+from usage import committed, counted, counted_async, record
+
+
+class FirestoreStorage(Storage):
+    """
+    The Firestore collections the service has always used. The clients are
+    created on first use rather than at import; the *_async methods go
+    through the async client, on the event loop.
+    """
+
+    def __init__(self, client=None, asyncClient=None):
+        self._client = client
+        self._asyncClient = asyncClient
+        self._writer = None
+        self._asyncWriter = None
+        self._leases = None
+        self.lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self.lock:
+                if self._client is None:
+                    self._client = firestore.client()
+        return self._client
+
+    @property
+    def writer(self) -> BatchWriter:
+        if self._writer is None:
+            with self.lock:
+                if self._writer is None:
+                    self._writer = BatchWriter(self.client)
+        return self._writer
+
+    @property
+    def asyncClient(self):
+        if self._asyncClient is None:
+            with self.lock:
+                if self._asyncClient is None:
+                    self._asyncClient = firestore_async.client()
+        return self._asyncClient
+
+    @property
+    def asyncWriter(self) -> AsyncBatchWriter:
+        if self._asyncWriter is None:
+            with self.lock:
+                if self._asyncWriter is None:
+                    self._asyncWriter = AsyncBatchWriter(self.asyncClient)
+        return self._asyncWriter
+
+    # The references are built on the blocking client unless given another
+    def messages(self, email, client=None):
+        return (client or self.client).collection("sms").document(email).collection("messages")
+
+    def transactions(self, email, client=None):
+        return (client or self.client).collection("transaction").document(email).collection("transaction")
+
+    def summary_ref(self, email, month, client=None):
+        return (client or self.client).collection("summary").document(email).collection("months").document(month)
+
+    def sms_hash_ref(self, email, digest):
+        return self.client.collection("sms_hash").document(email).collection("hashes").document(digest)
+
+    def enrichment_ref(self, item_id):
+        return self.client.collection("enrichment").document(item_id)
+
+    # Reads and writes of documents are recorded against the current request
+    def get(self, ref, **kwargs):
+        record(reads=1)
+        return ref.get(**kwargs)
+
+    def get_all(self, refs):
+        record(reads=len(refs))
+        return self.client.get_all(refs)
+
+    def set(self, ref, data, **kwargs):
+        record(writes=1)
+        ref.set(data, **kwargs)
+
+    def delete(self, ref):
+        record(deletes=1)
+        ref.delete()
+
+    # Firestore retries a transaction that lost a race, only the attempt that
+    # committed is recorded: function(firestore_transaction, attempt) notes
+    # its reads and writes in attempt, which starts empty every time
+    def transact(self, function):
+        attempt = {}
+
+        @firestore.transactional
+        def run(firestore_transaction):
+            attempt.clear()
+            return function(firestore_transaction, attempt)
+        result = run(self.client.transaction())
+        committed(attempt)
+        return result
+
+    async def transact_async(self, function):
+        attempt = {}
+
+        @async_transactional
+        async def run(firestore_transaction):
+            attempt.clear()
+            return await function(firestore_transaction, attempt)
+        result = await run(self.asyncClient.transaction())
+        committed(attempt)
+        return result
+
+    async def get_async(self, ref, **kwargs):
+        record(reads=1)
+        return await ref.get(**kwargs)
+
+    def get_all_async(self, refs):
+        record(reads=len(refs))
+        return self.asyncClient.get_all(refs)
+
+    async def delete_async(self, ref):
+        record(deletes=1)
+        await ref.delete()
+
+    # Messages
+    def new_message_id(self, email: str) -> str:
+        return self.messages(email).document().id
+
+    def list_messages(self, email: str, since: int, limit: Optional[int] = None) -> List[Message]:
+        query = self.messages(email).where(filter=FieldFilter("timestamp", ">=", since)).order_by("timestamp", direction=firestore.Query.DESCENDING)
+        if limit:
+            query = query.limit(limit)
+        messages = []
+        for doc in counted(query.stream()):
+            doc_dict = doc.to_dict()
+            doc_dict["id"] = doc.id
+            messages.append(Message(**doc_dict))
+        return messages
+
+    def list_messages_with_status(self, email: str, status: str, since: int) -> List[Message]:
+        # Needs the (status, timestamp) composite index of functions/firestore.indexes.json
+        query = (
+            self.messages(email)
+            .where(filter=FieldFilter("status", "==", status))
+            .where(filter=FieldFilter("timestamp", ">=", since))
+            .order_by("timestamp", direction=firestore.Query.DESCENDING)
+        )
+        messages = []
+        for doc in counted(query.stream()):
+            doc_dict = doc.to_dict()
+            doc_dict["id"] = doc.id
+            messages.append(Message(**doc_dict))
+        return messages
+
+    def save_message(self, email: str, message_id: str, entry: Dict):
+        self.set(self.messages(email).document(message_id), entry, merge=True)
+
+    def update_message_statuses(self, email: str, updates: List[Tuple[str, str, str]]) -> BatchWriteResult:
+        collection = self.messages(email)
+        writes = [(collection.document(message_id), {"status": status, "matchedPattern": matchedPattern}) for message_id, status, matchedPattern in updates]
+        return self.writer.commit(writes, op=UPDATE)
+
+    def set_message_status(self, email: str, message_id: str, status: str, matchedPattern: str):
+        self.set(self.messages(email).document(message_id), {"status": status, "matchedPattern": matchedPattern}, merge=True)
+
+    def list_emails(self) -> List[str]:
+        return [doc.id for doc in counted(self.client.collection("sms").stream())]
+
+    def get_watermark(self, email: str) -> int:
+        watermark = self.get(self.client.collection("watermark").document(email))
+        if watermark.exists:
+            return watermark.to_dict().get("messages", 0)
+        return 0
+
+    def set_watermark(self, email: str, timestamp: int):
+        self.set(self.client.collection("watermark").document(email), {"messages": timestamp}, merge=True)
+
+    # Catalogs
+    def list_categories(self, email: str) -> List[CategoryEntry]:
+        categories = []
+        for doc in counted(self.client.collection("category").document(email).collection("categories").order_by("category").stream()):
+            doc_dict = doc.to_dict()
+            doc_dict["id"] = doc.id
+            categories.append(CategoryEntry(**doc_dict))
+        return categories
+
+    def save_category(self, email: str, categoryEntry: CategoryEntry):
+        category_collection = self.client.collection("category").document(email).collection("categories")
+        if categoryEntry.id and self.get(category_collection.document(categoryEntry.id)).exists:
+            self.set(category_collection.document(categoryEntry.id), categoryEntry.dict())
+        else:
+            record(writes=1)
+            category_collection.add(categoryEntry.dict())
+
+    def delete_category(self, email: str, category_id: str) -> bool:
+        category_ref = self.client.collection("category").document(email).collection("categories").document(category_id)
+        if self.get(category_ref).exists:
+            self.delete(category_ref)
+            return True
+        return False
+
+    def list_senders(self) -> List[Sender]:
+        senders = []
+        for doc in counted(self.client.collection("sender").stream()):
+            doc_dict = doc.to_dict()
+            doc_dict["id"] = doc.id
+            senders.append(Sender(**doc_dict))
+        return senders
+
+    def add_sender(self, sender: Sender) -> bool:
+        sender_ref = self.client.collection("sender").document(sender.name)
+        if self.get(sender_ref).exists:
+            return False
+        self.set(sender_ref, sender.dict())
+        return True
+
+    def save_senders(self, senders: List[Sender]):
+        sender_collection = self.client.collection("sender")
+        for sender in senders:
+            self.set(sender_collection.document(sender.name), sender.dict())
+
+    def list_patterns(self) -> List[Pattern]:
+        patterns = []
+        for doc in counted(self.client.collection("pattern").order_by("action").stream()):
+            doc_dict = doc.to_dict()
+            doc_dict["id"] = doc.id
+            patterns.append(Pattern(**doc_dict))
+        return patterns
+
+    def save_pattern(self, pattern: Pattern):
+        pattern_collection = self.client.collection("pattern")
+        if pattern.id and self.get(pattern_collection.document(pattern.id)).exists:
+            self.set(pattern_collection.document(pattern.id), pattern.dict())
+        else:
+            record(writes=1)
+            pattern_collection.add(pattern.dict())
+
+    def delete_pattern(self, pattern_id: str) -> bool:
+        pattern_ref = self.client.collection("pattern").document(pattern_id)
+        if self.get(pattern_ref).exists:
+            self.delete(pattern_ref)
+            return True
+        return False
+
+    def list_merchants(self) -> Dict[str, Dict]:
+        return {doc.id: doc.to_dict() for doc in counted(self.client.collection("merchant").stream())}
+
+    def save_merchant(self, merchant: str, category: str):
+        self.set(self.client.collection("merchant").document(merchant), {"category": category}, merge=True)
+
+    def get_user(self, email: str) -> Optional[Dict]:
+        user = self.get(self.client.collection("users").document(email))
+        if user.exists:
+            return user.to_dict()
+        return None
+
+    # Transactions
+    def get_transaction(self, email: str, transaction_id: str) -> Optional[Transaction]:
+        transaction = self.get(self.transactions(email).document(transaction_id))
+        if transaction.exists:
+            return Transaction(**transaction.to_dict())
+        return None
+
+    def get_transactions_by_id(self, email: str, transaction_ids: List[str]) -> Dict[str, Transaction]:
+        collection = self.transactions(email)
+        refs = [collection.document(transaction_id) for transaction_id in set(transaction_ids)]
+        transactions = {}
+        for doc in self.get_all(refs):
+            if doc.exists:
+                transactions[doc.id] = Transaction(**doc.to_dict())
+        return transactions
+
+    def save_transactions(self, email: str, transactions: List[Transaction]) -> BatchWriteResult:
+        collection = self.transactions(email)
+        return self.writer.commit([(collection.document(transaction.id), transaction.dict()) for transaction in transactions])
+
+    def transaction_query(self, email, start=None, end=None, inclusiveEnd=False, client=None):
+        query = self.transactions(email, client).order_by("timestamp", direction=firestore.Query.DESCENDING)
+        if start is not None:
+            query = query.where(filter=FieldFilter("timestamp", ">=", start))
+        if end is not None:
+            query = query.where(filter=FieldFilter("timestamp", "<=" if inclusiveEnd else "<", end))
+        return query
+
+    def query_transactions(self, email: str, start: Optional[int] = None, end: Optional[int] = None) -> List[Transaction]:
+        return [Transaction(**doc.to_dict()) for doc in counted(self.transaction_query(email, start, end).stream())]
+
+    def stream_transactions(self, email: str, from_ts: Optional[int] = None, to_ts: Optional[int] = None):
+        for doc in counted(self.transaction_query(email, from_ts, to_ts, inclusiveEnd=True).stream()):
+            yield Transaction(**doc.to_dict())
+
+    def transaction_page_query(self, email, from_ts, to_ts, limit, after=None, client=None):
+        # Transactions are stored under their id, so the document name breaks
+        # timestamp ties the way the in-memory store does
+        query = self.transaction_query(email, from_ts, to_ts, inclusiveEnd=True, client=client).order_by(FieldPath.document_id(), direction=firestore.Query.DESCENDING)
+        if after is not None:
+            query = query.start_after({"timestamp": after[0], FieldPath.document_id(): after[1]})
+        return query.limit(limit)
+
+    def query_transactions_page(self, email, from_ts, to_ts, limit, after=None) -> List[Transaction]:
+        return [Transaction(**doc.to_dict()) for doc in counted(self.transaction_page_query(email, from_ts, to_ts, limit, after).stream())]
+
+    def update_transaction(self, email, transaction_id, transaction, delta, fields=None, only_if=None):
+        transaction_ref = self.transactions(email).document(transaction_id)
+        data = transaction.dict(include=fields)
+
+        # Read the stored transaction in the same Firestore transaction so the
+        # summary delta is taken against what is actually being overwritten
+        def update_in(firestore_transaction, attempt):
+            snapshot = transaction_ref.get(transaction=firestore_transaction)
+            attempt["reads"] = 1
+            old = Transaction(**snapshot.to_dict()) if snapshot.exists else None
+            if only_if is not None and not only_if(old):
+                return None
+            new = Transaction(**{**(snapshot.to_dict() or {}), **data})
+            firestore_transaction.set(transaction_ref, data, merge=True)
+            months = delta(old, new)
+            for month, buckets in months.items():
+                firestore_transaction.set(self.summary_ref(email, month), increments(buckets, firestore.Increment), merge=True)
+            attempt["writes"] = 1 + len(months)
+            return new
+        return self.transact(update_in)
+
+    # Monthly summaries
+    def get_summary(self, email: str, month: str) -> Optional[Dict]:
+        snapshot = self.get(self.summary_ref(email, month))
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def set_summary(self, email: str, month: str, data: Dict, generation: int) -> bool:
+        summary_ref = self.summary_ref(email, month)
+
+        def set_in(firestore_transaction, attempt):
+            snapshot = summary_ref.get(transaction=firestore_transaction)
+            attempt["reads"] = 1
+            if (snapshot.to_dict() or {}).get("generation", 0) != generation:
+                return False
+            firestore_transaction.set(summary_ref, data)
+            attempt["writes"] = 1
+            return True
+        return self.transact(set_in)
+
+    def increment_summaries(self, email, delta) -> BatchWriteResult:
+        # An increment retried after an ambiguous failure could count twice,
+        # the caller resets the months on any failure instead
+        return self.writer.commit([(self.summary_ref(email, month), increments(buckets, firestore.Increment)) for month, buckets in delta.items()], retry=False)
+
+    def delete_summaries(self, email: str, months: List[str]):
+        for month in months:
+            self.delete(self.summary_ref(email, month))
+
+    # SMS hashes
+    def get_sms_hashes(self, email: str, digests: List[str]) -> Dict[str, Dict]:
+        refs = [self.sms_hash_ref(email, digest) for digest in digests]
+        return {doc.id: doc.to_dict() for doc in self.get_all(refs) if doc.exists}
+
+    def create_sms_hash(self, email: str, digest: str, data: Dict) -> bool:
+        record(writes=1)
+        try:
+            self.sms_hash_ref(email, digest).create(data)
+            return True
+        except AlreadyExists:
+            return False
+
+    def set_sms_hashes(self, email: str, hashes: Dict[str, Dict]) -> BatchWriteResult:
+        return self.writer.commit([(self.sms_hash_ref(email, digest), data) for digest, data in hashes.items()])
+
+    def delete_sms_hash(self, email: str, digest: str):
+        self.delete(self.sms_hash_ref(email, digest))
+
+    # Enrichment queue
+    def queue_enrichments(self, email: str, transaction_ids: List[str], now: float) -> int:
+        refs = {transaction_id: self.enrichment_ref(f"{email}:{transaction_id}") for transaction_id in transaction_ids}
+        queued = {doc.id for doc in self.get_all(list(refs.values())) if doc.exists}
+        writes = [
+            (ref, {"email": email, "transactionId": transaction_id, "status": "pending", "attempts": 0, "nextAttempt": now})
+            for transaction_id, ref in refs.items() if ref.id not in queued
+        ]
+        return self.writer.commit(writes).written
+
+    def pending_enrichments(self, limit: int, now: float) -> List[Dict]:
+        # Each query needs its (status, field) composite index of
+        # functions/firestore.indexes.json
+        collection = self.client.collection("enrichment")
+        items = []
+        for status, field, op in (("running", "leaseUntil", "<"), ("pending", "nextAttempt", "<=")):
+            if len(items) >= limit:
+                break
+            query = (
+                collection.where(filter=FieldFilter("status", "==", status))
+                .where(filter=FieldFilter(field, op, now))
+                .order_by(field)
+                .limit(limit - len(items))
+            )
+            for doc in counted(query.stream()):
+                item = doc.to_dict()
+                item["id"] = doc.id
+                items.append(item)
+        return items
+
+    def claim_enrichment(self, item_id: str, owner: str, now: float, seconds: float) -> bool:
+        item_ref = self.enrichment_ref(item_id)
+
+        def claim_in(firestore_transaction, attempt):
+            snapshot = item_ref.get(transaction=firestore_transaction)
+            attempt["reads"] = 1
+            if not can_claim_enrichment(snapshot.to_dict() if snapshot.exists else None, now):
+                return False
+            firestore_transaction.update(item_ref, {"status": "running", "owner": owner, "leaseUntil": now + seconds})
+            attempt["writes"] = 1
+            return True
+        return self.transact(claim_in)
+
+    def complete_enrichment(self, item_id: str):
+        self.delete(self.enrichment_ref(item_id))
+
+    def retry_enrichment(self, item_id: str, update: Dict):
+        record(writes=1)
+        self.enrichment_ref(item_id).update(update)
+
+    def lease_store(self):
+        if self._leases is None:
+            self._leases = FirestoreLeaseStore(self.client)
+        return self._leases
+
+    # Async counterparts, see Storage
+    def list_of(self, model, docs):
+        items = []
+        for doc in docs:
+            doc_dict = doc.to_dict()
+            doc_dict["id"] = doc.id
+            items.append(model(**doc_dict))
+        return items
+
+    async def list_messages_async(self, email: str, since: int, limit: Optional[int] = None) -> List[Message]:
+        query = self.messages(email, self.asyncClient).where(filter=FieldFilter("timestamp", ">=", since)).order_by("timestamp", direction=firestore.Query.DESCENDING)
+        if limit:
+            query = query.limit(limit)
+        return self.list_of(Message, [doc async for doc in counted_async(query.stream())])
+
+    async def list_emails_async(self) -> List[str]:
+        return [doc.id async for doc in counted_async(self.asyncClient.collection("sms").stream())]
+
+    async def list_categories_async(self, email: str) -> List[CategoryEntry]:
+        query = self.asyncClient.collection("category").document(email).collection("categories").order_by("category")
+        return self.list_of(CategoryEntry, [doc async for doc in counted_async(query.stream())])
+
+    async def list_senders_async(self) -> List[Sender]:
+        return self.list_of(Sender, [doc async for doc in counted_async(self.asyncClient.collection("sender").stream())])
+
+    async def list_patterns_async(self) -> List[Pattern]:
+        query = self.asyncClient.collection("pattern").order_by("action")
+        return self.list_of(Pattern, [doc async for doc in counted_async(query.stream())])
+
+    async def list_merchants_async(self) -> Dict[str, Dict]:
+        return {doc.id: doc.to_dict() async for doc in counted_async(self.asyncClient.collection("merchant").stream())}
+
+    async def get_user_async(self, email: str) -> Optional[Dict]:
+        user = await self.get_async(self.asyncClient.collection("users").document(email))
+        return user.to_dict() if user.exists else None
+
+    async def get_transaction_async(self, email: str, transaction_id: str) -> Optional[Transaction]:
+        transaction = await self.get_async(self.transactions(email, self.asyncClient).document(transaction_id))
+        return Transaction(**transaction.to_dict()) if transaction.exists else None
+
+    async def get_transactions_by_id_async(self, email: str, transaction_ids: List[str]) -> Dict[str, Transaction]:
+        collection = self.transactions(email, self.asyncClient)
+        refs = [collection.document(transaction_id) for transaction_id in set(transaction_ids)]
+        return {doc.id: Transaction(**doc.to_dict()) async for doc in self.get_all_async(refs) if doc.exists}
+
+    async def save_transactions_async(self, email: str, transactions: List[Transaction]) -> BatchWriteResult:
+        collection = self.transactions(email, self.asyncClient)
+        return await self.asyncWriter.commit([(collection.document(transaction.id), transaction.dict()) for transaction in transactions])
+
+    async def query_transactions_async(self, email: str, start: Optional[int] = None, end: Optional[int] = None) -> List[Transaction]:
+        query = self.transaction_query(email, start, end, client=self.asyncClient)
+        return [Transaction(**doc.to_dict()) async for doc in counted_async(query.stream())]
+
+    async def stream_transactions_async(self, email: str, from_ts: Optional[int] = None, to_ts: Optional[int] = None):
+        async for doc in counted_async(self.transaction_query(email, from_ts, to_ts, inclusiveEnd=True, client=self.asyncClient).stream()):
+            yield Transaction(**doc.to_dict())
+
+    async def query_transactions_page_async(self, email, from_ts, to_ts, limit, after=None) -> List[Transaction]:
+        query = self.transaction_page_query(email, from_ts, to_ts, limit, after, client=self.asyncClient)
+        return [Transaction(**doc.to_dict()) async for doc in counted_async(query.stream())]
+
+    async def get_summary_async(self, email: str, month: str) -> Optional[Dict]:
+        snapshot = await self.get_async(self.summary_ref(email, month, self.asyncClient))
+        return snapshot.to_dict() if snapshot.exists else None
+
+    async def set_summary_async(self, email: str, month: str, data: Dict, generation: int) -> bool:
+        summary_ref = self.summary_ref(email, month, self.asyncClient)
+
+        async def set_in(firestore_transaction, attempt):
+            snapshot = await summary_ref.get(transaction=firestore_transaction)
+            attempt["reads"] = 1
+            if (snapshot.to_dict() or {}).get("generation", 0) != generation:
+                return False
+            firestore_transaction.set(summary_ref, data)
+            attempt["writes"] = 1
+            return True
+        return await self.transact_async(set_in)
+
+    async def increment_summaries_async(self, email, delta) -> BatchWriteResult:
+        writes = [(self.summary_ref(email, month, self.asyncClient), increments(buckets, firestore.Increment)) for month, buckets in delta.items()]
+        return await self.asyncWriter.commit(writes, retry=False)
+
+    async def delete_summaries_async(self, email: str, months: List[str]):
+        await asyncio.gather(*(self.delete_async(self.summary_ref(email, month, self.asyncClient)) for month in months))
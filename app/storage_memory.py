@@ -0,0 +1,279 @@
+import copy
+import threading
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from models import BatchWriteResult, CategoryEntry, Message, Pattern, Sender, Transaction
+from sharding import LocalLeaseStore
+from storage import Storage, can_claim_enrichment, written
+from summary import add_nested, increments
+
+
+class MemoryStorage(Storage):
+    """
+    Everything in process memory behind one lock, nothing survives a
+    restart. A stand-in store for benchmarks and load tests, so they measure
+    the service rather than a database.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.messages: Dict[str, Dict[str, Dict]] = {}
+        self.watermarks: Dict[str, int] = {}
+        self.categories: Dict[str, Dict[str, CategoryEntry]] = {}
+        self.senders: Dict[str, Sender] = {}
+        self.patterns: Dict[str, Pattern] = {}
+        self.merchants: Dict[str, Dict] = {}
+        self.users: Dict[str, Dict] = {}
+        self.transactions: Dict[str, Dict[str, Transaction]] = {}
+        self.summaries: Dict[Tuple[str, str], Dict] = {}
+        self.smsHashes: Dict[str, Dict[str, Dict]] = {}
+        self.enrichments: Dict[str, Dict] = {}
+        self.leases = LocalLeaseStore()
+
+    # Messages
+    def new_message_id(self, email: str) -> str:
+        return uuid.uuid4().hex
+
+    def list_messages(self, email: str, since: int, limit: Optional[int] = None) -> List[Message]:
+        with self.lock:
+            entries = [(message_id, data) for message_id, data in self.messages.get(email, {}).items() if data.get("timestamp", 0) >= since]
+        messages = sorted((Message(**{**data, "id": message_id}) for message_id, data in entries), key=lambda message: message.timestamp, reverse=True)
+        return messages[:limit] if limit else messages
+
+    def list_messages_with_status(self, email: str, status: str, since: int) -> List[Message]:
+        with self.lock:
+            entries = [
+                (message_id, data) for message_id, data in self.messages.get(email, {}).items()
+                if data.get("status", "unprocessed") == status and data.get("timestamp", 0) >= since
+            ]
+        return sorted((Message(**{**data, "id": message_id}) for message_id, data in entries), key=lambda message: message.timestamp, reverse=True)
+
+    def save_message(self, email: str, message_id: str, entry: Dict):
+        with self.lock:
+            messages = self.messages.setdefault(email, {})
+            messages[message_id] = {**messages.get(message_id, {}), **entry}
+
+    def update_message_statuses(self, email: str, updates: List[Tuple[str, str, str]]) -> BatchWriteResult:
+        latest = {message_id: (status, matchedPattern) for message_id, status, matchedPattern in updates}
+        updated = 0
+        with self.lock:
+            messages = self.messages.get(email, {})
+            for message_id, (status, matchedPattern) in latest.items():
+                if message_id in messages:
+                    messages[message_id] = {**messages[message_id], "status": status, "matchedPattern": matchedPattern}
+                    updated += 1
+        result = written(updated)
+        result.failed = len(latest) - updated
+        return result
+
+    def set_message_status(self, email: str, message_id: str, status: str, matchedPattern: str):
+        self.save_message(email, message_id, {"status": status, "matchedPattern": matchedPattern})
+
+    def list_emails(self) -> List[str]:
+        with self.lock:
+            return list(self.messages)
+
+    def get_watermark(self, email: str) -> int:
+        return self.watermarks.get(email, 0)
+
+    def set_watermark(self, email: str, timestamp: int):
+        self.watermarks[email] = timestamp
+
+    # Catalogs
+    def list_categories(self, email: str) -> List[CategoryEntry]:
+        with self.lock:
+            entries = [entry.copy(update={"id": category_id}) for category_id, entry in self.categories.get(email, {}).items()]
+        return sorted(entries, key=lambda entry: entry.category)
+
+    def save_category(self, email: str, categoryEntry: CategoryEntry):
+        with self.lock:
+            categories = self.categories.setdefault(email, {})
+            category_id = categoryEntry.id if categoryEntry.id in categories else uuid.uuid4().hex
+            categories[category_id] = categoryEntry.copy()
+
+    def delete_category(self, email: str, category_id: str) -> bool:
+        with self.lock:
+            return self.categories.get(email, {}).pop(category_id, None) is not None
+
+    def list_senders(self) -> List[Sender]:
+        with self.lock:
+            return [sender.copy(update={"id": name}) for name, sender in self.senders.items()]
+
+    def add_sender(self, sender: Sender) -> bool:
+        with self.lock:
+            if sender.name in self.senders:
+                return False
+            self.senders[sender.name] = sender.copy()
+            return True
+
+    def save_senders(self, senders: List[Sender]):
+        with self.lock:
+            for sender in senders:
+                self.senders[sender.name] = sender.copy()
+
+    def list_patterns(self) -> List[Pattern]:
+        with self.lock:
+            patterns = [pattern.copy(update={"id": pattern_id}) for pattern_id, pattern in self.patterns.items()]
+        # Stable, so patterns with the same action keep their insertion order
+        return sorted(patterns, key=lambda pattern: pattern.action.value)
+
+    def save_pattern(self, pattern: Pattern):
+        with self.lock:
+            pattern_id = pattern.id if pattern.id in self.patterns else uuid.uuid4().hex
+            self.patterns[pattern_id] = pattern.copy()
+
+    def delete_pattern(self, pattern_id: str) -> bool:
+        with self.lock:
+            return self.patterns.pop(pattern_id, None) is not None
+
+    def list_merchants(self) -> Dict[str, Dict]:
+        with self.lock:
+            return copy.deepcopy(self.merchants)
+
+    def save_merchant(self, merchant: str, category: str):
+        with self.lock:
+            self.merchants[merchant] = {**self.merchants.get(merchant, {}), "category": category}
+
+    def get_user(self, email: str) -> Optional[Dict]:
+        user = self.users.get(email)
+        return dict(user) if user is not None else None
+
+    # Transactions
+    def get_transaction(self, email: str, transaction_id: str) -> Optional[Transaction]:
+        return self.get_transactions_by_id(email, [transaction_id]).get(transaction_id)
+
+    def get_transactions_by_id(self, email: str, transaction_ids: List[str]) -> Dict[str, Transaction]:
+        with self.lock:
+            stored = self.transactions.get(email, {})
+            return {transaction_id: stored[transaction_id].copy() for transaction_id in set(transaction_ids) if transaction_id in stored}
+
+    def put_transaction(self, email: str, data: Dict) -> Tuple[Optional[Transaction], Transaction]:
+        # Caller holds the lock
+        stored = self.transactions.setdefault(email, {})
+        old = stored.get(data["id"])
+        new = Transaction(**{**(old.dict() if old else {}), **data})
+        stored[new.id] = new
+        return old, new
+
+    def save_transactions(self, email: str, transactions: List[Transaction]) -> BatchWriteResult:
+        with self.lock:
+            for transaction in transactions:
+                self.put_transaction(email, transaction.dict())
+        return written(len(transactions))
+
+    def select_transactions(self, email, start=None, end=None, inclusiveEnd=False) -> List[Transaction]:
+        with self.lock:
+            transactions = list(self.transactions.get(email, {}).values())
+        selected = [
+            transaction.copy() for transaction in transactions
+            if (start is None or transaction.timestamp >= start)
+            and (end is None or transaction.timestamp < end or (inclusiveEnd and transaction.timestamp == end))
+        ]
+        return sorted(selected, key=lambda transaction: (transaction.timestamp, transaction.id), reverse=True)
+
+    def query_transactions(self, email: str, start: Optional[int] = None, end: Optional[int] = None) -> List[Transaction]:
+        return self.select_transactions(email, start, end)
+
+    def stream_transactions(self, email: str, from_ts: Optional[int] = None, to_ts: Optional[int] = None):
+        yield from self.select_transactions(email, from_ts, to_ts, inclusiveEnd=True)
+
+    def query_transactions_page(self, email, from_ts, to_ts, limit, after=None) -> List[Transaction]:
+        transactions = self.select_transactions(email, from_ts, to_ts, inclusiveEnd=True)
+        if after is not None:
+            transactions = [transaction for transaction in transactions if (transaction.timestamp, transaction.id) < tuple(after)]
+        return transactions[:limit]
+
+    def update_transaction(self, email, transaction_id, transaction, delta, fields=None, only_if=None):
+        with self.lock:
+            if only_if is not None and not only_if(self.transactions.get(email, {}).get(transaction_id)):
+                return None
+            old, new = self.put_transaction(email, {**transaction.dict(include=fields), "id": transaction_id})
+            for month, buckets in delta(old, new).items():
+                add_nested(self.summaries.setdefault((email, month), {}), increments(buckets))
+            return new
+
+    # Monthly summaries
+    def get_summary(self, email: str, month: str) -> Optional[Dict]:
+        with self.lock:
+            data = self.summaries.get((email, month))
+            return copy.deepcopy(data) if data is not None else None
+
+    def set_summary(self, email: str, month: str, data: Dict, generation: int) -> bool:
+        with self.lock:
+            if self.summaries.get((email, month), {}).get("generation", 0) != generation:
+                return False
+            self.summaries[(email, month)] = copy.deepcopy(data)
+            return True
+
+    def increment_summaries(self, email, delta) -> BatchWriteResult:
+        with self.lock:
+            for month, buckets in delta.items():
+                add_nested(self.summaries.setdefault((email, month), {}), increments(buckets))
+        return written(len(delta))
+
+    def delete_summaries(self, email: str, months: List[str]):
+        with self.lock:
+            for month in months:
+                self.summaries.pop((email, month), None)
+
+    # SMS hashes
+    def get_sms_hashes(self, email: str, digests: List[str]) -> Dict[str, Dict]:
+        with self.lock:
+            hashes = self.smsHashes.get(email, {})
+            return {digest: dict(hashes[digest]) for digest in digests if digest in hashes}
+
+    def create_sms_hash(self, email: str, digest: str, data: Dict) -> bool:
+        with self.lock:
+            hashes = self.smsHashes.setdefault(email, {})
+            if digest in hashes:
+                return False
+            hashes[digest] = dict(data)
+            return True
+
+    def set_sms_hashes(self, email: str, hashes: Dict[str, Dict]) -> BatchWriteResult:
+        with self.lock:
+            self.smsHashes.setdefault(email, {}).update({digest: dict(data) for digest, data in hashes.items()})
+        return written(len(hashes))
+
+    def delete_sms_hash(self, email: str, digest: str):
+        with self.lock:
+            self.smsHashes.get(email, {}).pop(digest, None)
+
+    # Enrichment queue
+    def queue_enrichments(self, email: str, transaction_ids: List[str], now: float) -> int:
+        queued = 0
+        with self.lock:
+            for transaction_id in transaction_ids:
+                item_id = f"{email}:{transaction_id}"
+                if item_id not in self.enrichments:
+                    self.enrichments[item_id] = {"email": email, "transactionId": transaction_id, "status": "pending", "attempts": 0, "nextAttempt": now}
+                    queued += 1
+        return queued
+
+    def pending_enrichments(self, limit: int, now: float) -> List[Dict]:
+        with self.lock:
+            items = [{**item, "id": item_id} for item_id, item in self.enrichments.items()]
+        expired = sorted((item for item in items if item["status"] == "running" and item.get("leaseUntil", 0) < now), key=lambda item: item["leaseUntil"])
+        due = sorted((item for item in items if item["status"] == "pending" and item.get("nextAttempt", 0) <= now), key=lambda item: item.get("nextAttempt", 0))
+        return (expired + due)[:limit]
+
+    def claim_enrichment(self, item_id: str, owner: str, now: float, seconds: float) -> bool:
+        with self.lock:
+            item = self.enrichments.get(item_id)
+            if not can_claim_enrichment(item, now):
+                return False
+            self.enrichments[item_id] = {**item, "status": "running", "owner": owner, "leaseUntil": now + seconds}
+            return True
+
+    def complete_enrichment(self, item_id: str):
+        with self.lock:
+            self.enrichments.pop(item_id, None)
+
+    def retry_enrichment(self, item_id: str, update: Dict):
+        with self.lock:
+            if item_id in self.enrichments:
+                self.enrichments[item_id] = {**self.enrichments[item_id], **update}
+
+    def lease_store(self):
+        return self.leases
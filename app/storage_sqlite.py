@@ -0,0 +1,425 @@
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from models import BatchWriteResult, CategoryEntry, Message, Pattern, Sender, Transaction
+from sharding import LocalLeaseStore
+from storage import Storage, can_claim_enrichment, written
+from summary import add_nested, increments
+from utils import getScriptDir
+
+SQLITE_PATH = os.environ.get("SQLITE_PATH", os.path.join(getScriptDir(), "data", "expenses.sqlite3"))
+# Stay under SQLite's limit of bound parameters
+IN_CHUNK = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS message (
+    email TEXT NOT NULL,
+    id TEXT NOT NULL,
+    timestamp INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'unprocessed',
+    data TEXT NOT NULL,
+    PRIMARY KEY (email, id)
+);
+CREATE INDEX IF NOT EXISTS message_email_timestamp ON message (email, timestamp);
+DROP INDEX IF EXISTS message_email_status;
+CREATE INDEX IF NOT EXISTS message_email_status_timestamp ON message (email, status, timestamp);
+
+CREATE TABLE IF NOT EXISTS watermark (
+    email TEXT PRIMARY KEY,
+    messages INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS "transaction" (
+    email TEXT NOT NULL,
+    id TEXT NOT NULL,
+    timestamp INTEGER NOT NULL DEFAULT 0,
+    data TEXT NOT NULL,
+    PRIMARY KEY (email, id)
+);
+CREATE INDEX IF NOT EXISTS transaction_email_timestamp ON "transaction" (email, timestamp);
+
+CREATE TABLE IF NOT EXISTS category (
+    email TEXT NOT NULL,
+    id TEXT NOT NULL,
+    category TEXT NOT NULL DEFAULT '',
+    data TEXT NOT NULL,
+    PRIMARY KEY (email, id)
+);
+
+CREATE TABLE IF NOT EXISTS sender (
+    name TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS pattern (
+    id TEXT PRIMARY KEY,
+    action TEXT NOT NULL DEFAULT '',
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS merchant (
+    name TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS user (
+    email TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS summary (
+    email TEXT NOT NULL,
+    month TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (email, month)
+);
+
+CREATE TABLE IF NOT EXISTS sms_hash (
+    email TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (email, digest)
+);
+
+CREATE TABLE IF NOT EXISTS enrichment (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+DROP INDEX IF EXISTS enrichment_status;
+CREATE INDEX IF NOT EXISTS enrichment_status_next_attempt ON enrichment (status, json_extract(data, '$.nextAttempt'));
+CREATE INDEX IF NOT EXISTS enrichment_status_lease_until ON enrichment (status, json_extract(data, '$.leaseUntil'));
+"""
+
+
+def chunks(values: List, size: int = IN_CHUNK):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+class SQLiteStorage(Storage):
+    """
+    Single-node storage in one SQLite file in WAL mode, so readers do not
+    wait on the writer. Each thread gets its own connection; documents are
+    stored as JSON next to the columns they are looked up or ordered by,
+    with messages indexed on (email, timestamp) and (email, status, timestamp) and
+    transactions on (email, timestamp).
+    """
+
+    def __init__(self, path: str = SQLITE_PATH):
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.local = threading.local()
+        self.leases = LocalLeaseStore()
+        self.connection.executescript(SCHEMA)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def write(self):
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def select(self, query: str, params=()) -> List[Tuple]:
+        return self.connection.execute(query, params).fetchall()
+
+    # Messages
+    def new_message_id(self, email: str) -> str:
+        return uuid.uuid4().hex
+
+    def to_messages(self, rows) -> List[Message]:
+        return [Message(**{**json.loads(data), "id": message_id}) for message_id, data in rows]
+
+    def list_messages(self, email: str, since: int, limit: Optional[int] = None) -> List[Message]:
+        query = "SELECT id, data FROM message WHERE email = ? AND timestamp >= ? ORDER BY timestamp DESC"
+        params = [email, since]
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        return self.to_messages(self.select(query, params))
+
+    def list_messages_with_status(self, email: str, status: str, since: int) -> List[Message]:
+        return self.to_messages(self.select(
+            "SELECT id, data FROM message WHERE email = ? AND status = ? AND timestamp >= ? ORDER BY timestamp DESC", (email, status, since)
+        ))
+
+    def save_message(self, email: str, message_id: str, entry: Dict):
+        with self.write() as connection:
+            row = connection.execute("SELECT data FROM message WHERE email = ? AND id = ?", (email, message_id)).fetchone()
+            data = {**(json.loads(row[0]) if row else {}), **entry}
+            connection.execute(
+                "INSERT OR REPLACE INTO message (email, id, timestamp, status, data) VALUES (?, ?, ?, ?, ?)",
+                (email, message_id, data.get("timestamp", 0), data.get("status", "unprocessed"), json.dumps(data)),
+            )
+
+    def update_message_statuses(self, email: str, updates: List[Tuple[str, str, str]]) -> BatchWriteResult:
+        # Repeated ids keep the last update, like the batch writer's coalescing
+        latest = {message_id: (status, matchedPattern) for message_id, status, matchedPattern in updates}
+        updated = 0
+        with self.write() as connection:
+            for message_id, (status, matchedPattern) in latest.items():
+                cursor = connection.execute(
+                    "UPDATE message SET status = ?, data = json_set(data, '$.status', ?, '$.matchedPattern', ?) WHERE email = ? AND id = ?",
+                    (status, status, matchedPattern, email, message_id),
+                )
+                updated += cursor.rowcount
+        result = written(updated)
+        result.failed = len(latest) - updated
+        return result
+
+    def set_message_status(self, email: str, message_id: str, status: str, matchedPattern: str):
+        self.save_message(email, message_id, {"status": status, "matchedPattern": matchedPattern})
+
+    def list_emails(self) -> List[str]:
+        return [email for email, in self.select("SELECT DISTINCT email FROM message")]
+
+    def get_watermark(self, email: str) -> int:
+        rows = self.select("SELECT messages FROM watermark WHERE email = ?", (email,))
+        return rows[0][0] if rows else 0
+
+    def set_watermark(self, email: str, timestamp: int):
+        with self.write() as connection:
+            connection.execute("INSERT OR REPLACE INTO watermark (email, messages) VALUES (?, ?)", (email, timestamp))
+
+    # Catalogs
+    def list_categories(self, email: str) -> List[CategoryEntry]:
+        rows = self.select("SELECT id, data FROM category WHERE email = ? ORDER BY category", (email,))
+        return [CategoryEntry(**{**json.loads(data), "id": category_id}) for category_id, data in rows]
+
+    def save_category(self, email: str, categoryEntry: CategoryEntry):
+        with self.write() as connection:
+            category_id = categoryEntry.id
+            if not category_id or not connection.execute("SELECT 1 FROM category WHERE email = ? AND id = ?", (email, category_id)).fetchone():
+                category_id = uuid.uuid4().hex
+            connection.execute(
+                "INSERT OR REPLACE INTO category (email, id, category, data) VALUES (?, ?, ?, ?)",
+                (email, category_id, categoryEntry.category, json.dumps(categoryEntry.dict())),
+            )
+
+    def delete_category(self, email: str, category_id: str) -> bool:
+        with self.write() as connection:
+            return connection.execute("DELETE FROM category WHERE email = ? AND id = ?", (email, category_id)).rowcount > 0
+
+    def list_senders(self) -> List[Sender]:
+        return [Sender(**{**json.loads(data), "id": name}) for name, data in self.select("SELECT name, data FROM sender")]
+
+    def add_sender(self, sender: Sender) -> bool:
+        with self.write() as connection:
+            return connection.execute("INSERT OR IGNORE INTO sender (name, data) VALUES (?, ?)", (sender.name, json.dumps(sender.dict()))).rowcount > 0
+
+    def save_senders(self, senders: List[Sender]):
+        with self.write() as connection:
+            connection.executemany("INSERT OR REPLACE INTO sender (name, data) VALUES (?, ?)", [(sender.name, json.dumps(sender.dict())) for sender in senders])
+
+    def list_patterns(self) -> List[Pattern]:
+        return [Pattern(**{**json.loads(data), "id": pattern_id}) for pattern_id, data in self.select("SELECT id, data FROM pattern ORDER BY action")]
+
+    def save_pattern(self, pattern: Pattern):
+        with self.write() as connection:
+            pattern_id = pattern.id
+            if not pattern_id or not connection.execute("SELECT 1 FROM pattern WHERE id = ?", (pattern_id,)).fetchone():
+                pattern_id = uuid.uuid4().hex
+            connection.execute("INSERT OR REPLACE INTO pattern (id, action, data) VALUES (?, ?, ?)", (pattern_id, pattern.action.value, json.dumps(pattern.dict())))
+
+    def delete_pattern(self, pattern_id: str) -> bool:
+        with self.write() as connection:
+            return connection.execute("DELETE FROM pattern WHERE id = ?", (pattern_id,)).rowcount > 0
+
+    def list_merchants(self) -> Dict[str, Dict]:
+        return {name: json.loads(data) for name, data in self.select("SELECT name, data FROM merchant")}
+
+    def save_merchant(self, merchant: str, category: str):
+        with self.write() as connection:
+            row = connection.execute("SELECT data FROM merchant WHERE name = ?", (merchant,)).fetchone()
+            data = {**(json.loads(row[0]) if row else {}), "category": category}
+            connection.execute("INSERT OR REPLACE INTO merchant (name, data) VALUES (?, ?)", (merchant, json.dumps(data)))
+
+    def get_user(self, email: str) -> Optional[Dict]:
+        rows = self.select("SELECT data FROM user WHERE email = ?", (email,))
+        return json.loads(rows[0][0]) if rows else None
+
+    # Transactions
+    def get_transaction(self, email: str, transaction_id: str) -> Optional[Transaction]:
+        return self.get_transactions_by_id(email, [transaction_id]).get(transaction_id)
+
+    def get_transactions_by_id(self, email: str, transaction_ids: List[str]) -> Dict[str, Transaction]:
+        transactions = {}
+        for chunk in chunks(list(set(transaction_ids))):
+            marks = ",".join("?" * len(chunk))
+            for transaction_id, data in self.select(f'SELECT id, data FROM "transaction" WHERE email = ? AND id IN ({marks})', [email] + chunk):
+                transactions[transaction_id] = Transaction(**json.loads(data))
+        return transactions
+
+    def put_transaction(self, connection, email: str, data: Dict):
+        row = connection.execute('SELECT data FROM "transaction" WHERE email = ? AND id = ?', (email, data["id"])).fetchone()
+        merged = {**(json.loads(row[0]) if row else {}), **data}
+        connection.execute(
+            'INSERT OR REPLACE INTO "transaction" (email, id, timestamp, data) VALUES (?, ?, ?, ?)',
+            (email, merged["id"], merged.get("timestamp", 0), json.dumps(merged)),
+        )
+        return json.loads(row[0]) if row else None, merged
+
+    def save_transactions(self, email: str, transactions: List[Transaction]) -> BatchWriteResult:
+        with self.write() as connection:
+            for transaction in transactions:
+                self.put_transaction(connection, email, transaction.dict())
+        return written(len(transactions))
+
+    def transaction_rows(self, email, start=None, end=None, inclusiveEnd=False, after=None, limit=None):
+        query = 'SELECT data FROM "transaction" WHERE email = ?'
+        params = [email]
+        if start is not None:
+            query += " AND timestamp >= ?"
+            params.append(start)
+        if end is not None:
+            query += " AND timestamp <= ?" if inclusiveEnd else " AND timestamp < ?"
+            params.append(end)
+        if after is not None:
+            query += " AND (timestamp < ? OR (timestamp = ? AND id < ?))"
+            params.extend([after[0], after[0], after[1]])
+        query += " ORDER BY timestamp DESC, id DESC"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        return self.connection.execute(query, params)
+
+    def query_transactions(self, email: str, start: Optional[int] = None, end: Optional[int] = None) -> List[Transaction]:
+        return [Transaction(**json.loads(data)) for data, in self.transaction_rows(email, start, end)]
+
+    def stream_transactions(self, email: str, from_ts: Optional[int] = None, to_ts: Optional[int] = None):
+        for data, in self.transaction_rows(email, from_ts, to_ts, inclusiveEnd=True):
+            yield Transaction(**json.loads(data))
+
+    def query_transactions_page(self, email, from_ts, to_ts, limit, after=None) -> List[Transaction]:
+        return [Transaction(**json.loads(data)) for data, in self.transaction_rows(email, from_ts, to_ts, inclusiveEnd=True, after=after, limit=limit)]
+
+    def update_transaction(self, email, transaction_id, transaction, delta, fields=None, only_if=None):
+        with self.write() as connection:
+            if only_if is not None:
+                row = connection.execute('SELECT data FROM "transaction" WHERE email = ? AND id = ?', (email, transaction_id)).fetchone()
+                if not only_if(Transaction(**json.loads(row[0])) if row else None):
+                    return None
+            old, merged = self.put_transaction(connection, email, {**transaction.dict(include=fields), "id": transaction_id})
+            for month, buckets in delta(Transaction(**old) if old else None, Transaction(**merged)).items():
+                self.increment_summary(connection, email, month, increments(buckets))
+            return Transaction(**merged)
+
+    # Monthly summaries
+    def get_summary(self, email: str, month: str) -> Optional[Dict]:
+        rows = self.select("SELECT data FROM summary WHERE email = ? AND month = ?", (email, month))
+        return json.loads(rows[0][0]) if rows else None
+
+    def set_summary(self, email: str, month: str, data: Dict, generation: int) -> bool:
+        with self.write() as connection:
+            row = connection.execute("SELECT data FROM summary WHERE email = ? AND month = ?", (email, month)).fetchone()
+            if (json.loads(row[0]) if row else {}).get("generation", 0) != generation:
+                return False
+            connection.execute("INSERT OR REPLACE INTO summary (email, month, data) VALUES (?, ?, ?)", (email, month, json.dumps(data)))
+            return True
+
+    def increment_summary(self, connection, email, month, increments):
+        row = connection.execute("SELECT data FROM summary WHERE email = ? AND month = ?", (email, month)).fetchone()
+        data = json.loads(row[0]) if row else {}
+        add_nested(data, increments)
+        connection.execute("INSERT OR REPLACE INTO summary (email, month, data) VALUES (?, ?, ?)", (email, month, json.dumps(data)))
+
+    def increment_summaries(self, email, delta) -> BatchWriteResult:
+        with self.write() as connection:
+            for month, buckets in delta.items():
+                self.increment_summary(connection, email, month, increments(buckets))
+        return written(len(delta))
+
+    def delete_summaries(self, email: str, months: List[str]):
+        with self.write() as connection:
+            connection.executemany("DELETE FROM summary WHERE email = ? AND month = ?", [(email, month) for month in months])
+
+    # SMS hashes
+    def get_sms_hashes(self, email: str, digests: List[str]) -> Dict[str, Dict]:
+        hashes = {}
+        for chunk in chunks(list(digests)):
+            marks = ",".join("?" * len(chunk))
+            for digest, data in self.select(f"SELECT digest, data FROM sms_hash WHERE email = ? AND digest IN ({marks})", [email] + chunk):
+                hashes[digest] = json.loads(data)
+        return hashes
+
+    def create_sms_hash(self, email: str, digest: str, data: Dict) -> bool:
+        with self.write() as connection:
+            return connection.execute("INSERT OR IGNORE INTO sms_hash (email, digest, data) VALUES (?, ?, ?)", (email, digest, json.dumps(data))).rowcount > 0
+
+    def set_sms_hashes(self, email: str, hashes: Dict[str, Dict]) -> BatchWriteResult:
+        with self.write() as connection:
+            connection.executemany("INSERT OR REPLACE INTO sms_hash (email, digest, data) VALUES (?, ?, ?)",
+                                   [(email, digest, json.dumps(data)) for digest, data in hashes.items()])
+        return written(len(hashes))
+
+    def delete_sms_hash(self, email: str, digest: str):
+        with self.write() as connection:
+            connection.execute("DELETE FROM sms_hash WHERE email = ? AND digest = ?", (email, digest))
+
+    # Enrichment queue
+    def queue_enrichments(self, email: str, transaction_ids: List[str], now: float) -> int:
+        queued = 0
+        with self.write() as connection:
+            for transaction_id in transaction_ids:
+                item = {"email": email, "transactionId": transaction_id, "status": "pending", "attempts": 0, "nextAttempt": now}
+                queued += connection.execute("INSERT OR IGNORE INTO enrichment (id, status, data) VALUES (?, ?, ?)",
+                                             (f"{email}:{transaction_id}", "pending", json.dumps(item))).rowcount
+        return queued
+
+    def pending_enrichments(self, limit: int, now: float) -> List[Dict]:
+        # The expressions match the enrichment indexes
+        rows = self.select(
+            "SELECT id, data FROM enrichment WHERE status = 'running' AND json_extract(data, '$.leaseUntil') < ? "
+            "ORDER BY json_extract(data, '$.leaseUntil') LIMIT ?", (now, limit)
+        )
+        rows += self.select(
+            "SELECT id, data FROM enrichment WHERE status = 'pending' AND json_extract(data, '$.nextAttempt') <= ? "
+            "ORDER BY json_extract(data, '$.nextAttempt') LIMIT ?", (now, limit - len(rows))
+        )
+        return [{**json.loads(data), "id": item_id} for item_id, data in rows]
+
+    def update_enrichment(self, connection, item_id: str, item: Dict):
+        connection.execute("UPDATE enrichment SET status = ?, data = ? WHERE id = ?", (item["status"], json.dumps(item), item_id))
+
+    def claim_enrichment(self, item_id: str, owner: str, now: float, seconds: float) -> bool:
+        with self.write() as connection:
+            row = connection.execute("SELECT data FROM enrichment WHERE id = ?", (item_id,)).fetchone()
+            item = json.loads(row[0]) if row else None
+            if not can_claim_enrichment(item, now):
+                return False
+            self.update_enrichment(connection, item_id, {**item, "status": "running", "owner": owner, "leaseUntil": now + seconds})
+            return True
+
+    def complete_enrichment(self, item_id: str):
+        with self.write() as connection:
+            connection.execute("DELETE FROM enrichment WHERE id = ?", (item_id,))
+
+    def retry_enrichment(self, item_id: str, update: Dict):
+        with self.write() as connection:
+            row = connection.execute("SELECT data FROM enrichment WHERE id = ?", (item_id,)).fetchone()
+            if row:
+                self.update_enrichment(connection, item_id, {**json.loads(row[0]), **update})
+
+    def lease_store(self):
+        # One node, so the leases only need to be shared between threads
+        return self.leases
@@ -0,0 +1,115 @@
+import datetime
+from typing import Dict, List, Optional, Tuple
+
+from models import MonthlySummary, SummaryTotals, Transaction, TransactionType
+
+# month -> bucket path -> field -> delta, where a bucket path is ("totals",),
+# ("ignored",) or ("categories", category)
+Delta = Dict[str, Dict[Tuple[str, ...], Dict[str, float]]]
+
+
+def month_key(timestamp: int) -> str:
+    # Months follow the server's local time, like get_start_and_end_of_month
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m")
+
+def month_bounds(month: str) -> Tuple[int, int]:
+    """
+    Returns the first and last second of a "YYYY-MM" month.
+    """
+    start = datetime.datetime.strptime(month, "%Y-%m")
+    if start.month == 12:
+        end = datetime.datetime(start.year + 1, 1, 1)
+    else:
+        end = datetime.datetime(start.year, start.month + 1, 1)
+    return int(start.timestamp()), int(end.timestamp()) - 1
+
+def category_name(transaction: Transaction) -> str:
+    category = transaction.category
+    return category.value if hasattr(category, "value") else str(category)
+
+def add_to_delta(delta: Delta, transaction: Transaction, sign: int):
+    buckets = delta.setdefault(month_key(transaction.timestamp), {})
+    if transaction.ignore:
+        paths = [("ignored",)]
+    else:
+        paths = [("totals",), ("categories", category_name(transaction))]
+    amountField = "credit" if transaction.transactiontype == TransactionType.credit else "debit"
+    for path in paths:
+        fields = buckets.setdefault(path, {})
+        fields[amountField] = fields.get(amountField, 0) + sign * transaction.amount
+        fields["count"] = fields.get("count", 0) + sign
+
+def transaction_delta(old: Optional[Transaction], new: Optional[Transaction]) -> Delta:
+    """
+    Change to the monthly summaries when a transaction goes from old to new;
+    either side may be None for an insert or a delete.
+    """
+    delta: Delta = {}
+    if old is not None:
+        add_to_delta(delta, old, -1)
+    if new is not None:
+        add_to_delta(delta, new, 1)
+    # Drop buckets that cancel out, e.g. a reason edit
+    for month in list(delta):
+        for path in list(delta[month]):
+            delta[month][path] = {field: value for field, value in delta[month][path].items() if value}
+            if not delta[month][path]:
+                del delta[month][path]
+        if not delta[month]:
+            del delta[month]
+    return delta
+
+def merge_deltas(deltas: List[Delta]) -> Delta:
+    merged: Delta = {}
+    for delta in deltas:
+        for month, buckets in delta.items():
+            for path, fields in buckets.items():
+                target = merged.setdefault(month, {}).setdefault(path, {})
+                for field, value in fields.items():
+                    target[field] = target.get(field, 0) + value
+    return merged
+
+def nest(buckets: Dict[Tuple[str, ...], Dict[str, float]], wrap=lambda value: value) -> Dict:
+    """
+    Turns bucket paths into the nested maps stored in a summary document,
+    wrapping every value (for example in a Firestore Increment).
+    """
+    document: Dict = {}
+    for path, fields in buckets.items():
+        target = document
+        for key in path:
+            target = target.setdefault(key, {})
+        for field, value in fields.items():
+            target[field] = wrap(value)
+    return document
+
+def increments(buckets: Dict[Tuple[str, ...], Dict[str, float]], wrap=lambda value: value) -> Dict:
+    """
+    nest() of the buckets plus a bump of the document's generation, which a
+    rebuild compares to notice increments made while it was building.
+    """
+    return {**nest(buckets, wrap), "generation": wrap(1)}
+
+def add_nested(document: Dict, increments: Dict):
+    """
+    Adds a nest() map of increments into a stored summary document, for
+    stores without an increment operation of their own.
+    """
+    for key, value in increments.items():
+        if isinstance(value, dict):
+            add_nested(document.setdefault(key, {}), value)
+        else:
+            document[key] = document.get(key, 0) + value
+
+def build_summary(month: str, transactions: List[Transaction]) -> MonthlySummary:
+    delta: Delta = {}
+    for transaction in transactions:
+        add_to_delta(delta, transaction, 1)
+    summary = MonthlySummary(month=month)
+    for path, fields in delta.get(month, {}).items():
+        totals = SummaryTotals(**fields)
+        if path[0] == "categories":
+            summary.categories[path[1]] = totals
+        else:
+            setattr(summary, path[0], totals)
+    return summary
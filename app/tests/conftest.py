@@ -0,0 +1,45 @@
+import os
+import sys
+import threading
+
+# Appended rather than prepended, app/secrets would shadow the standard
+# library's secrets module
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+
+import pytest
+
+import db
+from cache import caches
+from storage import set_storage
+from storage_memory import MemoryStorage
+from storage_sqlite import SQLiteStorage
+
+EMAIL = "user@example.com"
+OTHER_EMAIL = "other@example.com"
+
+
+def reset_state():
+    # Loads add_transactions_db started in the background, before their
+    # results land in the next test's store
+    for thread in threading.enumerate():
+        if thread.name == "populate-transactions":
+            thread.join()
+    for cache in caches.values():
+        cache.clear()
+    db.transaction_store.invalidate()
+    db.sms_hashes.users.clear()
+
+@pytest.fixture(params=["memory", "sqlite"])
+def storage(request, tmp_path):
+    """
+    Every storage backend that runs without a server, installed as the
+    storage db.py uses, with db.py's caches and stores emptied.
+    """
+    # A file rather than ":memory:", every thread gets its own connection
+    backend = MemoryStorage() if request.param == "memory" else SQLiteStorage(str(tmp_path / "expenses.sqlite3"))
+    set_storage(backend)
+    reset_state()
+    yield backend
+    set_storage(None)
+    reset_state()
@@ -0,0 +1,111 @@
+import asyncio
+import threading
+
+from google.api_core import exceptions
+
+from batch_writer import SET, UPDATE, AsyncBatchWriter, BatchWriter, coalesce
+
+
+class Ref():
+    def __init__(self, path):
+        self.path = path
+
+
+class FakeBatch():
+    def __init__(self, client):
+        self.client = client
+        self.writes = []
+
+    def set(self, ref, data, merge=False):
+        self.writes.append((SET, ref.path, data))
+
+    def update(self, ref, data):
+        self.writes.append((UPDATE, ref.path, data))
+
+    def commit(self):
+        with self.client.lock:
+            self.client.attempts.append(self.writes)
+            error = self.client.errors.pop(0) if self.client.errors else None
+            if error is None:
+                self.client.committed.extend(self.writes)
+        if error is not None:
+            raise error
+
+
+class FakeAsyncBatch(FakeBatch):
+    async def commit(self):
+        FakeBatch.commit(self)
+
+
+class FakeClient():
+    """
+    Records the batches committed, failing the first ones with the given
+    errors, None standing for a commit that succeeds.
+    """
+
+    def __init__(self, errors=(), batch=FakeBatch):
+        self.errors = list(errors)
+        self.attempts = []
+        self.committed = []
+        self.lock = threading.Lock()
+        self.batchClass = batch
+
+    def batch(self):
+        return self.batchClass(self)
+
+
+def writes(count):
+    return [(Ref(f"doc/{index}"), {"value": index}) for index in range(count)]
+
+
+def test_coalesce_keeps_first_position():
+    a, b = Ref("doc/a"), Ref("doc/b")
+    assert [(ref.path, data) for ref, data in coalesce([(a, {"x": 1}), (b, {"y": 1}), (a, {"x": 2, "z": 3})])] == \
+        [("doc/a", {"x": 2, "z": 3}), ("doc/b", {"y": 1})]
+
+def test_chunks():
+    client = FakeClient()
+    result = BatchWriter(client, chunkSize=2, backoff=0).commit(writes(5), op=UPDATE)
+    assert (result.written, result.failed) == (5, 0)
+    assert [chunk.size for chunk in result.chunks] == [2, 2, 1]
+    assert sorted(len(attempt) for attempt in client.attempts) == [1, 2, 2]
+    assert sorted(path for _, path, _ in client.committed) == [f"doc/{index}" for index in range(5)]
+    assert {op for op, _, _ in client.committed} == {UPDATE}
+
+def test_transient_errors_are_retried():
+    client = FakeClient([exceptions.ServiceUnavailable("down"), exceptions.Aborted("contention")])
+    result = BatchWriter(client, chunkSize=10, retries=3, backoff=0).commit(writes(3))
+    assert (result.written, result.failed) == (3, 0)
+    assert result.chunks[0].attempts == 3
+    assert len(client.committed) == 3
+
+def test_retries_run_out():
+    client = FakeClient([exceptions.DeadlineExceeded("slow")] * 3)
+    result = BatchWriter(client, chunkSize=10, retries=2, backoff=0).commit(writes(3))
+    assert (result.written, result.failed) == (0, 3)
+    assert result.chunks[0].attempts == 3
+    assert client.committed == []
+
+def test_no_retry():
+    client = FakeClient([exceptions.DeadlineExceeded("slow")])
+    result = BatchWriter(client, chunkSize=10, retries=3, backoff=0).commit(writes(3), retry=False)
+    assert (result.written, result.failed) == (0, 3)
+    assert len(client.attempts) == 1
+
+def test_permanent_errors_are_not_retried():
+    client = FakeClient([exceptions.NotFound("missing document")])
+    result = BatchWriter(client, chunkSize=10, retries=3, backoff=0).commit(writes(3), op=UPDATE)
+    assert result.failed == 3
+    assert result.chunks[0].error == "404 missing document"
+    assert len(client.attempts) == 1
+
+def test_async_writer():
+    client = FakeClient([exceptions.ServiceUnavailable("down")], batch=FakeAsyncBatch)
+    writer = AsyncBatchWriter(client, chunkSize=2, retries=3, backoff=0)
+    result = asyncio.run(writer.commit(writes(3)))
+    assert (result.written, result.failed) == (3, 0)
+    assert sorted(chunk.attempts for chunk in result.chunks) == [1, 2]
+
+    client = FakeClient([exceptions.ServiceUnavailable("down")], batch=FakeAsyncBatch)
+    result = asyncio.run(AsyncBatchWriter(client, chunkSize=10, backoff=0).commit(writes(3), retry=False))
+    assert (result.written, result.failed, len(client.attempts)) == (0, 3, 1)
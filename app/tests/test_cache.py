@@ -0,0 +1,101 @@
+import asyncio
+import time
+
+import db
+import db_async
+from cache import MISSING, TTLCache, cached, cached_async
+from conftest import EMAIL, OTHER_EMAIL
+from models import CategoryEntry, Transaction
+
+
+def test_ttl_expiry(monkeypatch):
+    cache = TTLCache("test_ttl_expiry", maxsize=10, ttl=60)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    cache.set("key", "value")
+    assert cache.get("key") == "value"
+
+    monkeypatch.setattr(time, "monotonic", lambda: now + 60)
+    assert cache.get("key") is MISSING
+    assert cache.stats()["expirations"] == 1
+    assert cache.stats()["size"] == 0
+
+def test_lru_eviction():
+    cache = TTLCache("test_lru_eviction", maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    # Reading "a" makes "b" the least recently used
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is MISSING
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.stats()["evictions"] == 1
+
+def test_invalidate_tenant():
+    cache = TTLCache("test_invalidate_tenant", maxsize=10, ttl=60)
+    calls = []
+
+    @cached(cache, per_user=True)
+    def lookup(email, key):
+        calls.append((email, key))
+        return f"{email}/{key}"
+
+    for email in [EMAIL, OTHER_EMAIL]:
+        lookup(email, 1)
+        lookup(email, 2)
+    lookup.invalidate_tenant(EMAIL)
+    for email in [EMAIL, OTHER_EMAIL]:
+        lookup(email, 1)
+        lookup(email, 2)
+    assert calls.count((EMAIL, 1)) == 2
+    assert calls.count((OTHER_EMAIL, 1)) == 1
+
+    lookup.invalidate(OTHER_EMAIL, 2)
+    lookup(OTHER_EMAIL, 2)
+    assert calls.count((OTHER_EMAIL, 2)) == 2
+    assert cache.tenants[OTHER_EMAIL] == {(OTHER_EMAIL, 1), (OTHER_EMAIL, 2)}
+
+def test_cached_async_shares_entries():
+    cache = TTLCache("test_cached_async_shares_entries", maxsize=10, ttl=60)
+    calls = []
+
+    @cached(cache, per_user=True)
+    def lookup(email):
+        calls.append("sync")
+        return email.upper()
+
+    @cached_async(cache, per_user=True)
+    async def lookup_async(email):
+        calls.append("async")
+        return email.upper()
+
+    assert lookup(EMAIL) == EMAIL.upper()
+    assert asyncio.run(lookup_async(EMAIL)) == EMAIL.upper()
+    lookup_async.invalidate_tenant(EMAIL)
+    assert asyncio.run(lookup_async(EMAIL)) == EMAIL.upper()
+    assert lookup(EMAIL) == EMAIL.upper()
+    assert calls == ["sync", "async"]
+
+def test_upsert_category_invalidates_only_its_user(storage):
+    categories = {email: [entry.category for entry in db.get_categories(email)] for email in [EMAIL, OTHER_EMAIL]}
+    # Written behind the cache's back, OTHER_EMAIL keeps the cached list
+    storage.save_category(OTHER_EMAIL, CategoryEntry(category="travel", icon="Flight", colorHex="#000000"))
+
+    assert db.upsert_category(CategoryEntry(category="rent", icon="Home", colorHex="#ffffff"), EMAIL)
+    assert [entry.category for entry in db.get_categories(EMAIL)] == ["rent"] + categories[EMAIL]
+    assert [entry.category for entry in db.get_categories(OTHER_EMAIL)] == categories[OTHER_EMAIL]
+    assert [entry.category for entry in asyncio.run(db_async.get_categories(EMAIL))] == ["rent"] + categories[EMAIL]
+
+    assert db.delete_category(next(entry.id for entry in storage.list_categories(EMAIL)), EMAIL)
+    assert [entry.category for entry in db.get_categories(EMAIL)] == categories[EMAIL]
+
+def test_transaction_writes_invalidate_get_transaction(storage):
+    assert db.get_transaction(EMAIL, "t0") is None
+    transaction = Transaction(id="t0", amount=10, timestamp=1709251200)
+    db.add_transactions_db(EMAIL, [transaction])
+    assert db.get_transaction(EMAIL, "t0") == transaction
+
+    changed = transaction.copy(update={"reason": "lunch"})
+    assert db.update_transaction(EMAIL, "t0", changed)
+    assert db.get_transaction(EMAIL, "t0") == changed
+    assert asyncio.run(db_async.get_transaction(EMAIL, "t0")) == changed
@@ -0,0 +1,51 @@
+import contextlib
+import io
+
+import db
+from benchmarks.corpus import generateCorpus
+from benchmarks.parse import compare
+from conftest import EMAIL
+from models import MessageStatus
+from parser import parseMessages
+
+
+def test_corpus_is_deterministic():
+    first = generateCorpus(300, 40, 30, seed=3)
+    assert generateCorpus(300, 40, 30, seed=3) == first
+    assert generateCorpus(300, 40, 30, seed=4)[0] != first[0]
+
+    messages, patterns, senders = first
+    assert (len(messages), len(patterns), len(senders)) == (300, 40, 30)
+    assert [message.timestamp for message in messages] == sorted((message.timestamp for message in messages), reverse=True)
+
+def test_parse_corpus(storage):
+    messages, patterns, senders = generateCorpus(300, 40, 30)
+    for pattern in patterns:
+        storage.save_pattern(pattern)
+    storage.save_senders(senders)
+    for message in messages:
+        storage.save_message(EMAIL, message.id, message.dict(exclude={"id"}))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        report = parseMessages(EMAIL, [message.copy() for message in messages], wait=True)
+    matched = {message.id for message in storage.list_messages_with_status(EMAIL, MessageStatus.matched.value, 0)}
+    transactions = storage.query_transactions(EMAIL)
+    assert report.matched == len(matched) > 0
+    assert {transaction.id for transaction in transactions} == matched
+    assert all(transaction.amount > 0 and transaction.account for transaction in transactions)
+
+    # Re-parsing known messages finds them all duplicates
+    db.sms_hashes.users.clear()
+    with contextlib.redirect_stdout(io.StringIO()):
+        parseMessages(EMAIL, [message.copy() for message in messages], wait=True)
+    assert storage.query_transactions(EMAIL) == transactions
+
+def test_compare_flags_slower_best_times():
+    def result(best, messages=1000):
+        return {"messages": messages, "patterns": 10, "senders": 50, "stages": {"match": {"median": best, "best": best}}}
+
+    baseline = {"scales": {"small": result(0.010)}}
+    assert compare({"small": result(0.014)}, baseline, tolerance=0.5) == []
+    assert compare({"small": result(0.016)}, baseline, tolerance=0.5) == ["small/match: 10.0 ms -> 16.0 ms (+60%)"]
+    # Other sizes are not compared
+    assert compare({"small": result(0.016, messages=2000)}, baseline, tolerance=0.5) == []
@@ -0,0 +1,160 @@
+import time
+
+from conftest import EMAIL, OTHER_EMAIL
+from models import Message, MessageStatus, Transaction
+from sharding import LocalLeaseStore, ShardWorker, shard_of
+from summary import month_key, transaction_delta
+
+# 2024-03-01 and 2024-04-01 UTC
+MARCH = 1709251200
+APRIL = 1711929600
+
+
+def transactions_at(*timestamps):
+    return [Transaction(id=f"t{index}", amount=10 * (index + 1), timestamp=timestamp, merchant=f"merchant{index}")
+            for index, timestamp in enumerate(timestamps)]
+
+def ids(transactions):
+    return [transaction.id for transaction in transactions]
+
+
+def test_messages(storage):
+    for index, status in enumerate(["unprocessed", "matched", "unprocessed"]):
+        storage.save_message(EMAIL, f"m{index}", {"sender": "BANK", "sms": f"sms {index}", "timestamp": 100 + index, "status": status})
+    storage.save_message(OTHER_EMAIL, "m9", {"sender": "BANK", "sms": "other", "timestamp": 100})
+
+    assert [message.id for message in storage.list_messages(EMAIL, 0)] == ["m2", "m1", "m0"]
+    assert [message.id for message in storage.list_messages(EMAIL, 101, limit=1)] == ["m2"]
+    assert [message.id for message in storage.list_messages_with_status(EMAIL, "unprocessed", 0)] == ["m2", "m0"]
+    assert sorted(storage.list_emails()) == [OTHER_EMAIL, EMAIL]
+
+    result = storage.update_message_statuses(EMAIL, [("m0", "matched", "p1"), ("missing", "matched", "p1")])
+    assert (result.written, result.failed) == (1, 1)
+    assert storage.list_messages(EMAIL, 100, limit=None)[-1] == Message(id="m0", sender="BANK", sms="sms 0", timestamp=100,
+                                                                        status=MessageStatus.matched, matchedPattern="p1")
+
+def test_transaction_queries(storage):
+    transactions = transactions_at(MARCH, MARCH + 10, MARCH + 10, APRIL)
+    assert storage.save_transactions(EMAIL, transactions).written == 4
+
+    assert ids(storage.query_transactions(EMAIL)) == ["t3", "t2", "t1", "t0"]
+    # query_transactions excludes the end, the stream and the pages include it
+    assert ids(storage.query_transactions(EMAIL, MARCH, APRIL)) == ["t2", "t1", "t0"]
+    assert ids(storage.stream_transactions(EMAIL, MARCH + 10, APRIL)) == ["t3", "t2", "t1"]
+    assert ids(storage.query_transactions_page(EMAIL, MARCH, APRIL, 2)) == ["t3", "t2"]
+    assert ids(storage.query_transactions_page(EMAIL, MARCH, APRIL, 2, after=(MARCH + 10, "t2"))) == ["t1", "t0"]
+
+    assert storage.get_transaction(EMAIL, "t1") == transactions[1]
+    assert storage.get_transaction(OTHER_EMAIL, "t1") is None
+    assert sorted(storage.get_transactions_by_id(EMAIL, ["t0", "t3", "missing"])) == ["t0", "t3"]
+
+def test_update_transaction_merges_fields_and_summary(storage):
+    transaction = transactions_at(MARCH)[0]
+    storage.save_transactions(EMAIL, [transaction])
+
+    change = Transaction(id="ignored", amount=999, timestamp=MARCH, category="food", merchant="changed")
+    merged = storage.update_transaction(EMAIL, transaction.id, change, transaction_delta, fields={"category"})
+    assert (merged.id, merged.category, merged.amount, merged.merchant) == ("t0", "food", 10, "merchant0")
+    assert storage.get_transaction(EMAIL, "t0") == merged
+
+    data = storage.get_summary(EMAIL, month_key(MARCH))
+    assert data["categories"]["food"]["count"] == 1
+    assert data["categories"]["uncategorized"]["count"] == -1
+
+def test_update_transaction_only_if(storage):
+    transaction = transactions_at(MARCH)[0]
+    storage.save_transactions(EMAIL, [transaction])
+
+    change = transaction.copy(update={"category": "food", "emailChecked": True})
+    assert storage.update_transaction(EMAIL, transaction.id, change, transaction_delta, only_if=lambda stored: stored.emailChecked) is None
+    assert storage.get_transaction(EMAIL, transaction.id) == transaction
+    assert storage.get_summary(EMAIL, month_key(MARCH)) is None
+
+    merged = storage.update_transaction(EMAIL, transaction.id, change, transaction_delta, only_if=lambda stored: not stored.emailChecked)
+    assert merged == change
+    assert storage.get_transaction(EMAIL, transaction.id) == change
+
+def test_summary_generation(storage):
+    month = month_key(MARCH)
+    assert storage.get_summary(EMAIL, month) is None
+    assert not storage.set_summary(EMAIL, month, {"built": True, "generation": 1}, generation=1)
+    assert storage.set_summary(EMAIL, month, {"built": True, "generation": 0}, generation=0)
+
+    delta = transaction_delta(None, transactions_at(MARCH)[0])
+    assert storage.increment_summaries(EMAIL, delta).written == 1
+    data = storage.get_summary(EMAIL, month)
+    assert data["generation"] == 1
+    assert data["totals"]["count"] == 1
+    # An increment since the read makes the write lose
+    assert not storage.set_summary(EMAIL, month, {"built": True, "generation": 0}, generation=0)
+
+    storage.delete_summaries(EMAIL, [month])
+    assert storage.get_summary(EMAIL, month) is None
+
+def test_sms_hashes(storage):
+    assert storage.create_sms_hash(EMAIL, "digest", {"messageId": "m0", "timestamp": 1})
+    assert not storage.create_sms_hash(EMAIL, "digest", {"messageId": "m1", "timestamp": 2})
+    assert storage.create_sms_hash(OTHER_EMAIL, "digest", {"messageId": "m1", "timestamp": 2})
+    assert storage.get_sms_hashes(EMAIL, ["digest", "missing"]) == {"digest": {"messageId": "m0", "timestamp": 1}}
+
+    storage.delete_sms_hash(EMAIL, "digest")
+    assert storage.get_sms_hashes(EMAIL, ["digest"]) == {}
+
+def test_enrichment_lease_expiry(storage):
+    assert storage.queue_enrichments(EMAIL, ["t0", "t1"], now=100) == 2
+    assert storage.queue_enrichments(EMAIL, ["t0"], now=100) == 0
+    assert storage.pending_enrichments(10, now=99) == []
+
+    items = storage.pending_enrichments(10, now=100)
+    assert sorted(item["transactionId"] for item in items) == ["t0", "t1"]
+    item_id = next(item["id"] for item in items if item["transactionId"] == "t0")
+
+    assert storage.claim_enrichment(item_id, "node-a", now=100, seconds=30)
+    # The lease is live until it runs out, for its owner too
+    assert not storage.claim_enrichment(item_id, "node-b", now=120, seconds=30)
+    assert not storage.claim_enrichment(item_id, "node-a", now=130, seconds=30)
+    assert [item["transactionId"] for item in storage.pending_enrichments(10, now=120)] == ["t1"]
+
+    # node-a died holding it, the expired lease comes first
+    assert [item["transactionId"] for item in storage.pending_enrichments(10, now=131)] == ["t0", "t1"]
+    assert storage.claim_enrichment(item_id, "node-b", now=131, seconds=30)
+
+    storage.retry_enrichment(item_id, {"status": "pending", "attempts": 1, "nextAttempt": 200})
+    assert not storage.claim_enrichment(item_id, "node-a", now=199, seconds=30)
+    assert storage.claim_enrichment(item_id, "node-a", now=200, seconds=30)
+    storage.complete_enrichment(item_id)
+    assert [item["transactionId"] for item in storage.pending_enrichments(10, now=1000)] == ["t1"]
+
+def test_refresh_lease_handoff(storage):
+    leases = storage.lease_store()
+    assert leases.claim(0, "node-a", cycle=1, now=100, seconds=30)
+    assert not leases.claim(0, "node-b", cycle=1, now=110, seconds=30)
+    assert leases.renew(0, "node-a", now=125, seconds=30)
+    assert not leases.renew(0, "node-b", now=125, seconds=30)
+    # Renewed past the first expiry
+    assert not leases.claim(0, "node-b", cycle=1, now=140, seconds=30)
+
+    # node-a stops renewing, its lease runs out
+    assert leases.claim(0, "node-b", cycle=1, now=156, seconds=30)
+    assert not leases.renew(0, "node-a", now=157, seconds=30)
+    leases.release(0, "node-a", cycle=1)
+    leases.release(0, "node-b", cycle=1)
+    # Done for the cycle, until the next one
+    assert not leases.claim(0, "node-a", cycle=1, now=200, seconds=30)
+    assert leases.claim(0, "node-a", cycle=2, now=200, seconds=30)
+
+def test_shard_worker_takes_over_expired_lease():
+    store = LocalLeaseStore()
+    emails = [f"user{index}@example.com" for index in range(20)]
+    worker = ShardWorker(store, shards=4, leaseSeconds=60, cycleSeconds=3600, owner="node-b")
+    cycle = int(time.time() // worker.cycleSeconds)
+    dead = shard_of(emails[0], 4)
+    # Left behind by a node that died a minute ago
+    assert store.claim(dead, "node-a", cycle, time.time() - 60, 30)
+
+    processed = worker.run(emails, lambda shardEmails: shardEmails)
+    assert sorted(processed) == sorted(emails)
+    assert store.leases[dead]["owner"] == ""
+    assert store.leases[dead]["cycle"] == cycle
+    # Nothing left to do this cycle
+    assert worker.run(emails, lambda shardEmails: shardEmails) == []
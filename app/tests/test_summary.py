@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+import db
+import db_async
+from conftest import EMAIL
+from models import BatchWriteResult, Transaction, TransactionType
+from summary import build_summary, month_bounds
+
+MONTH = "2024-03"
+MARCH = 1709251200
+
+
+def expected(storage):
+    start, end = month_bounds(MONTH)
+    return comparable(build_summary(MONTH, storage.query_transactions(EMAIL, start, end + 1)))
+
+def comparable(summary):
+    # Increments leave categories that went back to zero behind
+    empty = {"debit": 0, "credit": 0, "count": 0}
+    return {**summary.dict(), "categories": {name: totals for name, totals in summary.dict()["categories"].items() if totals != empty}}
+
+def add(*transactions):
+    db.add_transactions_db(EMAIL, list(transactions))
+
+
+def test_increments_match_a_rebuild(storage):
+    add(Transaction(id="a", amount=10, timestamp=MARCH, category="food"))
+    # Never built, built from the transactions on first read
+    assert comparable(db.get_monthly_summary(EMAIL, MONTH)) == expected(storage)
+    assert storage.get_summary(EMAIL, MONTH)["built"]
+
+    add(Transaction(id="b", amount=25, timestamp=MARCH + 1, transactiontype=TransactionType.credit),
+        Transaction(id="c", amount=5, timestamp=MARCH + 2, category="food"))
+    db.update_transaction(EMAIL, "a", Transaction(id="a", amount=10, timestamp=MARCH, category="rent"))
+    db.update_transaction(EMAIL, "c", Transaction(id="c", amount=5, timestamp=MARCH + 2, category="food", ignore=True))
+    summary = db.get_monthly_summary(EMAIL, MONTH)
+    assert comparable(summary) == expected(storage)
+    assert (summary.totals.debit, summary.totals.credit, summary.ignored.count) == (10, 25, 1)
+    assert comparable(asyncio.run(db_async.get_monthly_summary(EMAIL, MONTH))) == expected(storage)
+
+def test_rebuild_after_reset(storage):
+    add(Transaction(id="a", amount=10, timestamp=MARCH), Transaction(id="b", amount=20, timestamp=MARCH + 1))
+    before = comparable(db.get_monthly_summary(EMAIL, MONTH))
+
+    db.reset_monthly_summaries(EMAIL, [MONTH])
+    assert storage.get_summary(EMAIL, MONTH) is None
+    assert comparable(db.get_monthly_summary(EMAIL, MONTH)) == before == expected(storage)
+
+    asyncio.run(db_async.reset_monthly_summaries(EMAIL, [MONTH]))
+    assert storage.get_summary(EMAIL, MONTH) is None
+    assert comparable(asyncio.run(db_async.get_monthly_summary(EMAIL, MONTH))) == before
+    assert storage.get_summary(EMAIL, MONTH)["built"]
+
+def test_failed_increment_resets_the_month(storage, monkeypatch):
+    add(Transaction(id="a", amount=10, timestamp=MARCH))
+    db.get_monthly_summary(EMAIL, MONTH)
+
+    monkeypatch.setattr(storage, "increment_summaries", lambda email, delta: BatchWriteResult(failed=len(delta)))
+    add(Transaction(id="b", amount=20, timestamp=MARCH + 1))
+    assert storage.get_summary(EMAIL, MONTH) is None
+    assert db.get_monthly_summary(EMAIL, MONTH).totals.count == 2
+
+def test_failed_update_resets_the_month(storage, monkeypatch):
+    add(Transaction(id="a", amount=10, timestamp=MARCH))
+    db.get_monthly_summary(EMAIL, MONTH)
+
+    update = storage.update_transaction
+
+    def landed_then_failed(*args, **kwargs):
+        update(*args, **kwargs)
+        raise TimeoutError("commit outcome unknown")
+
+    monkeypatch.setattr(storage, "update_transaction", landed_then_failed)
+    with pytest.raises(TimeoutError):
+        db.update_transaction(EMAIL, "a", Transaction(id="a", amount=10, timestamp=MARCH, category="rent"))
+    assert storage.get_summary(EMAIL, MONTH) is None
+    assert comparable(db.get_monthly_summary(EMAIL, MONTH)) == expected(storage)
+
+def test_rebuild_retries_when_incremented_meanwhile(storage, monkeypatch):
+    add(Transaction(id="a", amount=10, timestamp=MARCH))
+    db.reset_monthly_summaries(EMAIL, [MONTH])
+
+    query = db._query_transactions
+    reads = []
+
+    def query_then_write(email, start=None, end=None):
+        transactions = query(email, start, end)
+        if start != month_bounds(MONTH)[0]:
+            # The current month, loaded in the background after a write
+            return transactions
+        reads.append(len(transactions))
+        if len(reads) == 1:
+            # A write lands while the rebuild holds the old transactions
+            add(Transaction(id="b", amount=20, timestamp=MARCH + 1))
+        return transactions
+
+    monkeypatch.setattr(db, "_query_transactions", query_then_write)
+    summary = db.get_monthly_summary(EMAIL, MONTH)
+    assert reads == [1, 2]
+    assert summary.totals.count == 2
+    assert comparable(db.get_monthly_summary(EMAIL, MONTH)) == expected(storage)
@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+import db
+import db_async
+from conftest import EMAIL
+from models import Transaction
+from transaction_store import TransactionStore
+
+# 2024-03-01, 2024-04-01 and 2024-05-01 UTC
+MARCH = 1709251200
+APRIL = 1711929600
+MAY = 1714521600
+
+
+def transaction(id, timestamp, **fields):
+    return Transaction(id=id, amount=10, timestamp=timestamp, **fields)
+
+def ids(transactions):
+    return [transaction.id for transaction in transactions]
+
+
+def test_missing_joins_contiguous_months():
+    store = TransactionStore(ttl=60)
+    assert store.missing(EMAIL, MARCH, MAY + 10) == [(MARCH, MAY + 31 * 86400)]
+    store.fill(EMAIL, APRIL, MAY, [], time.monotonic())
+    assert store.missing(EMAIL, MARCH, MAY + 10) == [(MARCH, APRIL), (MAY, MAY + 31 * 86400)]
+    assert store.missing(EMAIL, None, None) == [(None, None)]
+
+    store.fill(EMAIL, None, None, [], time.monotonic())
+    assert store.missing(EMAIL, None, None) == []
+    assert store.missing(EMAIL, MARCH, MAY) == []
+
+def test_range_and_page():
+    store = TransactionStore(ttl=60)
+    transactions = [transaction("a", MARCH), transaction("b", MARCH + 5), transaction("c", MARCH + 5), transaction("d", APRIL + 1)]
+    store.fill(EMAIL, MARCH, MAY, transactions, time.monotonic())
+
+    assert ids(store.range(EMAIL, MARCH, MAY)) == ["d", "c", "b", "a"]
+    assert ids(store.range(EMAIL, MARCH + 1, MARCH + 5)) == ["c", "b"]
+    assert ids(store.page(EMAIL, MARCH, MAY, 2)) == ["d", "c"]
+    assert ids(store.page(EMAIL, MARCH, MAY, 2, after=(MARCH + 5, "c"))) == ["b", "a"]
+
+    # Moving a transaction to another month moves it between buckets
+    store.upsert(EMAIL, transaction("a", APRIL + 2))
+    assert ids(store.range(EMAIL, MARCH, MAY)) == ["a", "d", "c", "b"]
+    assert ids(store.range(EMAIL, MARCH, APRIL)) == ["c", "b"]
+
+def test_fill_replays_only_writes_after_the_query():
+    store = TransactionStore(ttl=60)
+    store.upsert(EMAIL, transaction("old", MARCH, reason="before"))
+    queriedAt = time.monotonic()
+    store.upsert(EMAIL, transaction("new", MARCH, reason="after"))
+
+    # The query saw the first write, and a later change to it that the
+    # buffered write must not roll back
+    store.fill(EMAIL, MARCH, APRIL, [transaction("old", MARCH, reason="later")], queriedAt)
+    assert {item.id: item.reason for item in store.range(EMAIL, MARCH, APRIL - 1)} == {"old": "later", "new": "after"}
+    assert store.user(EMAIL).unloadedWrites == {}
+
+def test_fill_leaves_loaded_months_alone():
+    store = TransactionStore(ttl=60)
+    store.fill(EMAIL, MARCH, APRIL, [transaction("a", MARCH)], time.monotonic())
+    queriedAt = time.monotonic()
+    store.upsert(EMAIL, transaction("a", MARCH, reason="written"))
+
+    # A slower, overlapping query started before the write
+    store.fill(EMAIL, MARCH, MAY, [transaction("a", MARCH), transaction("b", MARCH + 1), transaction("c", APRIL)], queriedAt)
+    assert {item.id: item.reason for item in store.range(EMAIL, MARCH, MAY)} == {"a": "written", "c": ""}
+
+def test_get_transactions_follows_writes(storage):
+    storage.save_transactions(EMAIL, [transaction("a", MARCH), transaction("b", APRIL)])
+    assert ids(db.get_transactions(EMAIL, MARCH, MAY)) == ["b", "a"]
+    assert db.transaction_store.missing(EMAIL, MARCH, MAY) == []
+
+    db.add_transactions_db(EMAIL, [transaction("c", MARCH + 1)])
+    assert db.update_transaction(EMAIL, "b", transaction("b", APRIL, reason="rent"))
+    # Milliseconds are accepted too
+    expected = storage.query_transactions(EMAIL, MARCH, MAY + 1)
+    assert db.get_transactions(EMAIL, MARCH * 1000, MAY * 1000) == expected
+    assert asyncio.run(db_async.get_transactions(EMAIL, MARCH, MAY)) == expected
+    assert db.get_transactions_page(EMAIL, MARCH, MAY, limit=2, after=(APRIL, "b")) == expected[1:3]
+
+def test_get_transactions_page_reads_storage_for_unloaded_months(storage):
+    storage.save_transactions(EMAIL, [transaction("a", MARCH), transaction("b", APRIL)])
+    assert ids(db.get_transactions_page(EMAIL, MARCH, MAY, limit=1)) == ["b"]
+    # Paging does not load the window
+    assert db.transaction_store.missing(EMAIL, MARCH, MAY) != []
+    assert ids(asyncio.run(db_async.get_transactions_page(EMAIL, MARCH, MAY, limit=1, after=(APRIL, "b")))) == ["a"]
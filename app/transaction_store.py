@@ -0,0 +1,217 @@
+import datetime
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, List, Optional, Set, Tuple
+
+from cache import DEFAULT_MAXSIZE, DEFAULT_TTL_SECONDS, MISSING, TTLCache
+from models import Transaction
+
+Month = Tuple[int, int]
+
+# Writes to months that are not loaded are kept around this long (in number
+# of entries) so a load that was already in flight does not miss them
+MAX_UNLOADED_WRITES = 1000
+
+
+def month_of(timestamp: int) -> Month:
+    date = datetime.datetime.utcfromtimestamp(timestamp)
+    return date.year, date.month
+
+def month_start(month: Month) -> int:
+    year, monthNumber = month
+    return int(datetime.datetime(year, monthNumber, 1, tzinfo=datetime.timezone.utc).timestamp())
+
+def next_month(month: Month) -> Month:
+    year, monthNumber = month
+    return (year + 1, 1) if monthNumber == 12 else (year, monthNumber + 1)
+
+def months_between(from_ts: int, to_ts: int) -> List[Month]:
+    months = []
+    month, last = month_of(from_ts), month_of(to_ts)
+    while month <= last:
+        months.append(month)
+        month = next_month(month)
+    return months
+
+
+class UserTransactions():
+    def __init__(self):
+        self.buckets: Dict[Month, List[Tuple[int, str]]] = {}
+        self.byId: Dict[str, Transaction] = {}
+        self.months: Set[Month] = set()
+        self.complete = False
+        # Transaction id -> (transaction, time.monotonic() of the write)
+        self.unloadedWrites: Dict[str, Tuple[Transaction, float]] = {}
+        self.lock = threading.RLock()
+
+    def isLoaded(self, month: Month) -> bool:
+        return self.complete or month in self.months
+
+    def insert(self, transaction: Transaction):
+        self.remove(transaction.id)
+        key = (transaction.timestamp, transaction.id)
+        insort(self.buckets.setdefault(month_of(transaction.timestamp), []), key)
+        self.byId[transaction.id] = transaction
+
+    def remove(self, transaction_id: str):
+        existing = self.byId.pop(transaction_id, None)
+        if existing is None:
+            return
+        bucket = self.buckets.get(month_of(existing.timestamp), [])
+        key = (existing.timestamp, existing.id)
+        index = bisect_left(bucket, key)
+        if index < len(bucket) and bucket[index] == key:
+            bucket.pop(index)
+
+
+class TransactionStore():
+    """
+    Per-user, in-memory copy of the transactions collection. Transactions
+    are kept in per-month buckets of (timestamp, id) keys sorted with
+    bisect, and the store remembers which months have been loaded, so any
+    [from, to] window is answered from memory once its months are present.
+
+    The caller fetches what missing() reports and hands it to fill(); writes
+    are applied in place with upsert(). Open-ended windows need the user's
+    whole history, which is loaded once and marks the user complete. A
+    loaded month is kept up to date by upsert() and never replaced by a
+    later fill(), whose query may have started before the latest writes.
+
+    Users are held in a TTLCache: the least recently used are evicted past
+    maxsize, and a user's months are dropped and loaded again ttl seconds
+    after the user was first loaded, so writes made by other processes show
+    up within ttl.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_MAXSIZE, ttl: float = DEFAULT_TTL_SECONDS):
+        self.users = TTLCache("transaction_store", maxsize, ttl)
+        self.lock = threading.Lock()
+
+    def user(self, email: str) -> UserTransactions:
+        with self.lock:
+            user = self.users.get(email)
+            if user is MISSING:
+                user = UserTransactions()
+                self.users.set(email, user)
+        return user
+
+    def missing(self, email: str, from_ts: Optional[int], to_ts: Optional[int]) -> List[Tuple[Optional[int], Optional[int]]]:
+        """
+        Returns the [start, end) timestamp ranges to fetch, contiguous missing
+        months joined into one range. (None, None) stands for everything.
+        """
+        user = self.user(email)
+        with user.lock:
+            if user.complete:
+                return []
+            if not from_ts or not to_ts:
+                return [(None, None)]
+            ranges = []
+            for month in months_between(from_ts, to_ts):
+                if month in user.months:
+                    continue
+                start, end = month_start(month), month_start(next_month(month))
+                if ranges and ranges[-1][1] == start:
+                    ranges[-1] = (ranges[-1][0], end)
+                else:
+                    ranges.append((start, end))
+            return ranges
+
+    def fill(self, email: str, start: Optional[int], end: Optional[int], transactions: List[Transaction], queriedAt: float):
+        """
+        Stores what a query for [start, end) returned, queriedAt being the
+        time.monotonic() it started at. Months loaded meanwhile are left
+        alone. Of the writes upserted while the months were not loaded, only
+        those made after queriedAt are applied over the result: earlier ones
+        are in it already, and may be older than it.
+        """
+        user = self.user(email)
+        with user.lock:
+            if user.complete:
+                return
+            loaded = set(user.months)
+            if start is None:
+                user.complete = True
+            else:
+                user.months.update(months_between(start, end - 1))
+
+            for transaction in transactions:
+                # Present ones are in a loaded month, upserted since
+                if transaction.id not in user.byId and month_of(transaction.timestamp) not in loaded:
+                    user.insert(transaction)
+            for transaction_id, (transaction, writtenAt) in list(user.unloadedWrites.items()):
+                if start is None or start <= transaction.timestamp < end:
+                    del user.unloadedWrites[transaction_id]
+                    if writtenAt >= queriedAt:
+                        user.insert(transaction)
+
+    def upsert(self, email: str, transaction: Transaction):
+        transaction = Transaction(**transaction.dict())
+        user = self.user(email)
+        with user.lock:
+            if user.isLoaded(month_of(transaction.timestamp)):
+                user.insert(transaction)
+                return
+            # The transaction may have moved out of a loaded month
+            user.remove(transaction.id)
+            if len(user.unloadedWrites) >= MAX_UNLOADED_WRITES:
+                user.unloadedWrites.clear()
+            user.unloadedWrites[transaction.id] = (transaction, time.monotonic())
+
+    def range(self, email: str, from_ts: Optional[int], to_ts: Optional[int]) -> List[Transaction]:
+        """
+        Returns the transactions with from_ts <= timestamp <= to_ts, newest
+        first. Either bound may be None for an open end.
+        """
+        user = self.user(email)
+        with user.lock:
+            months = sorted(user.buckets, reverse=True)
+            if from_ts:
+                months = [month for month in months if month >= month_of(from_ts)]
+            if to_ts:
+                months = [month for month in months if month <= month_of(to_ts)]
+
+            transactions = []
+            for month in months:
+                bucket = user.buckets[month]
+                low = bisect_left(bucket, (from_ts,)) if from_ts else 0
+                high = bisect_right(bucket, (to_ts, "\uffff")) if to_ts else len(bucket)
+                for _, transaction_id in reversed(bucket[low:high]):
+                    transactions.append(user.byId[transaction_id])
+            return transactions
+
+    def page(self, email: str, from_ts: Optional[int], to_ts: Optional[int], limit: int,
+             after: Optional[Tuple[int, str]] = None) -> List[Transaction]:
+        """
+        Like range(), but returns at most limit transactions that come after
+        the (timestamp, id) key "after" in newest-first order.
+        """
+        user = self.user(email)
+        with user.lock:
+            months = sorted(user.buckets, reverse=True)
+            if from_ts:
+                months = [month for month in months if month >= month_of(from_ts)]
+            if to_ts:
+                months = [month for month in months if month <= month_of(to_ts)]
+            if after:
+                months = [month for month in months if month <= month_of(after[0])]
+
+            transactions = []
+            for month in months:
+                bucket = user.buckets[month]
+                low = bisect_left(bucket, (from_ts,)) if from_ts else 0
+                high = bisect_right(bucket, (to_ts, "\uffff")) if to_ts else len(bucket)
+                if after:
+                    high = min(high, bisect_left(bucket, after))
+                for index in range(high - 1, low - 1, -1):
+                    transactions.append(user.byId[bucket[index][1]])
+                    if len(transactions) == limit:
+                        return transactions
+            return transactions
+
+    def invalidate(self, email: Optional[str] = None):
+        if email is None:
+            self.users.clear()
+        else:
+            self.users.invalidate(email)
@@ -1,10 +1,12 @@
-from typing import List
-from db import add_merchant, add_transactions_db, get_merchants, get_transaction, get_transaction_uncached, update_transaction
-from models import AddTransactionReasonRequest, Category, Transaction
+from typing import List, Optional
+from db import add_merchant, add_transactions_db, enqueue_enrichments, get_merchants, get_transaction, get_transaction_uncached, get_transactions_by_id, update_transaction
+from models import AddTransactionReasonRequest, BatchWriteResult, Category, Transaction
 from fastapi import HTTPException
+from enrichment import EnrichmentQueue
 from mail import Mail
 import logging
 import re
+from bisect import bisect_left, bisect_right
 
 from utils import measure_time
 
@@ -42,56 +44,92 @@ def categorize_transaction(transaction_id: str, category: Category, email: str,
     add_merchant(transaction.merchant, category)
     return "ok"
 
-@measure_time
-def checkMailForTransaction(transaction: Transaction):
-    try:
-        # Checking phonepe emails for UPI transactions
-        if transaction.type == "upi":
-            logging.info(f"Checking email for {transaction.merchant}")
-            fromEpoch = transaction.timestamp - 120
-            toEpoch = transaction.timestamp + 120
-            mails = Mail().getEmailsFrom("noreply@phonepe.com", fromEpoch, toEpoch)
-            if len(mails) == 0:
-                logging.info("No emails found")
-                transaction.emailChecked = True
-            if len(mails) == 1:
-                mail = mails[0]
-                subjectJson = mail.parseSubject(r"Sent\s+₹\s*(?P<amount>\d+)\s+to\s+(?P<merchant>.+)")
-                amount = subjectJson.get("amount", 0)
-                if amount:
-                    # Remove anything but digits and comma and dot from amount
-                    amount = re.sub(r"[^\d,.]", "", amount)
-                    amount = int(amount)
-                    if amount != transaction.amount:
-                        logging.info(f"Amount mismatch, expected {transaction.amount}, got {amount}")
-                        return
-                pattern = re.compile(
-                    r"Paid to\s+(?P<recipient>[A-Z\s]+)\s+₹\s*(?P<amount>\d+).*?"
-                    r"Bank Ref\. No\.\s*:\s*(?P<ref_no>\d+).*?"
-                    r"Message\s*:\s*(?P<message>\S.*?)?(?:\s+[A-Z][a-z]+|$)",
-                    re.DOTALL
-                )
-                contentJson = mail.parseHtmlContent(pattern)
-                logging.info(contentJson)
-                merchant = contentJson.get("recipient")
-                if merchant and merchant != transaction.merchant:
-                    logging.info(f"Updating merchant from email: {merchant}")
-                    transaction.merchant = merchant
-                message = contentJson.get("message")
-                if message:
-                    transaction.message = message
-                    try:
-                        category = Category[message.lower()]
-                        transaction.category = category
-                    except KeyError:
-                        pass
-                transaction.emailChecked = True
-            if len(mails) > 1:
-                logging.info("Found multiple emails, Ignoring for now")
-                transaction.emailChecked = True
-                transaction.multipleMails = True
-    except Exception as e:
-        logging.exception(f"Error checking email for {transaction.merchant}: {str(e)}")
+# PhonePe sends one mail per UPI payment within a couple of minutes of it
+MAIL_WINDOW_SECONDS = 120
+SUBJECT_PATTERN = re.compile(r"Sent\s+₹\s*(?P<amount>\d+)\s+to\s+(?P<merchant>.+)")
+CONTENT_PATTERN = re.compile(
+    r"Paid to\s+(?P<recipient>[A-Z\s]+)\s+₹\s*(?P<amount>\d+).*?"
+    r"Bank Ref\. No\.\s*:\s*(?P<ref_no>\d+).*?"
+    r"Message\s*:\s*(?P<message>\S.*?)?(?:\s+[A-Z][a-z]+|$)",
+    re.DOTALL
+)
+
+def applyMailsToTransaction(transaction: Transaction, mails):
+    """
+    Updates the transaction from the PhonePe mails found in its window.
+    """
+    if len(mails) == 0:
+        logging.info("No emails found")
+        transaction.emailChecked = True
+    if len(mails) == 1:
+        mail = mails[0]
+        subjectJson = mail.parseSubject(SUBJECT_PATTERN)
+        amount = subjectJson.get("amount", 0)
+        if amount:
+            # Remove anything but digits and comma and dot from amount
+            amount = re.sub(r"[^\d,.]", "", amount)
+            amount = int(amount)
+            if amount != transaction.amount:
+                logging.info(f"Amount mismatch, expected {transaction.amount}, got {amount}")
+                return
+        contentJson = mail.parseHtmlContent(CONTENT_PATTERN)
+        logging.info(contentJson)
+        merchant = contentJson.get("recipient")
+        if merchant and merchant != transaction.merchant:
+            logging.info(f"Updating merchant from email: {merchant}")
+            transaction.merchant = merchant
+        message = contentJson.get("message")
+        if message:
+            transaction.message = message
+            try:
+                category = Category[message.lower()]
+                transaction.category = category
+            except KeyError:
+                pass
+        transaction.emailChecked = True
+    if len(mails) > 1:
+        logging.info("Found multiple emails, Ignoring for now")
+        transaction.emailChecked = True
+        transaction.multipleMails = True
+
+def enrichFromMails(transactions: List[Transaction]):
+    """
+    Enriches the UPI transactions from PhonePe mails with one IMAP search
+    covering all their windows; each transaction then gets the mails that
+    fall in its own window. Raises when the mails cannot be read.
+    """
+    transactions = [transaction for transaction in transactions if transaction.type == "upi"]
+    if not transactions:
+        return
+    logging.info(f"Checking email for {len(transactions)} transactions")
+    windows = [(transaction.timestamp - MAIL_WINDOW_SECONDS, transaction.timestamp + MAIL_WINDOW_SECONDS) for transaction in transactions]
+    mails = sorted(Mail().getEmailsInWindows("noreply@phonepe.com", windows), key=lambda mail: mail.date.timestamp())
+
+    mailTimes = [mail.date.timestamp() for mail in mails]
+    for transaction, (fromEpoch, toEpoch) in zip(transactions, windows):
+        try:
+            low, high = bisect_left(mailTimes, fromEpoch), bisect_right(mailTimes, toEpoch)
+            applyMailsToTransaction(transaction, mails[low:high])
+        except Exception as e:
+            logging.exception(f"Error checking email for {transaction.merchant}: {str(e)}")
+
+def needsMailCheck(transaction: Transaction) -> bool:
+    return transaction.emailChecked == False and transaction.category == Category.uncategorized
+
+def pendingMailCheck(transaction: Transaction) -> bool:
+    # False once it changed since it was queued, e.g. categorized by hand
+    return not transaction.ignore and needsMailCheck(transaction)
+
+def enrichQueued(transactions: List[Transaction]):
+    enrichFromMails([transaction for transaction in transactions if pendingMailCheck(transaction)])
+
+# What applyMailsToTransaction sets, the only fields the queue saves
+MAIL_FIELDS = {"merchant", "message", "category", "emailChecked", "multipleMails"}
+
+enrichmentQueue = EnrichmentQueue(enrichQueued, MAIL_FIELDS, pendingMailCheck)
+
+def needsEnrichment(transaction: Transaction) -> bool:
+    return transaction.type == "upi" and needsMailCheck(transaction)
 
 @measure_time
 def update_category(transaction, existingtransaction=None):
@@ -103,25 +141,30 @@ def update_category(transaction, existingtransaction=None):
     if existingtransaction:
         if existingtransaction.emailChecked:
             transaction.emailChecked = True
-    if transaction.emailChecked == False and transaction.category == Category.uncategorized:
-        checkMailForTransaction(transaction)
     if transaction.category != Category.uncategorized:
         print(f"Updating category for {transaction.merchant} to {transaction.category}")
 
 @measure_time
-def add_transactions(email: str, transactions: List[Transaction]):
+def add_transactions(email: str, transactions: List[Transaction]) -> Optional[BatchWriteResult]:
     if not transactions:
-        return False
+        return None
+
+    existingtransactions = get_transactions_by_id(email, [transaction.id for transaction in transactions])
 
+    # Mail checks are slow, so the transactions are saved first and the ones
+    # still uncategorized are queued for a mail check
     transactionToAdd = []
+    toEnrich = []
     for transaction in transactions:
         try:
-            existingtransaction = get_transaction(email, transaction.id)
+            existingtransaction = existingtransactions.get(transaction.id)
             if existingtransaction:
                 if existingtransaction.ignore:
                     continue
                 if existingtransaction.category == Category.uncategorized:
                     update_category(transaction, existingtransaction)
+                    if needsEnrichment(transaction):
+                        toEnrich.append(transaction.id)
                     if transaction.dict() == existingtransaction.dict():
                         continue
                     logging.info(f"Updating transaction: {existingtransaction.dict()}")
@@ -134,6 +177,13 @@ def add_transactions(email: str, transactions: List[Transaction]):
         except Exception as e:
             logging.exception(f"Error adding transaction: {transaction}: {str(e)}")
 
+    result = None
     if len(transactionToAdd) > 0:
         print(f"Adding {len(transactionToAdd)} transactions")
-        add_transactions_db(email, transactionToAdd)
+        result = add_transactions_db(email, transactionToAdd, check_existing=False)
+        # Items whose transaction did not land are dropped by the queue
+        toEnrich.extend(transaction.id for transaction in transactionToAdd if needsEnrichment(transaction))
+
+    if toEnrich and enqueue_enrichments(email, toEnrich):
+        enrichmentQueue.notify()
+    return result
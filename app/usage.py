@@ -0,0 +1,182 @@
+import contextvars
+import functools
+import logging
+import os
+import threading
+from typing import AsyncIterator, Dict, Iterable, Optional
+
+FIELDS = ("reads", "writes", "deletes", "round_trips")
+# Per route budgets, "*" applying to the routes without their own, as
+# "/messages reads=2000 round_trips=100; /processmessages reads=20000; * reads=50000"
+BUDGETS = os.environ.get("FIRESTORE_BUDGETS", "")
+# "log" only logs requests going over their budget, "reject" also stops them
+# at the call that goes over it, unless they have started writing
+BUDGET_ACTION = os.environ.get("FIRESTORE_BUDGET_ACTION", "log")
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def parse_budgets(spec: str) -> Dict[str, Dict[str, int]]:
+    budgets = {}
+    for entry in spec.split(";"):
+        parts = entry.split()
+        if not parts:
+            continue
+        route, limits = parts[0], {}
+        for part in parts[1:]:
+            field, _, limit = part.partition("=")
+            if field not in FIELDS or not limit.isdigit():
+                raise ValueError(f"Invalid Firestore budget {part!r} for {route}")
+            limits[field] = int(limit)
+        budgets[route] = limits
+    return budgets
+
+budgets = parse_budgets(BUDGETS)
+
+def budget_for(route: str) -> Dict[str, int]:
+    return budgets.get(route, budgets.get("*", {}))
+
+
+class Usage():
+    """
+    The Firestore documents read, written and deleted and the round trips
+    made on behalf of one request. The storage layer records into the Usage
+    of the current request, found through a context variable, which
+    run_in_threadpool and asyncio tasks carry along; work submitted to an
+    executor carries it only through propagate. Work left running after the
+    response (background tasks, the parser executor, cache-populating
+    threads) is not counted.
+
+    A streamed body (stream()) is produced after the handler returned and
+    its reads are counted, and held to the budget, until it is sent. The
+    headers go out before the body, so on a streamed response they hold only
+    what was read before it; the logged counts are complete.
+    """
+    def __init__(self, route: str = "", budget: Optional[Dict[str, int]] = None):
+        self.route = route
+        self.budget = budget or {}
+        self.reads = 0
+        self.writes = 0
+        self.deletes = 0
+        self.round_trips = 0
+        # Over budget on these, logged once
+        self.exceeded = set()
+        # Set once the response is on its way, nothing is rejected after
+        self.finished = False
+        # Set when the body is produced while it is sent, see stream()
+        self.streaming = False
+        # Set once the request starts writing, nothing is rejected after
+        # either, so a write made of several steps (transactions, then the
+        # summaries they change) is never cut off halfway
+        self.writing = False
+        self.lock = threading.Lock()
+
+    def add(self, reads: int = 0, writes: int = 0, deletes: int = 0, round_trips: int = 1):
+        with self.lock:
+            self.reads += reads
+            self.writes += writes
+            self.deletes += deletes
+            self.round_trips += round_trips
+            if writes or deletes:
+                self.writing = True
+            if not self.budget:
+                return
+            over = {field for field, limit in self.budget.items() if getattr(self, field) > limit}
+            newly = over - self.exceeded
+            self.exceeded |= newly
+        if newly:
+            logging.warning(f"{self.route} went over its Firestore budget on {', '.join(sorted(newly))}: {self.counts()} > {self.budget}")
+        # Every later call fails too, in case the first failure is swallowed
+        if over and BUDGET_ACTION == "reject" and not self.finished and not self.writing:
+            raise BudgetExceeded(f"{self.route} exceeded its Firestore budget")
+
+    def counts(self) -> Dict[str, int]:
+        return {field: getattr(self, field) for field in FIELDS}
+
+    def headers(self) -> Dict[str, str]:
+        return {f"X-Firestore-{field.replace('_', '-').title()}": str(getattr(self, field)) for field in FIELDS}
+
+
+current: contextvars.ContextVar[Optional[Usage]] = contextvars.ContextVar("usage", default=None)
+
+def record(reads: int = 0, writes: int = 0, deletes: int = 0, round_trips: int = 1):
+    usage = current.get()
+    if usage is not None:
+        usage.add(reads, writes, deletes, round_trips)
+
+def start_writing():
+    """
+    Marks the current request as writing before a write that is recorded
+    only once it is done, such as a batch commit.
+    """
+    usage = current.get()
+    if usage is not None:
+        usage.writing = True
+
+def counted(documents: Iterable):
+    """
+    Yields the documents of a query stream, recording each one as a read.
+    """
+    record()
+    for document in documents:
+        record(reads=1, round_trips=0)
+        yield document
+
+def committed(attempt: Dict[str, int]):
+    """
+    Records the reads and writes of the Firestore transaction attempt that
+    committed: one round trip for the reads, which begin the transaction,
+    and one for the commit.
+    """
+    writes = attempt.get("writes", 0)
+    record(reads=attempt.get("reads", 0), writes=writes, round_trips=2 if writes else 1)
+
+async def counted_async(documents):
+    record()
+    async for document in documents:
+        record(reads=1, round_trips=0)
+        yield document
+
+def propagate(func):
+    """
+    Binds func to the current request's Usage, for running on an executor.
+    """
+    usage = current.get()
+    if usage is None:
+        return func
+
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        token = current.set(usage)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            current.reset(token)
+    return run
+
+def stream(items: AsyncIterator) -> AsyncIterator:
+    """
+    Carries the current request's Usage into a response body produced while
+    it is sent, after the handler returned, and marks the request as
+    streaming so its counts are taken once the body is done.
+    """
+    usage = current.get()
+    if usage is None:
+        return items
+    usage.streaming = True
+    return carried(items, usage)
+
+async def carried(items: AsyncIterator, usage: Usage):
+    iterator = items.__aiter__()
+    while True:
+        # Set around every step, which may run in another context than the last
+        token = current.set(usage)
+        try:
+            item = await iterator.__anext__()
+        except StopAsyncIteration:
+            return
+        finally:
+            current.reset(token)
+        yield item
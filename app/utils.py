@@ -1,9 +1,13 @@
+import functools
 import os
 import json
+import base64
 import time
 import logging
 from datetime import datetime, timedelta
 
+from metrics import Histogram
+
 
 def getScriptDir():
     return os.path.dirname(os.path.realpath(__file__))
@@ -29,14 +33,18 @@ def getSecret(secretName):
         secret = secretFile.read().strip()
         return secret
 
+function_seconds = Histogram("function_seconds", "Duration of the functions decorated with measure_time", ["function"])
+
 def measure_time(func):
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        execution_time = end_time - start_time
-        logging.info(f"{func.__name__} took {execution_time:.4f} seconds to execute")
-        return result
+        start_time = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            execution_time = time.perf_counter() - start_time
+            function_seconds.observe(execution_time, func.__name__)
+            logging.info(f"{func.__name__} took {execution_time:.4f} seconds to execute")
     return wrapper
 
 def get_start_and_end_of_month():
@@ -59,3 +67,14 @@ def get_start_and_end_of_month():
     end_epoch = int(end_of_month.timestamp())
 
     return start_epoch, end_epoch
+
+def encode_cursor(timestamp, id):
+    return base64.urlsafe_b64encode(f"{timestamp}:{id}".encode()).decode()
+
+def decode_cursor(cursor):
+    # Raises ValueError for anything encode_cursor did not produce
+    try:
+        timestamp, id = base64.urlsafe_b64decode(cursor.encode()).decode().split(":", 1)
+        return int(timestamp), id
+    except (TypeError, UnicodeDecodeError, base64.binascii.Error) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
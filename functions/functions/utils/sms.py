@@ -1,6 +1,9 @@
 import logging
 from firebase_functions import https_fn
 from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists
+import hashlib
+import os
 import time
 
 # Configure logging
@@ -8,6 +11,46 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(mess
 
 db = firestore.client()
 
+# Must match DEDUPE_WINDOW_SECONDS in the app, both share the sms_hash index
+DEDUPE_WINDOW_SECONDS = int(os.environ.get("DEDUPE_WINDOW_SECONDS", 30 * 24 * 60 * 60))
+
+def sms_hash_ref(email, sms):
+    digest = hashlib.md5(sms.encode()).hexdigest()
+    return db.collection("sms_hash").document(email).collection("hashes").document(digest)
+
+def claim_sms_hash(email, sms, message_id, timestamp):
+    hash_ref = sms_hash_ref(email, sms)
+    claim = {"messageId": message_id, "timestamp": timestamp}
+    try:
+        hash_ref.create(claim)
+        return True
+    except AlreadyExists:
+        pass
+
+    # The expiry check and the rewrite in one transaction, so two saves of
+    # the same SMS cannot both take over an expired claim
+    @firestore.transactional
+    def reclaim(transaction):
+        existing = hash_ref.get(transaction=transaction).to_dict() or {}
+        if abs(timestamp - existing.get("timestamp", 0)) <= DEDUPE_WINDOW_SECONDS:
+            return False
+        transaction.set(hash_ref, claim)
+        return True
+    return reclaim(db.transaction())
+
+def release_sms_hash(email, sms, message_id):
+    # Only our own claim, a retry of the same SMS may hold it by now
+    hash_ref = sms_hash_ref(email, sms)
+
+    @firestore.transactional
+    def release(transaction):
+        if (hash_ref.get(transaction=transaction).to_dict() or {}).get("messageId") == message_id:
+            transaction.delete(hash_ref)
+    try:
+        release(db.transaction())
+    except Exception as e:
+        logging.error(f"Failed to release SMS hash for email: {email}, error: {str(e)}")
+
 def save_sms_from_req(req: https_fn.Request) -> https_fn.Response:
     logging.info("Received request to save SMS")
 
@@ -27,13 +70,21 @@ def save_sms_from_req(req: https_fn.Request) -> https_fn.Response:
         "timestamp": timestamp
     }
 
+    claimed = False
     try:
         sms_collection = db.collection("sms").document(email).collection("messages")
         sms_doc = sms_collection.document()
+        if not claim_sms_hash(email, sms, sms_doc.id, timestamp):
+            logging.info(f"Dropping duplicate SMS for email: {email}")
+            return https_fn.Response("SMS already received"), 200
+        claimed = True
         sms_doc.set(entry)
         logging.info(f"SMS saved successfully for email: {email}")
     except Exception as e:
         logging.error(f"Failed to save SMS for email: {email}, error: {str(e)}")
+        # Otherwise the retry of this SMS would be dropped as a duplicate
+        if claimed:
+            release_sms_hash(email, sms, sms_doc.id)
         return https_fn.Response(f"Failed to save SMS: {str(e)}"), 400
 
     return https_fn.Response("SMS saved successfully"), 200